@@ -0,0 +1,285 @@
+"""
+Provides a driver for running VPT over many fchk files at once, spreading the jobs over a pool of worker processes
+and streaming back compact results in the order the jobs were given
+
+Can also be run as a script on a JSON file holding a list of job specs:
+
+    python -m PyVPT.Batch jobs.json --processes 8 --output results.jsonl
+"""
+
+import os, sys, time, json, traceback, multiprocessing as mp
+from multiprocessing.connection import wait
+import numpy as np
+
+__all__ = [
+    'VPTJob',
+    'VPTJobResult',
+    'run_batch'
+]
+
+class VPTJob:
+    """
+    Represents a single VPT run over an fchk file
+    """
+    def __init__(self,
+                 file,
+                 states=15,
+                 n_quanta=3,
+                 coupled_states='auto',
+                 internals=None,
+                 coeff_threshold=None,
+                 energy_threshold=None,
+                 n_coefficients=5,
+                 cache_dir=None
+                 ):
+        """
+        :param file: the fchk file to run on
+        :type file: str
+        :param states: the states to get corrections for
+        :type states: int | Iterable[int] | Iterable[Iterable[int]]
+        :param n_quanta: the numbers of quanta to use for every mode
+        :type n_quanta: int | Iterable[int]
+        :param coupled_states: the states to couple to (see `PerturbationTheoryHamiltonian.get_corrections`)
+        :type coupled_states: None | str | Iterable[int]
+        :param internals: the internal coordinate system to use
+        :type internals: CoordinateSystem | None
+        :param coeff_threshold: first-order coefficients larger than the first element (from near degeneracies)
+        are replaced by the second, which defaults to 0 (see `PerturbationTheoryHamiltonian.get_corrections`)
+        :type coeff_threshold: float | Iterable[float] | None
+        :param energy_threshold: energy differences smaller than the first element are replaced by the second,
+        which defaults to 1 (see `PerturbationTheoryHamiltonian.get_corrections`)
+        :type energy_threshold: float | Iterable[float] | None
+        :param n_coefficients: the number of largest first-order coefficients to report for every state
+        :type n_coefficients: int
+        :param cache_dir: an optional cache directory to pass through to `from_fchk`
+        :type cache_dir: str | None
+        """
+        self.file = file
+        self.states = states
+        self.n_quanta = n_quanta
+        self.coupled_states = coupled_states
+        self.internals = internals
+        self.coeff_threshold = coeff_threshold
+        self.energy_threshold = energy_threshold
+        self.n_coefficients = n_coefficients
+        self.cache_dir = cache_dir
+    @classmethod
+    def from_spec(cls, spec):
+        """Builds a job from a dict (or just a file name)
+
+        :param spec:
+        :type spec: str | dict
+        :return:
+        :rtype: VPTJob
+        """
+        if isinstance(spec, VPTJob):
+            return spec
+        elif isinstance(spec, str):
+            return cls(spec)
+        else:
+            return cls(**spec)
+
+    def get_hamiltonian(self):
+        """Builds the Hamiltonian the job works with
+
+        :return:
+        :rtype: PerturbationTheoryHamiltonian
+        """
+        from .PerturbationTheory import PerturbationTheoryHamiltonian
+
+        return PerturbationTheoryHamiltonian.from_fchk(
+            self.file,
+            internals=self.internals,
+            n_quanta=self.n_quanta,
+            cache_dir=self.cache_dir
+        )
+
+    def run(self):
+        """Parses, transforms, and solves, returning the compact result
+
+        :return:
+        :rtype: VPTJobResult
+        """
+        start = time.time()
+        try:
+            with self.get_hamiltonian() as ham:
+                states = ham.get_state_indices(len(ham.basis) if self.states is None else self.states)
+                coeffs, corrs, coupled_states = ham.get_corrections(
+                    states,
+                    coupled_states=self.coupled_states,
+                    coeff_threshold=self.coeff_threshold,
+                    energy_threshold=self.energy_threshold,
+                    return_coupled_states=True
+                )
+            energies = np.array([np.broadcast_to(c, (len(states),)) for c in corrs])
+            state_qns = np.array(ham.get_state_quantum_numbers(states))
+            if self.n_coefficients > 0 and coeffs is not None:
+                coeffs = np.asarray(coeffs).reshape((len(states), -1))
+                n = min(self.n_coefficients, coeffs.shape[1])
+                top = np.argsort(-np.abs(coeffs), axis=1)[:, :n]
+                top_coeffs = np.take_along_axis(coeffs, top, axis=1)
+                top_states = np.array(ham.get_state_quantum_numbers(np.asarray(coupled_states)[top.flatten()]))
+                top_states = top_states.reshape(top.shape + (-1,))
+            else:
+                top_coeffs = None
+                top_states = None
+        except Exception as e:
+            return VPTJobResult(
+                self.file,
+                error="{}: {}".format(type(e).__name__, e),
+                traceback=traceback.format_exc(),
+                timing=time.time() - start
+            )
+
+        return VPTJobResult(
+            self.file,
+            states=state_qns,
+            energies=energies,
+            coefficients=top_coeffs,
+            coupled_states=top_states,
+            timing=time.time() - start
+        )
+
+class VPTJobResult:
+    """
+    The compact result of a `VPTJob`, holding the energy corrections at every order
+    and the largest first-order coefficients
+    """
+    def __init__(self, file, states=None, energies=None, coefficients=None, coupled_states=None,
+                 error=None, traceback=None, timing=None):
+        self.file = file
+        self.states = states
+        self.energies = energies
+        self.coefficients = coefficients
+        self.coupled_states = coupled_states
+        self.error = error
+        self.traceback = traceback
+        self.timing = timing
+    @property
+    def failed(self):
+        return self.error is not None
+    @property
+    def total_energies(self):
+        return None if self.energies is None else np.sum(self.energies, axis=0)
+    def to_dict(self):
+        listify = lambda a: None if a is None else np.asarray(a).tolist()
+        return dict(
+            file=self.file,
+            states=listify(self.states),
+            energies=listify(self.energies),
+            coefficients=listify(self.coefficients),
+            coupled_states=listify(self.coupled_states),
+            error=self.error,
+            traceback=self.traceback,
+            timing=self.timing
+        )
+    def __repr__(self):
+        return "{}({}, {})".format(
+            type(self).__name__,
+            self.file,
+            "failed" if self.failed else "{} states".format(len(self.states))
+        )
+
+def _run_job(job, conn, memory_limit):
+    """Worker entry point, runs the job and sends back the result"""
+    if memory_limit is not None:
+        try:
+            import resource
+        except ImportError:
+            pass
+        else:
+            resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    try:
+        res = job.run()
+    except BaseException as e: # e.g. a MemoryError while building the result
+        res = VPTJobResult(job.file, error="{}: {}".format(type(e).__name__, e), traceback=traceback.format_exc())
+    conn.send(res)
+    conn.close()
+
+def run_batch(jobs, processes=None, memory_limit=None, context=None):
+    """Runs VPT over every job, with every job getting its own worker process so that failures
+    (including crashed or killed workers) stay isolated and memory is released after every job.
+    Results are yielded in the order the jobs were given, as soon as they're available.
+
+    :param jobs: the jobs to run (`VPTJob` objects, dicts of `VPTJob` arguments, or file names)
+    :type jobs: Iterable[VPTJob | dict | str]
+    :param processes: the maximum number of jobs to run at once, defaults to the number of CPUs
+    :type processes: int | None
+    :param memory_limit: a per-worker address-space limit in bytes (only enforced on Unix)
+    :type memory_limit: int | None
+    :param context: the multiprocessing start method to use
+    :type context: str | None
+    :return:
+    :rtype: Iterator[VPTJobResult]
+    """
+    jobs = [VPTJob.from_spec(j) for j in jobs]
+    if processes is None:
+        processes = os.cpu_count() or 1
+    ctx = mp.get_context(context)
+
+    queue = list(enumerate(jobs))[::-1]
+    running = {} # sentinel -> (index, process, connection)
+    done = {}
+    next_out = 0
+    while next_out < len(jobs):
+        while queue and len(running) < processes:
+            i, job = queue.pop()
+            recv, send = ctx.Pipe(duplex=False)
+            proc = ctx.Process(target=_run_job, args=(job, send, memory_limit), daemon=True)
+            proc.start()
+            send.close()
+            running[proc.sentinel] = (i, proc, recv)
+
+        ready = wait(list(running.keys()) + [r[2] for r in running.values()])
+        for sentinel in list(running.keys()):
+            i, proc, recv = running[sentinel]
+            res = None
+            if recv in ready or sentinel in ready:
+                if recv.poll():
+                    try:
+                        res = recv.recv()
+                    except EOFError:
+                        res = None
+                elif sentinel not in ready:
+                    continue
+                proc.join()
+                if res is None:
+                    res = VPTJobResult(
+                        jobs[i].file,
+                        error="worker exited with code {} before returning a result".format(proc.exitcode)
+                    )
+                recv.close()
+                del running[sentinel]
+                done[i] = res
+
+        while next_out in done:
+            yield done.pop(next_out)
+            next_out += 1
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Runs VPT over a batch of fchk files")
+    parser.add_argument("jobs", help="a JSON file holding a list of job specs (file names or dicts of VPTJob arguments)")
+    parser.add_argument("--processes", type=int, default=None, help="the number of worker processes to use")
+    parser.add_argument("--memory_limit", type=int, default=None, help="per-worker memory limit in bytes")
+    parser.add_argument("--output", default=None, help="where to write the JSON-lines results, defaults to stdout")
+    opts = parser.parse_args(argv)
+
+    with open(opts.jobs) as f:
+        jobs = json.load(f)
+
+    out = open(opts.output, 'w') if opts.output is not None else sys.stdout
+    failures = 0
+    try:
+        for res in run_batch(jobs, processes=opts.processes, memory_limit=opts.memory_limit):
+            failures += res.failed
+            out.write(json.dumps(res.to_dict()) + "\n")
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 1 if failures > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
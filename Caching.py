@@ -0,0 +1,195 @@
+"""
+Provides a simple on-disk cache for the potential and kinetic expansion terms so that repeated runs over identical
+inputs can skip the parsing and tensor transformations and go straight to the perturbation theory
+"""
+
+import os, hashlib, numpy as np
+from .SymmetricTensors import SymmetricTensor
+
+__all__ = [
+    'ExpansionTermsCache'
+]
+
+class ExpansionTermsCache:
+    """
+    Stores sets of arrays as uncompressed .npz files in a directory, keyed by a hash of whatever inputs
+    were used to generate them
+    """
+    def __init__(self, cache_dir):
+        """
+        :param cache_dir: the directory to store the cached terms in
+        :type cache_dir: str
+        """
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @classmethod
+    def get_key(cls, *inputs):
+        """Hashes the inputs (arrays, numbers, strings, files and nested containers of these) into a key
+
+        :param inputs:
+        :type inputs:
+        :return:
+        :rtype: str
+        """
+        hasher = hashlib.sha1()
+        cls._update_hash(hasher, inputs)
+        return hasher.hexdigest()
+    @classmethod
+    def _update_hash(cls, hasher, obj):
+        if obj is None:
+            hasher.update(b'None')
+        elif isinstance(obj, (str, bytes)):
+            hasher.update(obj.encode() if isinstance(obj, str) else obj)
+        elif isinstance(obj, (bool, int, float, np.integer, np.floating, np.bool_)):
+            hasher.update(repr(obj).encode())
+        elif isinstance(obj, dict):
+            hasher.update(b'dict')
+            for k in sorted(obj.keys(), key=str):
+                cls._update_hash(hasher, k)
+                cls._update_hash(hasher, obj[k])
+        elif isinstance(obj, (tuple, list)):
+            hasher.update(b'seq' + str(len(obj)).encode())
+            for x in obj:
+                cls._update_hash(hasher, x)
+        else:
+            if not isinstance(obj, np.ndarray):
+                if hasattr(obj, 'asarray'):
+                    obj = obj.asarray()
+                elif hasattr(obj, 'toarray'):
+                    obj = obj.toarray()
+            arr = np.ascontiguousarray(obj)
+            if arr.dtype == object:
+                hasher.update(repr(obj).encode())
+            else:
+                hasher.update(str((arr.dtype.str, arr.shape)).encode())
+                hasher.update(arr.tobytes())
+    @classmethod
+    def get_file_key(cls, file, *inputs, block_size=2**20):
+        """Hashes the contents of a file along with any extra inputs
+
+        :param file:
+        :type file: str
+        :return:
+        :rtype: str
+        """
+        hasher = hashlib.sha1()
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                hasher.update(block)
+        cls._update_hash(hasher, inputs)
+        return hasher.hexdigest()
+
+    def get_file(self, key, name):
+        return os.path.join(self.cache_dir, "{}_{}.npz".format(name, key))
+    def has(self, key, name):
+        return os.path.isfile(self.get_file(key, name))
+
+    def save_data(self, key, name, data):
+        """Saves a dict of arrays, writing to a temporary file first so concurrent readers never see partial data
+
+        :param key:
+        :type key: str
+        :param name:
+        :type name: str
+        :param data:
+        :type data: dict
+        """
+        file = self.get_file(key, name)
+        tmp = file + ".{}.tmp".format(os.getpid())
+        with open(tmp, 'wb') as f:
+            np.savez(f, **{k: self._asarray(v) for k, v in data.items()})
+        os.replace(tmp, file)
+    def load_data(self, key, name):
+        """Loads a dict of arrays or returns None if there's nothing cached
+
+        :param key:
+        :type key: str
+        :param name:
+        :type name: str
+        :return:
+        :rtype: dict | None
+        """
+        file = self.get_file(key, name)
+        if not os.path.isfile(file):
+            return None
+        with np.load(file) as data:
+            return {k: data[k] for k in data.files}
+
+    def save(self, key, name, terms):
+        """Saves a tuple of expansion terms, remembering which of them are identically zero and which are packed
+
+        :param key:
+        :type key: str
+        :param name:
+        :type name: str
+        :param terms:
+        :type terms: tuple
+        """
+        self.save_data(key, name, self.encode_terms(terms))
+    def load(self, key, name):
+        """Loads a tuple of expansion terms or returns None if there's nothing cached
+
+        :param key:
+        :type key: str
+        :param name:
+        :type name: str
+        :return:
+        :rtype: tuple | None
+        """
+        data = self.load_data(key, name)
+        if data is None:
+            return None
+        return self.decode_terms(data)
+
+    @classmethod
+    def encode_terms(cls, terms):
+        """Flattens a tuple of expansion terms into a dict of arrays
+
+        :param terms:
+        :type terms: tuple
+        :return:
+        :rtype: dict
+        """
+        data = {}
+        for i, t in enumerate(terms):
+            if isinstance(t, int) and t == 0:
+                data['zero_{}'.format(i)] = np.array(0)
+            elif isinstance(t, SymmetricTensor):
+                for k, v in t.to_data().items():
+                    data['packed_{}_{}'.format(i, k)] = v
+            else:
+                data['term_{}'.format(i)] = cls._asarray(t)
+        return data
+    @classmethod
+    def decode_terms(cls, data):
+        """Rebuilds the tuple of expansion terms flattened by `encode_terms`
+
+        :param data:
+        :type data: dict
+        :return:
+        :rtype: tuple
+        """
+        terms = []
+        i = 0
+        while True:
+            if 'zero_{}'.format(i) in data:
+                terms.append(0)
+            elif 'term_{}'.format(i) in data:
+                terms.append(data['term_{}'.format(i)])
+            elif 'packed_{}_values'.format(i) in data:
+                prefix = 'packed_{}_'.format(i)
+                terms.append(SymmetricTensor.from_data({k[len(prefix):]: v for k, v in data.items() if k.startswith(prefix)}))
+            else:
+                break
+            i += 1
+        return tuple(terms)
+
+    @staticmethod
+    def _asarray(a):
+        if not isinstance(a, np.ndarray):
+            if hasattr(a, 'asarray'):
+                a = a.asarray()
+            elif hasattr(a, 'toarray'):
+                a = a.toarray()
+        return np.asarray(a)
@@ -0,0 +1,176 @@
+"""
+Provides the executor the matrix element evaluation is spread over, so that the (mostly GIL-releasing) NumPy work
+in the product operators and the independent H0/H1/H2 blocks can use more than one core
+"""
+
+import os, functools as fp, itertools as ip, concurrent.futures as cf, numpy as np
+
+__all__ = [
+    'ElementExecutor'
+]
+
+class ElementExecutor:
+    """
+    Wraps a thread (or process) pool, handing back results in the order the work was given so that
+    everything built from them is the same as in a serial run
+    """
+    modes = ('threads', 'processes')
+    def __init__(self, mode='threads', max_workers=None, pool=None):
+        """
+        :param mode: either 'threads' or 'processes', where the processes are started with a fork server (or spawned)
+        so scripts using them need the usual `if __name__ == '__main__'` guard
+        :type mode: str
+        :param max_workers: the number of workers, by default the number of available cores
+        :type max_workers: int | None
+        :param pool: an existing `concurrent.futures` executor to use instead of starting one
+        :type pool: cf.Executor | None
+        """
+        if mode not in self.modes:
+            raise ValueError("{}: mode '{}' isn't one of {}".format(type(self).__name__, mode, self.modes))
+        if pool is not None:
+            mode = 'processes' if isinstance(pool, cf.ProcessPoolExecutor) else 'threads'
+            if max_workers is None:
+                max_workers = getattr(pool, '_max_workers', None)
+        if max_workers is None:
+            max_workers = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+        self.mode = mode
+        self.max_workers = max(1, int(max_workers))
+        self._pool = pool
+        self._owns_pool = pool is None
+        self._block_pool = None
+
+    @classmethod
+    def get(cls, spec):
+        """Normalizes the things that can be passed as an executor
+
+        :param spec: `None` (serial), a number of threads, 'threads' or 'processes', a `concurrent.futures`
+        executor, or an `ElementExecutor`
+        :type spec: None | int | str | cf.Executor | ElementExecutor
+        :return:
+        :rtype: ElementExecutor | None
+        """
+        if spec is None or isinstance(spec, cls):
+            return spec
+        elif isinstance(spec, bool):
+            return cls() if spec else None
+        elif isinstance(spec, int):
+            return None if spec <= 1 else cls(max_workers=spec)
+        elif isinstance(spec, str):
+            return cls(mode=spec)
+        elif isinstance(spec, cf.Executor):
+            return cls(pool=spec)
+        raise ValueError("{}: don't know how to use {} as an executor".format(cls.__name__, spec))
+
+    @property
+    def uses_processes(self):
+        return self.mode == 'processes'
+    @property
+    def pool(self):
+        if self._pool is None:
+            if self.uses_processes:
+                import multiprocessing as mp
+                # the pool can get started from one of the run_all threads, and forking while other threads
+                # are running can leave the workers stuck on locks that were held at the time
+                method = 'forkserver' if 'forkserver' in mp.get_all_start_methods() else 'spawn'
+                self._pool = cf.ProcessPoolExecutor(max_workers=self.max_workers, mp_context=mp.get_context(method))
+            else:
+                self._pool = cf.ThreadPoolExecutor(max_workers=self.max_workers)
+        return self._pool
+
+    def map(self, func, *iterables, shared=None):
+        """Like the builtin `map`, but evaluated on the pool
+
+        :param func: the function to apply, which has to be picklable when using processes
+        :type func: callable
+        :param shared: arrays that every call needs, which are passed to `func` as its first argument. With processes
+        they're copied into shared memory once rather than pickled along with every call, so `func` mustn't hold
+        on to them (or return views of them)
+        :type shared: Iterable[np.ndarray] | None
+        :return: the results, in order
+        :rtype: list
+        """
+        if shared is None:
+            return list(self.pool.map(func, *iterables))
+        shared = list(shared)
+        if not self.uses_processes:
+            return list(self.pool.map(fp.partial(func, shared), *iterables))
+        with _SharedArrays(shared) as spec:
+            return list(self.pool.map(_call_with_shared, ip.repeat(func), ip.repeat(spec), *iterables))
+    def run_all(self, funcs):
+        """Runs a few independent (and not necessarily picklable) callables at once, at most `max_workers` at a
+        time. They go to a separate pool of threads that's kept for the life of the executor, which keeps them
+        from competing for the pool workers they might themselves be waiting on (and lets them be closures even
+        when the pool uses processes)
+
+        :param funcs:
+        :type funcs: Iterable[callable]
+        :return: the results, in order
+        :rtype: list
+        """
+        funcs = list(funcs)
+        if len(funcs) < 2 or self.max_workers == 1:
+            return [f() for f in funcs]
+        if self._block_pool is None:
+            self._block_pool = cf.ThreadPoolExecutor(max_workers=self.max_workers)
+        futures = [self._block_pool.submit(f) for f in funcs]
+        return [f.result() for f in futures]
+
+    def shutdown(self, wait=True):
+        if self._block_pool is not None:
+            self._block_pool.shutdown(wait=wait)
+            self._block_pool = None
+        if self._pool is not None and self._owns_pool:
+            self._pool.shutdown(wait=wait)
+            self._pool = None
+    def __getstate__(self):
+        # pools can't be sent to other processes, but the configuration can
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        state['_owns_pool'] = True
+        state['_block_pool'] = None
+        return state
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+    def __repr__(self):
+        return "{}({}, max_workers={})".format(type(self).__name__, self.mode, self.max_workers)
+
+class _SharedArrays:
+    """
+    Copies a set of arrays into a single block of shared memory for the lifetime of the context, handing out
+    the (picklable) spec that `_call_with_shared` attaches to them with
+    """
+    alignment = 64
+    def __init__(self, arrays):
+        self.arrays = [np.ascontiguousarray(a) for a in arrays]
+        self._shm = None
+    def __enter__(self):
+        from multiprocessing import shared_memory
+        offsets = [0]
+        for a in self.arrays:
+            offsets.append(offsets[-1] + a.nbytes + (-a.nbytes % self.alignment))
+        self._shm = shared_memory.SharedMemory(create=True, size=max(1, offsets[-1]))
+        layout = []
+        for a, offset in zip(self.arrays, offsets):
+            np.ndarray(a.shape, dtype=a.dtype, buffer=self._shm.buf, offset=offset)[...] = a
+            layout.append((offset, a.dtype.str, a.shape))
+        return self._shm.name, tuple(layout)
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._shm.close()
+        self._shm.unlink()
+        self._shm = None
+
+def _call_with_shared(func, spec, *args):
+    """Attaches to the arrays set up by `_SharedArrays` and calls `func` with them in a worker process"""
+    from multiprocessing import shared_memory
+    name, layout = spec
+    shm = shared_memory.SharedMemory(name=name)
+    arrays = None
+    try:
+        arrays = [np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset) for offset, dtype, shape in layout]
+        return func(arrays, *args)
+    finally:
+        # the views have to be gone before the block can be closed
+        arrays = None
+        shm.close()
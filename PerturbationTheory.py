@@ -1,41 +1,68 @@
-import numpy as np, scipy.sparse as sp, functools as fp, itertools as ip
-from Psience import Wavefunctions, Wavefunction, NormalModeCoordinates
-from McUtils.Numputils import SparseArray
-from McUtils.Coordinerds import CoordinateSystem, CoordinateSet, CartesianCoordinates3D
-from McUtils.Data import UnitsData
+import numpy as np, functools as fp, itertools as ip, math, sys, importlib
+from .Caching import ExpansionTermsCache
+from .SymmetricTensors import SymmetricTensor
+from .Profiling import Profiler
+from .StateSpaces import StateSpace, DirectProductStateSpace, TruncatedStateSpace
+from .Serialization import ArrayContainer
+from .Executors import ElementExecutor
 
 __all__ = [
-    'PerturbationTheoryWavefunctions',
     'PerturbationTheoryException',
     'PerturbationTheoryHamiltonian'
 ]
 
+class _LazyImport:
+    """
+    Stands in for a module (or something in one) that's only imported once it's actually used, so that
+    importing PyVPT doesn't pay for Psience, McUtils, and scipy when they aren't needed
+    """
+    def __init__(self, module, name=None):
+        self._module = module
+        self._name = name
+        self._obj = None
+    def load(self):
+        if self._obj is None:
+            obj = importlib.import_module(self._module)
+            self._obj = obj if self._name is None else getattr(obj, self._name)
+        return self._obj
+    def __getattr__(self, item):
+        if item.startswith('_'):
+            raise AttributeError(item)
+        return getattr(self.load(), item)
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+    def __instancecheck__(self, obj):
+        # nothing can be an instance of a class whose module was never imported
+        if self._obj is None and self._module not in sys.modules:
+            return False
+        return isinstance(obj, self.load())
+
+sp = _LazyImport("scipy.sparse")
+SparseArray = _LazyImport("McUtils.Numputils", "SparseArray")
+CoordinateSet = _LazyImport("McUtils.Coordinerds", "CoordinateSet")
+UnitsData = _LazyImport("McUtils.Data", "UnitsData")
+NormalModeCoordinates = _LazyImport("Psience", "NormalModeCoordinates")
+
+def __getattr__(name):
+    # the wavefunctions need Psience, so they live in their own module
+    if name == 'PerturbationTheoryWavefunctions':
+        from .Wavefunctions import PerturbationTheoryWavefunctions
+        return PerturbationTheoryWavefunctions
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
 class PerturbationTheoryException(Exception):
     pass
 
-class PerturbationTheoryWavefunction(Wavefunction):
-    @property
-    def coeffs(self):
-        return self.data
-
-class PerturbationTheoryWavefunctions(Wavefunctions):
-    def __init__(self, basis, energies, coeffs, hamiltonian):
-        """Energies for the wavefunctions generated
-
-        :param energies:
-        :type energies:
-        :param coeffs:
-        :type coeffs:
-        :param hamiltonian:
-        :type hamiltonian:
-        """
-        self.hamiltonian = hamiltonian
-        self.basis = basis
-        super().__init__(
-            energies=energies,
-            wavefunctions=coeffs,
-            wavefunction_class=PerturbationTheoryWavefunction
-        )
+def _densify(a):
+    """Makes sure we're working with a plain np.ndarray"""
+    if isinstance(a, SparseArray):
+        a = a.asarray()
+    return np.asarray(a)
+
+def _get_chunk_size(memory_budget, n_modes):
+    """The number of (bra, ket) elements to compute at once so that a chunk fits in roughly `memory_budget` bytes,
+    going by a rough estimate of the peak number of bytes needed per element"""
+    return max(1, int(memory_budget // (8 * (32 * n_modes + 16))))
 
 class PerturbationTheoryHamiltonian:
     """Represents the main handler used in the perturbation theory calculation
@@ -50,8 +77,23 @@ class PerturbationTheoryHamiltonian:
     :type modes: NormalModeCoordinates
     :param internals: The internal coordinate normal modes
     :type internals: CoordinateSystem
-    :param numbers_of_quanta: The numbers of quanta of excitation to use for every mode
-    :type numbers_of_quanta: np.ndarray | Iterable[int]
+    :param numbers_of_quanta: The numbers of quanta of excitation to use for every mode, or the state space to work in
+    :type numbers_of_quanta: np.ndarray | Iterable[int] | StateSpace
+    :param cache_dir: An optional directory to cache the expansion terms in
+    :type cache_dir: str | None
+    :param cache_key: The key to cache the terms under, by default a hash of the inputs
+    :type cache_key: str | None
+    :param operator_cache_size: The maximum number of operators/single-mode tables to hold on to
+    :type operator_cache_size: int
+    :param profiler: An optional profiler to record the time spent in (and the sizes of) every stage
+    :type profiler: Profiler | None
+    :param executor: An optional executor (or number of threads, or 'threads'/'processes') to evaluate the
+    matrix elements with. One built from a spec is shut down by `close` (or leaving a `with` block), while one that's
+    passed in is left to the caller
+    :type executor: ElementExecutor | int | str | None
+    :param cache_elements: Whether to hold on to every computed matrix element (keyed by quantum numbers) so that
+    they can be reused after the basis is extended
+    :type cache_elements: bool
     """
     def __init__(self,
                  *ignore,
@@ -61,7 +103,13 @@ class PerturbationTheoryHamiltonian:
                  modes = None,
                  internals = None,
                  n_quanta = 3,
-                 undimensionalize = True
+                 undimensionalize = True,
+                 cache_dir = None,
+                 cache_key = None,
+                 operator_cache_size = 128,
+                 profiler = None,
+                 executor = None,
+                 cache_elements = False
                  ):
         if len(ignore) > 0:
             raise PerturbationTheoryException("{} takes no positional arguments".format(
@@ -69,7 +117,13 @@ class PerturbationTheoryHamiltonian:
             ))
         mode_n = modes.matrix.shape[0]
         self.mode_n = mode_n
-        self.n_quanta = np.full((mode_n,), n_quanta) if isinstance(n_quanta, (int, np.int)) else tuple(n_quanta)
+        self.basis = self._get_basis(n_quanta)
+        # the operators only need to know the per-mode bounds, the basis takes care of the state indexing
+        self.n_quanta = self.basis.n_quanta
+        self._displacement_cache = {}
+        self._anharmonic_constants = None
+        self.operator_cache = self.OperatorCache(max_size=operator_cache_size)
+        self.element_cache = self.ElementCache() if cache_elements else None
         # we assume that our modes are already in mass-weighted coordinates, so now we need to make them dimensionless
         # to make life easier, we include this undimensionalization differently for the kinetic and potential energy
         # the kinetic energy needs to be weighted by a sqrt(omega) term while the PE needs a 1/sqrt(omega)
@@ -81,8 +135,104 @@ class PerturbationTheoryHamiltonian:
         else:
             modes_T, modes_V = modes, modes
         self.internals = internals
-        self.V_terms = self.PotentialTerms(pot_derivs, coords, masses, modes_V, internals)
-        self.G_terms = self.KineticTerms(coords, masses, modes_T, internals)
+        if cache_dir is not None:
+            cache = ExpansionTermsCache(cache_dir)
+            if cache_key is None:
+                cache_key = cache.get_key(
+                    coords, masses, pot_derivs,
+                    modes.matrix, modes.freqs,
+                    self._internals_spec(internals),
+                    undimensionalize
+                )
+        else:
+            cache = None
+        # both sets of terms need Jacobians of the internals, which are only worth computing once
+        jacobians = self.JacobianProvider(coords, internals) if internals is not None else None
+        self.V_terms = self.PotentialTerms(pot_derivs, coords, masses, modes_V, internals,
+                                           cache=cache, cache_key=cache_key, profiler=profiler, jacobians=jacobians)
+        self.G_terms = self.KineticTerms(coords, masses, modes_T, internals,
+                                         cache=cache, cache_key=cache_key, profiler=profiler, jacobians=jacobians)
+        self._profiler = profiler
+        self.executor = ElementExecutor.get(executor)
+        # only an executor made here (from a number of threads, a mode, or a bare pool) is ours to shut down
+        self._owns_executor = self.executor is not None and self.executor is not executor
+    def _get_basis(self, n_quanta):
+        """Normalizes the numbers of quanta (or state space) the Hamiltonian can be built with"""
+        if isinstance(n_quanta, StateSpace):
+            if n_quanta.n_modes != self.mode_n:
+                raise PerturbationTheoryException("{}: state space has {} modes but there are {}".format(
+                    type(self).__name__, n_quanta.n_modes, self.mode_n
+                ))
+            return n_quanta
+        if isinstance(n_quanta, (int, np.integer)):
+            n_quanta = np.full((self.mode_n,), n_quanta)
+        return DirectProductStateSpace(n_quanta)
+    def extend_basis(self, n_quanta):
+        """Grows the basis in place, keeping the expansion terms, the operator building blocks, and (with
+        `cache_elements`) every matrix element computed so far, so only the elements involving new states get computed
+
+        :param n_quanta: the new numbers of quanta for every mode, or the new state space
+        :type n_quanta: int | Iterable[int] | StateSpace
+        :return:
+        :rtype: PerturbationTheoryHamiltonian
+        """
+        basis = self._get_basis(n_quanta)
+        if any(new < old for new, old in zip(basis.n_quanta, self.n_quanta)):
+            raise PerturbationTheoryException("{0}.{1}: can't shrink n_quanta from {2} to {3}".format(
+                type(self).__name__, "extend_basis", self.n_quanta, basis.n_quanta
+            ))
+        self.basis = basis
+        self.n_quanta = basis.n_quanta
+        return self
+    def close(self):
+        """Shuts down the worker pools of the executor, if it was built from a spec rather than passed in"""
+        if self._owns_executor:
+            self.executor.shutdown()
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+    def _get_extended_basis(self, step):
+        """The basis with `step` more quanta in every mode (and, for a truncated basis, in total)"""
+        n_quanta = tuple(n + step for n in self.n_quanta)
+        if isinstance(self.basis, DirectProductStateSpace):
+            return DirectProductStateSpace(n_quanta)
+        max_quanta = int(np.max(np.sum(self.basis.get_quantum_numbers(), axis=1)))
+        return TruncatedStateSpace.from_max_quanta(self.mode_n, max_quanta + step, n_quanta=n_quanta)
+    @property
+    def profiler(self):
+        return self._profiler
+    @profiler.setter
+    def profiler(self, profiler):
+        # the operators are handed the profiler whenever their elements are pulled
+        self._profiler = profiler
+        self.V_terms.profiler = profiler
+        self.G_terms.profiler = profiler
+    @staticmethod
+    def _internals_spec(internals):
+        """Pulls everything that defines an internal coordinate system (or set of internal coordinates) out of it,
+        e.g. the z-matrix ordering in the converter options, so that different definitions get different cache keys
+
+        :param internals:
+        :type internals: CoordinateSystem | CoordinateSet | None
+        :return:
+        :rtype: dict | None
+        """
+        if internals is None:
+            return None
+        spec = dict(
+            type=type(internals).__name__,
+            name=getattr(internals, 'name', None),
+            dimension=getattr(internals, 'dimension', None),
+            converter_options=getattr(internals, 'converter_options', None),
+            matrix=getattr(internals, 'matrix', None),
+            origin=getattr(internals, 'origin', None)
+        )
+        if isinstance(internals, np.ndarray):
+            # a set of coordinates is defined by its values along with its system
+            spec['values'] = np.asarray(internals)
+            spec['system'] = PerturbationTheoryHamiltonian._internals_spec(getattr(internals, 'system', None))
+        return spec
     def undimensionalize(self, masses, modes):
         L = modes.matrix
         freqs = modes.freqs
@@ -94,9 +244,94 @@ class PerturbationTheoryHamiltonian:
         return modes_T, modes_V
     @staticmethod
     def _tripmass(masses):
-        return np.broadcast_to(masses, (len(masses), 3)).T.flatten()
+        return np.repeat(np.asarray(masses), 3)
     @classmethod
-    def from_fchk(cls, file, internals = None, n_quanta = 3):
+    def from_fchk(cls, file, internals = None, n_quanta = 3, cache_dir = None, profiler = None, executor = None,
+                  cache_elements = False):
+        """Builds the Hamiltonian from a Gaussian fchk file
+
+        :param file: the fchk file to load
+        :type file: str
+        :param internals: the internal coordinate system to use
+        :type internals: CoordinateSystem | None
+        :param n_quanta: the numbers of quanta to use for every mode, or the state space to work in
+        :type n_quanta: int | Iterable[int] | StateSpace
+        :param cache_dir: if given, the parsed data and expansion terms are cached here keyed by the file contents
+        :type cache_dir: str | None
+        :param profiler: an optional profiler to record the parsing and every later stage with
+        :type profiler: Profiler | None
+        :param executor: an optional executor to evaluate the matrix elements with
+        :type executor: ElementExecutor | int | str | None
+        :param cache_elements: whether to hold on to the computed matrix elements, see `extend_basis`
+        :type cache_elements: bool
+        :return:
+        :rtype: PerturbationTheoryHamiltonian
+        """
+        if cache_dir is not None:
+            cache = ExpansionTermsCache(cache_dir)
+            cache_key = cache.get_file_key(file, cls._internals_spec(internals), True)
+            names = ("fchk", cls.PotentialTerms.__name__, cls.KineticTerms.__name__)
+            if all(cache.has(cache_key, n) for n in names):
+                data = cache.load_data(cache_key, "fchk")
+                return cls(
+                    coords=data["coords"],
+                    masses=data["masses"],
+                    pot_derivs=None,
+                    modes=NormalModeCoordinates(data["modes"], freqs=data["freqs"]),
+                    internals=internals,
+                    n_quanta=n_quanta,
+                    cache_dir=cache_dir,
+                    cache_key=cache_key,
+                    profiler=profiler,
+                    executor=executor,
+                    cache_elements=cache_elements
+                )
+        else:
+            cache = None
+            cache_key = None
+
+        if profiler is not None:
+            start = profiler.start("from_fchk")
+        data = cls.load_fchk_data(file)
+        fcs, thirds, fourths = cls._weight_derivatives_by_mass(
+            data["masses"], data["freqs"],
+            data["force_constants"], data["third_derivatives"], data["fourth_derivatives"]
+        )
+        coords, masses, modes, freqs = data["coords"], data["masses"], data["modes"], data["freqs"]
+        if profiler is not None:
+            profiler.stop("from_fchk", start, (fcs, thirds, fourths), atoms=len(masses))
+
+        ham = cls(
+            coords=coords,
+            masses=masses,
+            pot_derivs=[data["gradient"], fcs, thirds, fourths],
+            modes=NormalModeCoordinates(modes, freqs=freqs),
+            internals=internals,
+            n_quanta=n_quanta, # need a way to pull the internals from the FChk or provide an alternate way to get them...
+            cache_dir=cache_dir,
+            cache_key=cache_key,
+            profiler=profiler,
+            executor=executor,
+            cache_elements=cache_elements
+        )
+        if cache is not None:
+            # we only record the parse once the terms are cached, since a cache hit skips the derivatives entirely
+            ham.V_terms.packed_terms, ham.G_terms.packed_terms
+            cache.save_data(cache_key, "fchk", dict(coords=coords, masses=masses, modes=modes, freqs=freqs))
+
+        return ham
+
+    @classmethod
+    def load_fchk_data(cls, file):
+        """Parses everything the Hamiltonian needs out of a Gaussian fchk file, before any of the mass-dependent
+        weighting is applied (the modes are only rescaled so that they reproduce the frequencies)
+
+        :param file: the fchk file to load
+        :type file: str
+        :return: the coordinates and masses (atomic units), the Cartesian gradient and force constants,
+        the normal mode derivatives of the force constants (as Gaussian reports them), the modes, and the frequencies
+        :rtype: dict
+        """
         from McUtils.GaussianInterface import GaussianFChkReader
 
         with GaussianFChkReader(file) as gr:
@@ -118,7 +353,21 @@ class PerturbationTheoryHamiltonian:
         # raise Exception(UnitsData.convert("Hartrees", "Wavenumbers")*new)
 
         fds = parse["ForceDerivatives"]
-
+        return dict(
+            coords=coords,
+            masses=masses,
+            gradient=parse["Gradient"],
+            force_constants=fcs,
+            third_derivatives=fds.third_deriv_array,
+            fourth_derivatives=fds.fourth_deriv_array,
+            modes=modes,
+            freqs=freqs
+        )
+    @classmethod
+    def _weight_derivatives_by_mass(cls, masses, freqs, fcs, thirds, fourths):
+        """Applies the mass and frequency weighting to the Cartesian force constants and their normal mode
+        derivatives"""
+        amu_conv = UnitsData.convert("AtomicMassUnits", "AtomicUnitOfMass")
         m_conv = np.sqrt(cls._tripmass(masses))
         f_conv = np.sqrt(freqs)
 
@@ -126,44 +375,417 @@ class PerturbationTheoryHamiltonian:
         fcs = fcs * undimension_2
 
         undimension_3 = np.outer(m_conv, m_conv)[np.newaxis, :, :] / f_conv[:, np.newaxis, np.newaxis]
-        thirds = fds.third_deriv_array * (undimension_3 / np.sqrt(amu_conv))
+        thirds = thirds * (undimension_3 / np.sqrt(amu_conv))
 
         wat = np.outer(m_conv, m_conv)[np.newaxis, :, :] / (f_conv**2)[:, np.newaxis, np.newaxis]
         undimension_4 = SparseArray.from_diag(wat/ amu_conv)
-        fourths = fds.fourth_deriv_array
         fourths = fourths * undimension_4
         #symm4=np.tensordot(fourths.tensordot(modes, axes=[2, 1]), modes, axes=[2, 1])
+        return fcs, thirds, fourths
 
-        # test4 = np.array([
-        #     [symm4[1, 2, 0], symm4[1, 0, 2]],
-        #     [symm4[0, 2, 1], symm4[2, 0, 1]]
-        # ])
+    @classmethod
+    def get_isotopologue_modes(cls, coords, masses, fcs, n_modes=None):
+        """Diagonalizes the mass-weighted Hessian for a batch of mass vectors at once, after projecting out the
+        translations and rotations
+
+        :param coords: the Cartesian coordinates
+        :type coords: np.ndarray
+        :param masses: the masses of every atom, one row per isotopologue
+        :type masses: np.ndarray
+        :param fcs: the Cartesian force constants
+        :type fcs: np.ndarray
+        :param n_modes: the number of vibrations, by default 3N-6
+        :type n_modes: int | None
+        :return: the modes (one row per mode, as Cartesian displacements) and frequencies, in order of increasing
+        frequency, with a leading axis running over the isotopologues
+        :rtype: (np.ndarray, np.ndarray)
+        """
+        coords = np.asarray(coords).reshape((-1, 3))
+        masses = np.atleast_2d(masses)
+        ncart = coords.size
+        if n_modes is None:
+            n_modes = ncart - 6
+        sqm = np.sqrt(np.repeat(masses, 3, axis=1))  # (B, 3N)
+        com = np.einsum('ba,ax->bx', masses, coords) / np.sum(masses, axis=1)[:, np.newaxis]
+        rel = coords[np.newaxis] - com[:, np.newaxis]  # (B, N, 3)
+        tr = []
+        for x in range(3):
+            t = np.zeros(rel.shape)
+            t[:, :, x] = 1
+            tr.append(t.reshape((len(masses), -1)) * sqm)
+            tr.append(np.cross(rel, np.eye(3)[x]).reshape((len(masses), -1)) * sqm)
+        tr = np.linalg.qr(np.stack(tr, axis=2))[0]  # (B, 3N, 6), possibly rank deficient for linear molecules
+        proj = np.eye(ncart)[np.newaxis] - tr @ np.swapaxes(tr, 1, 2)
+        hess = fcs[np.newaxis] / (sqm[:, :, np.newaxis] * sqm[:, np.newaxis, :])
+        vals, vecs = np.linalg.eigh(proj @ hess @ proj)
+        # the vibrations are the eigenvectors with the least overlap with the translations and rotations
+        overlap = np.sum((np.swapaxes(tr, 1, 2) @ vecs)**2, axis=1)
+        vib = np.sort(np.argsort(overlap, axis=1, kind='stable')[:, :n_modes], axis=1)
+        vals = np.take_along_axis(vals, vib, axis=1)
+        vecs = np.take_along_axis(vecs, vib[:, np.newaxis, :], axis=2)
+        freqs = np.sign(vals) * np.sqrt(np.abs(vals))
+        modes = np.swapaxes(vecs, 1, 2) / sqm[:, np.newaxis, :]
+        return modes, freqs
+    @classmethod
+    def _transform_mode_derivatives(cls, coords, fcs, old_modes, new_modes, thirds, fourths):
+        """Re-expresses the normal mode derivatives of the force constants in terms of a new set of modes.
+        Each new mode is split into the old modes plus a translation and a rotation. The translations leave the
+        force constants unchanged and a rotation just rotates them, so the third derivatives are exact, and the
+        fourth derivatives along a rotation follow from the third derivatives the same way.
+        Only the semi-diagonal fourth derivatives are available, so the quartic terms between four distinct old
+        modes aren't known and are taken to be zero, which means the fourth derivatives are only exact when every
+        new mode mixes at most three of the old ones (e.g. always for a triatomic).
+
+        :return: the third derivatives and the (semi-diagonal) fourth derivatives with respect to the new modes
+        :rtype: (np.ndarray, np.ndarray)
+        """
+        amu_conv = UnitsData.convert("AtomicMassUnits", "AtomicUnitOfMass")
+        coords = np.asarray(coords).reshape((-1, 3))
+        nat = len(coords)
+        old_modes = np.asarray(old_modes)
+        n_old = len(old_modes)
+        rigid = []
+        gens = []
+        for x in range(3):
+            t = np.zeros(coords.shape)
+            t[:, x] = 1
+            rigid.append(t.reshape(-1))
+        for x in range(3):
+            # the generator of rotations about x, applied to every atom
+            gen = np.cross(np.eye(3)[x], np.eye(3))
+            rigid.append(np.dot(coords, gen).reshape(-1))
+            gens.append(np.kron(np.eye(nat), gen.T))
+        basis = np.concatenate([old_modes, np.array(rigid)], axis=0)
+        duals = np.linalg.pinv(basis.T)
+        coeffs = np.matmul(duals, np.moveaxis(new_modes, -1, -2))  # (..., n_old + 6, n_new)
+        mode_coeffs, rot_coeffs = coeffs[..., :n_old, :], coeffs[..., n_old + 3:, :]
+
+        thirds = _densify(thirds)
+        # the force constants are in atomic units while the derivatives are in Gaussian's mass-weighted units
+        rotated = np.sqrt(amu_conv) * np.array([np.dot(g, fcs) - np.dot(fcs, g) for g in gens])
+        new_thirds = (
+                np.einsum('...ik,iab->...kab', mode_coeffs, thirds)
+                + np.einsum('...rk,rab->...kab', rot_coeffs, rotated)
+        )
 
-        return cls(
-            coords=coords,
+        # the fourth derivatives are assembled along the old modes and the rigid motions and then taken along the
+        # new modes, starting from the quartic terms between the old modes that repeat (at least) one mode
+        nb = len(basis)
+        diag = np.einsum('iiab->iab', _densify(fourths))
+        known = np.einsum('mc,icd,nd->imn', old_modes, diag, old_modes)
+        quartic = np.zeros((nb,) * 4)
+        vib = quartic[:n_old, :n_old, :n_old, :n_old]
+        idx = np.indices(vib.shape)
+        for p, q in ip.combinations(range(4), 2):
+            r, t = [a for a in range(4) if a not in (p, q)]
+            same = idx[p] == idx[q]
+            vib[same] = known[idx[p][same], idx[r][same], idx[t][same]]
+        # the Cartesian third derivatives (along everything, nothing along translations) fix every quartic term
+        # with a rotation in it, since the derivative of the potential along a rotation vanishes everywhere
+        cubic = np.einsum('pa,pbc->abc', duals[np.r_[:n_old, n_old + 3:nb]], np.concatenate([thirds, rotated]))
+        for r, g in enumerate(gens):
+            rot = -np.sqrt(amu_conv) * (
+                    np.einsum('abc,ad->bcd', cubic, g)
+                    + np.einsum('abd,ac->bcd', cubic, g)
+                    + np.einsum('acd,ab->bcd', cubic, g)
+            )
+            rot = np.einsum('bcd,pb,qc,sd->pqs', rot, basis, basis, basis, optimize=True)
+            for ax in range(4):
+                np.moveaxis(quartic, ax, 0)[n_old + 3 + r] = rot
+        new_diag = np.einsum('...pk,...qk,pqrs->...krs', coeffs, coeffs, quartic, optimize=True)
+        new_diag = np.einsum('rc,...krs,sd->...kcd', duals, new_diag, duals, optimize=True)
+        return new_thirds, new_diag
+
+    @classmethod
+    def get_isotopologues(cls, data, masses, internals=None, n_quanta=3, profiler=None, executor=None):
+        """Builds the Hamiltonians for a batch of isotopologues out of a single set of parsed derivatives,
+        so only the mass-dependent steps (the normal modes, the mass weighting, and everything downstream of them)
+        are redone for each one
+
+        The normal mode derivatives are carried over to the new modes exactly, except that the quartic terms
+        between four distinct modes aren't in the fchk file and are taken to be zero.
+        For a molecule with more than three modes, the new fourth derivatives are missing the parts of those terms
+        that get mixed in by the change of modes, which grow with how strongly the substitution mixes the modes
+
+        :param data: an fchk file or the data `load_fchk_data` pulled out of one
+        :type data: str | dict
+        :param masses: the masses (in amu) of every atom, one row per isotopologue
+        :type masses: Iterable[Iterable[float]]
+        :param internals: the internal coordinate system to use
+        :type internals: CoordinateSystem | None
+        :param n_quanta: the numbers of quanta to use for every mode, or the state space to work in
+        :type n_quanta: int | Iterable[int] | StateSpace
+        :param profiler: an optional profiler to record the shared setup and every later stage with
+        :type profiler: Profiler | None
+        :param executor: an optional executor to evaluate the matrix elements with, where every Hamiltonian builds
+        its own from anything but an `ElementExecutor` (and so should be closed once it's done)
+        :type executor: ElementExecutor | int | str | None
+        :return:
+        :rtype: list[PerturbationTheoryHamiltonian]
+        """
+        if isinstance(data, str):
+            data = cls.load_fchk_data(data)
+        if profiler is not None:
+            start = profiler.start("get_isotopologues")
+        amu_conv = UnitsData.convert("AtomicMassUnits", "AtomicUnitOfMass")
+        masses = amu_conv * np.atleast_2d(np.asarray(masses, dtype=float))
+        coords, fcs = data["coords"], data["force_constants"]
+        old_modes = data["modes"]
+        modes, freqs = cls.get_isotopologue_modes(coords, masses, fcs, n_modes=len(old_modes))
+        if data["freqs"][0] > data["freqs"][-1]:
+            modes, freqs = modes[:, ::-1], freqs[:, ::-1]
+        thirds, fourths = cls._transform_mode_derivatives(
+            coords, fcs, old_modes, modes,
+            data["third_derivatives"], data["fourth_derivatives"]
+        )
+        derivs = [
+            cls._weight_derivatives_by_mass(m, f, fcs, t, SparseArray.from_diag(q))
+            for m, f, t, q in zip(masses, freqs, thirds, fourths)
+        ]
+        if profiler is not None:
+            profiler.stop("get_isotopologues", start, derivs, isotopologues=len(masses))
+        return [
+            cls(
+                coords=coords,
+                masses=m,
+                pot_derivs=[data["gradient"]] + list(d),
+                modes=NormalModeCoordinates(L, freqs=f),
+                internals=internals,
+                n_quanta=n_quanta,
+                profiler=profiler,
+                executor=executor
+            )
+            for m, L, f, d in zip(masses, modes, freqs, derivs)
+        ]
+
+    def to_data(self):
+        """Converts to a dict of arrays (and a dict of JSON metadata) for storage, computing the expansion terms if
+        they haven't been yet
+
+        :return: the arrays and the metadata
+        :rtype: (dict, dict)
+        """
+        arrays = {
+            "modes/matrix": self.modes.matrix,
+            "modes/freqs": self.modes.freqs
+        }
+        for name, val in (("coords", self.V_terms.coords), ("masses", self.V_terms.masses)):
+            if val is not None:
+                arrays[name] = np.asarray(val)
+        ArrayContainer.add_group(arrays, "V", ExpansionTermsCache.encode_terms(self.V_terms.packed_terms))
+        ArrayContainer.add_group(arrays, "G", ExpansionTermsCache.encode_terms(self.G_terms.packed_terms))
+        ArrayContainer.add_group(arrays, "basis", self.basis.to_data())
+        internals = self._internals_spec(self.internals)
+        metadata = dict(
+            type=type(self).__name__,
+            basis=type(self.basis).__name__,
+            internals=None if internals is None else ExpansionTermsCache.get_key(internals)
+        )
+        return arrays, metadata
+    @classmethod
+    def from_data(cls, arrays, metadata=None, internals=None, operator_cache_size=128, profiler=None, executor=None):
+        """Rebuilds a Hamiltonian from the output of `to_data`, without recomputing any of the expansion terms
+
+        :param arrays:
+        :type arrays: dict
+        :param metadata:
+        :type metadata: dict | None
+        :param internals: the internal coordinate system the terms were built in, which can't be stored itself
+        :type internals: CoordinateSystem | None
+        :return:
+        :rtype: PerturbationTheoryHamiltonian
+        """
+        masses = arrays.get("masses", None)
+        ham = cls(
+            coords=arrays.get("coords", None),
             masses=masses,
-            pot_derivs=[parse["Gradient"], fcs, thirds, fourths],
-            modes=NormalModeCoordinates(modes, freqs=freqs),
+            pot_derivs=None,
+            modes=NormalModeCoordinates(np.asarray(arrays["modes/matrix"]), freqs=np.asarray(arrays["modes/freqs"])),
             internals=internals,
-            n_quanta=n_quanta # need a way to pull the internals from the FChk or provide an alternate way to get them...
+            n_quanta=StateSpace.from_data(ArrayContainer.get_group(arrays, "basis")),
+            undimensionalize=masses is not None,
+            operator_cache_size=operator_cache_size,
+            profiler=profiler,
+            executor=executor
         )
+        ham.V_terms._terms = ExpansionTermsCache.decode_terms(ArrayContainer.get_group(arrays, "V"))
+        ham.G_terms._terms = ExpansionTermsCache.decode_terms(ArrayContainer.get_group(arrays, "G"))
+        return ham
+    def save(self, file):
+        """Saves the modes, the expansion terms, and the basis as an `ArrayContainer`
+
+        :param file:
+        :type file: str
+        """
+        arrays, metadata = self.to_data()
+        ArrayContainer.write(file, arrays, metadata=metadata)
+    @classmethod
+    def load(cls, file, mmap=True, **opts):
+        """Loads a Hamiltonian written by `save`
+
+        :param file:
+        :type file: str
+        :param mmap: whether to memory-map the expansion terms instead of reading them into memory
+        :type mmap: bool
+        :param opts: the options for `from_data`
+        :return:
+        :rtype: PerturbationTheoryHamiltonian
+        """
+        arrays, metadata = ArrayContainer.read(file, mmap=mmap)
+        if metadata is None or metadata.get("type") != cls.__name__:
+            raise PerturbationTheoryException("{0}.{1}: {2} doesn't hold a {0}".format(cls.__name__, "load", file))
+        return cls.from_data(arrays, metadata, **opts)
+
+    class JacobianProvider:
+        """
+        Computes every order of a Jacobian that's needed in a single pass (so the finite difference displacements of
+        the lower orders aren't repeated for the higher ones) and holds on to them, so that the potential and kinetic
+        terms can share them
+        """
+        def __init__(self, coords, internals):
+            """
+            :param coords: the Cartesian coordinates
+            :type coords: np.ndarray | CoordinateSet
+            :param internals: the internal coordinate system
+            :type internals: CoordinateSystem
+            """
+            self.coords = coords
+            self.internals = internals
+            self._cartesians = None
+            self._internal_coords = None
+            self._jacobians = {}
+        @property
+        def cartesians(self):
+            if self._cartesians is None:
+                from McUtils.Coordinerds import CartesianCoordinates3D
+                self._cartesians = CoordinateSet(self.coords, CartesianCoordinates3D)
+            return self._cartesians
+        @property
+        def internal_coords(self):
+            if self._internal_coords is None:
+                self._internal_coords = self.cartesians.convert(self.internals)
+            return self._internal_coords
+
+        @staticmethod
+        def _get_orders(jacobian, orders):
+            """Asks for all the orders at once, falling back to one at a time if the list of orders isn't supported"""
+            orders = list(orders)
+            try:
+                res = jacobian(orders)
+            except (TypeError, ValueError):
+                res = None
+            if not isinstance(res, (list, tuple)) or len(res) != len(orders):
+                res = [jacobian(o) for o in orders]
+            return res
+        def get_jacobians(self, key, jacobian, orders):
+            """Returns the requested orders of a Jacobian, computing any we don't already have in one pass
+
+            :param key: the name of the Jacobian
+            :type key: hashable
+            :param jacobian: takes an order (or list of orders) and computes the Jacobian(s)
+            :type jacobian: callable
+            :param orders:
+            :type orders: Iterable[int]
+            :return:
+            :rtype: list
+            """
+            have = self._jacobians.setdefault(key, {})
+            # the lower orders come along for free with the highest one, so we always ask for all of them
+            missing = [o for o in orders if o not in have]
+            if len(missing) > 0:
+                todo = list(range(1, max(missing) + 1))
+                for o, j in zip(todo, self._get_orders(jacobian, todo)):
+                    have.setdefault(o, j)
+            return [have[o] for o in orders]
+
+        def get_mode_jacobians(self, modes, orders=(1, 2, 3, 4)):
+            """The derivatives of the Cartesians with respect to the normal modes through the internals"""
+            from McUtils.Coordinerds import CartesianCoordinates3D
+            # keyed on the modes themselves, since the id of a modes object can be reused once it's gone
+            return self.get_jacobians(
+                ('modes', ExpansionTermsCache.get_key(getattr(modes, 'matrix', modes))),
+                lambda o: self.internals.jacobian(self.cartesians, CartesianCoordinates3D, modes, o),
+                orders
+            )
+        def get_cartesian_jacobians(self, orders=(1, 2)):
+            """The derivatives of the internals with respect to the Cartesians"""
+            return self.get_jacobians(
+                'cartesians',
+                lambda o: self.cartesians.jacobian(self.internals, o),
+                orders
+            )
+        def get_internal_jacobians(self, orders=(2, 3)):
+            """The derivatives of the Cartesians with respect to the internals"""
+            from McUtils.Coordinerds import CartesianCoordinates3D
+            return self.get_jacobians(
+                'internals',
+                lambda o: self.internal_coords.jacobian(CartesianCoordinates3D, o),
+                orders
+            )
 
     class ExpansionTerms:
-        def __init__(self):
+        def __init__(self, cache=None, cache_key=None, profiler=None, jacobians=None):
+            """
+            :param cache: an optional cache to load the terms from/store them in
+            :type cache: ExpansionTermsCache | None
+            :param cache_key: the key to use with the cache
+            :type cache_key: str | None
+            :param profiler: an optional profiler to record `get_terms` with
+            :type profiler: Profiler | None
+            :param jacobians: an optional provider to share the internal coordinate Jacobians through
+            :type jacobians: PerturbationTheoryHamiltonian.JacobianProvider | None
+            """
             self._terms = None
+            self._dense_terms = None
+            self._weighted_terms = None
+            self.cache = cache
+            self.cache_key = cache_key
+            self.profiler = profiler
+            self._jacobians = jacobians
+        @property
+        def jacobians(self):
+            if self._jacobians is None:
+                self._jacobians = PerturbationTheoryHamiltonian.JacobianProvider(self.coords, self.internals)
+            return self._jacobians
         def get_terms(self):
             raise NotImplemented
         @property
-        def terms(self):
+        def packed_terms(self):
+            """The terms as they're computed and cached, with the (partially) symmetric ones packed into
+            `SymmetricTensor`s that only hold their unique entries, which is what H1 and H2 contract against"""
             if self._terms is None:
-                self._terms = self.get_terms()
+                if self.cache is not None:
+                    self._terms = self.cache.load(self.cache_key, type(self).__name__)
+                if self._terms is None:
+                    if self.profiler is None:
+                        self._terms = self.get_terms()
+                    else:
+                        self._terms = self.profiler.profile(type(self).__name__ + ".get_terms", self.get_terms)
+                    if self.cache is not None:
+                        self.cache.save(self.cache_key, type(self).__name__, self._terms)
             return self._terms
+        @property
+        def terms(self):
+            """The terms as dense arrays (see `packed_terms` for the packed form)"""
+            if self._dense_terms is None:
+                self._dense_terms = tuple(t.toarray() if isinstance(t, SymmetricTensor) else t for t in self.packed_terms)
+            return self._dense_terms
+        @property
+        def weighted_terms(self):
+            """The terms with every entry scaled by 1/m!, where m is the largest number of its indices that repeat,
+            i.e. the derivatives as they appear in the Taylor expansion summed over only the unique index sets"""
+            if self._weighted_terms is None:
+                self._weighted_terms = [
+                    w.toarray() if isinstance(w, SymmetricTensor) else w
+                    for w in map(self._weight_derivatives, self.packed_terms)
+                ]
+            return self._weighted_terms
         def __getitem__(self, item):
             return self.terms[item]
-        @staticmethod
-        def _dot(*t, axes=None):
+        @classmethod
+        def _dot(cls, *t, axes=None):
             """
-            Flexible tensordot
+            Flexible tensordot, chains of more than two dense tensors are contracted in the optimal order
             """
 
             if len(t) == 1:
@@ -172,31 +794,133 @@ class PerturbationTheoryHamiltonian:
             if any(isinstance(x, int) for x in t):
                 return 0
 
-            tdot = lambda a, b, **kw: (a.tensordot(b, **kw) if hasattr(a, "tensordot") else np.tensordot(a, b, **kw))
-            td = lambda a, b: (0 if isinstance(a, int) or isinstance(b[0], int) else tdot(a, b[0], axes=b[1]))
             if axes is None:
                 axes = [1] * (len(t) - 1)
 
+            if len(t) > 2 and all(isinstance(x, (np.ndarray, SparseArray)) for x in t):
+                return cls._planned_dot(t, axes)
+
+            tdot = lambda a, b, **kw: (a.tensordot(b, **kw) if hasattr(a, "tensordot") else np.tensordot(a, b, **kw))
+            td = lambda a, b: (0 if isinstance(a, int) or isinstance(b[0], int) else tdot(a, b[0], axes=b[1]))
+
             return fp.reduce(td, zip(t[1:], axes), t[0])
+        _contraction_plans = {}
+        @classmethod
+        def _get_contraction_expr(cls, shapes, axes):
+            """Converts a left-to-right chain of tensordots into a single einsum expression
 
+            :param shapes: the shapes of the tensors in the chain
+            :type shapes: tuple
+            :param axes: the tensordot axes for every step of the chain
+            :type axes: Iterable
+            :return:
+            :rtype: str
+            """
+            import string
+            letters = iter(string.ascii_letters)
+            running = [next(letters) for _ in shapes[0]]
+            subs = [list(running)]
+            for shape, ax in zip(shapes[1:], axes):
+                new = [next(letters) for _ in shape]
+                if isinstance(ax, (int, np.integer)):
+                    a_axes = list(range(len(running) - ax, len(running)))
+                    b_axes = list(range(ax))
+                else:
+                    a_axes, b_axes = (list(np.atleast_1d(x)) for x in ax)
+                a_axes = [i % len(running) for i in a_axes]
+                b_axes = [j % len(new) for j in b_axes]
+                for i, j in zip(a_axes, b_axes):
+                    new[j] = running[i]
+                running = [l for i, l in enumerate(running) if i not in a_axes] + \
+                          [l for j, l in enumerate(new) if j not in b_axes]
+                subs.append(new)
+            return ",".join("".join(s) for s in subs) + "->" + "".join(running)
+        @classmethod
+        def _planned_dot(cls, t, axes):
+            """Contracts a chain of tensors in the cheapest order, caching the plan by the input shapes
+
+            :param t: the tensors
+            :type t: Iterable[np.ndarray]
+            :param axes: the tensordot axes for every step of the chain, as `_dot` takes them
+            :type axes: Iterable
+            :return:
+            :rtype: np.ndarray
+            """
+            t = [_densify(x) for x in t]
+            key = (
+                tuple(x.shape for x in t),
+                tuple(a if isinstance(a, (int, np.integer)) else tuple(tuple(np.atleast_1d(x)) for x in a) for a in axes)
+            )
+            if key not in cls._contraction_plans:
+                expr = cls._get_contraction_expr(key[0], axes)
+                path = np.einsum_path(expr, *t, optimize='optimal')[0]
+                cls._contraction_plans[key] = (expr, path)
+            expr, path = cls._contraction_plans[key]
+            return np.einsum(expr, *t, optimize=path)
+
+        _weight_cache = {}
+        _dense_weight_limit = 2**22
         @staticmethod
-        def _weight_derivatives(t):
+        def _get_multiplicities(shape):
+            """The largest number of axes that share an index value, at every position in a tensor of the given shape"""
+            k = len(shape)
+            grids = [np.arange(n).reshape((1,)*a + (n,) + (1,)*(k-a-1)) for a, n in enumerate(shape)]
+            mult = np.ones(shape, dtype=np.uint8)
+            for a in range(k):
+                counts = sum((grids[a] == grids[b]).astype(np.uint8) for b in range(k))
+                mult = np.maximum(mult, counts)
+            return mult
+        @classmethod
+        def _get_weights(cls, shape):
+            """The (cached) weights 1/m!, with m the largest number of repeated indices, either as a dense tensor or,
+            for large tensors, as the flat positions of the entries with repeated indices and their weights
+
+            :param shape:
+            :type shape: tuple
+            :return:
+            :rtype: np.ndarray | tuple
+            """
+            shape = tuple(int(n) for n in shape)
+            if shape not in cls._weight_cache:
+                k = len(shape)
+                facs = 1 / np.array([math.factorial(i) for i in range(k + 1)])
+                if np.prod(shape) <= cls._dense_weight_limit:
+                    weights = facs[cls._get_multiplicities(shape)]
+                else:
+                    # only the O(N^(k-1)) entries on one of the pairwise diagonals have a weight other than one
+                    diags = []
+                    for a, b in ip.combinations(range(k), 2):
+                        sub = [n for i, n in enumerate(shape) if i != b]
+                        sub[a] = min(shape[a], shape[b])
+                        idx = np.array(np.unravel_index(np.arange(int(np.prod(sub))), sub))
+                        diags.append(np.insert(idx, b, idx[a], axis=0))
+                    idx = np.concatenate(diags, axis=1)
+                    flat = np.unique(np.ravel_multi_index(idx, shape))
+                    idx = np.array(np.unravel_index(flat, shape)).T
+                    mult = np.max(np.sum(idx[:, :, np.newaxis] == idx[:, np.newaxis, :], axis=2), axis=1)
+                    weights = (flat, facs[mult])
+                cls._weight_cache[shape] = weights
+            return cls._weight_cache[shape]
+        @classmethod
+        def _weight_derivatives(cls, t):
             if isinstance(t, int):
                 return t
-            weighted = t
             order = len(t.shape)
-            if order > 1:
-                s = t.shape
-                weights = np.ones(s)
-                all_inds = list(range(len(s)))
-                for i in range(2, order + 1):
-                    for inds in ip.combinations(all_inds, i):
-                        # define a diagonal slice through
-                        sel = tuple(slice(None, None, None) if a not in inds else np.arange(s[a]) for a in all_inds)
-                        weights[sel] = 1 / np.math.factorial(i)
-                weighted = weighted * weights
-                # print(weights, weighted.array)
-            return weighted
+            if order < 2:
+                return t
+            if isinstance(t, SymmetricTensor):
+                # the weight is invariant under permuting the indices, so it can be applied to the packed values
+                idx = t.indices
+                mult = np.max(np.sum(idx[:, :, np.newaxis] == idx[:, np.newaxis, :], axis=2), axis=1)
+                facs = 1 / np.array([math.factorial(i) for i in range(order + 1)])
+                return type(t)(t.values * facs[mult], t.indices, t.shape, t.groups)
+            weights = cls._get_weights(t.shape)
+            if isinstance(weights, tuple):
+                flat, vals = weights
+                t = np.array(_densify(t), dtype=float)
+                t.reshape(-1)[flat] *= vals
+                return t
+            return t * weights
         @staticmethod
         def _shift(a, *s):
             if isinstance(a, int):
@@ -287,7 +1011,8 @@ class PerturbationTheoryHamiltonian:
 
             xQQQQ = x_derivs[3]
             Vxxxx = V_derivs[3]
-            V_QQQQ_1 = dot(xQQQQ, Vx) + dot(xQ, Vxx, xQQQ, axes=[[-1, 0], [-1, -1]])
+            # xQ_Vxx, xQQ_Vxx, VQxx and xQ_VQxx_xQQ are shared between several of the terms
+            V_QQQQ_1 = dot(xQQQQ, Vx) + dot(xQ_Vxx, xQQQ, axes=[[-1, -1]])
 
             xQQQ_Vxx_xQ = dot(xQQQ, Vxx, xQ, axes=[[-1, 0], [-1, -1]])
             xQ_22_Vxxx = dot(xQ, Vxxx, axes=[[-1, 1]])
@@ -305,9 +1030,10 @@ class PerturbationTheoryHamiltonian:
                     shift(xQQ_Vxx_xQQ, (0, 3))
             )
 
+            xQ_VQxx_xQQ = dot(xQ, VQxx, xQQ, axes=[[1, 1], [2, 2]])
             V_QQQQ_4 = (
                     shift(xQQ_Vxx_xQQ, (1, 2)) +
-                    shift(dot(xQ, VQxx, xQQ, axes=[[1, 1], [2, 2]]), (2, 3)) +
+                    shift(xQ_VQxx_xQQ, (2, 3)) +
                     shift(xQQQ_Vxx_xQ, (0, 1), (3, 1))
             )
 
@@ -319,7 +1045,7 @@ class PerturbationTheoryHamiltonian:
             V_QQQQ_5 = (
                     dot(xQQ, VQxx, xQ, axes=[[2, 1], [3, 1]]) +
                     shift(dot(xQQ, VQxx, xQ, axes=[[2, 2], [2, 1]]), (3, 1)) +
-                    shift(dot(xQ, VQxx, xQQ, axes=[[1, 1], [2, 2]]), (2, 0)) +
+                    shift(xQ_VQxx_xQQ, (2, 0)) +
                     dot(VQQxx, xQ, xQ, axes=[[3, 1], [2, 1]])
             )
 
@@ -333,14 +1059,15 @@ class PerturbationTheoryHamiltonian:
 
             return V_Q, V_QQ, V_QQQ, V_QQQQ
     class PotentialTerms(ExpansionTerms):
-        def __init__(self, v_derivs, coords, masses, modes, internals, mixed_derivs = True):
+        def __init__(self, v_derivs, coords, masses, modes, internals, mixed_derivs = True,
+                     cache=None, cache_key=None, profiler=None, jacobians=None):
             self.coords = coords
             self.modes = modes
             self.masses = masses
             self.internals = internals
-            self.v_derivs = self._canonicalize_derivs(v_derivs)
+            self.v_derivs = self._canonicalize_derivs(v_derivs) if v_derivs is not None else None
             self.mixed_derivs = mixed_derivs
-            super().__init__()
+            super().__init__(cache=cache, cache_key=cache_key, profiler=profiler, jacobians=jacobians)
 
         def _canonicalize_derivs(self, derivs):
 
@@ -389,6 +1116,13 @@ class PerturbationTheoryHamiltonian:
             return grad, fcs, thirds, fourths
 
         def get_terms(self):
+            if self.v_derivs is None:
+                raise PerturbationTheoryException(
+                    "{0}.{1}: no potential derivatives were supplied and no cached terms were found".format(
+                        type(self).__name__,
+                        "get_terms"
+                    )
+                )
             if self.internals is None:
                 # this is nice because it eliminates most of terms in the expansion
                 xQ = self.modes.matrix
@@ -397,11 +1131,7 @@ class PerturbationTheoryHamiltonian:
                 xQQQQ = 0
             else:
                 # I think this could do with some sprucing up...
-                ccoords = CoordinateSet(self.coords, CartesianCoordinates3D)
-                xQ = self.internals.jacobian(ccoords, CartesianCoordinates3D, self.modes, 1)
-                xQQ = self.internals.jacobian(ccoords, CartesianCoordinates3D, self.modes, 2)
-                xQQQ = self.internals.jacobian(ccoords, CartesianCoordinates3D, self.modes, 3)
-                xQQQQ = self.internals.jacobian(ccoords, CartesianCoordinates3D, self.modes, 4)
+                xQ, xQQ, xQQQ, xQQQQ = self.jacobians.get_mode_jacobians(self.modes, (1, 2, 3, 4))
 
             x_derivs = (xQ, xQQ, xQQQ, xQQQQ)
 
@@ -426,9 +1156,16 @@ class PerturbationTheoryHamiltonian:
             #     v4[0, 0, 0, 0]
             # ]).T
 
+            # only the unique i<=j<=k(<=l) entries are kept, which is all QQQ and QQQQ can see anyway
+            if not isinstance(v3, int):
+                v3 = SymmetricTensor.from_dense(v3)
+            if not isinstance(v4, int):
+                v4 = SymmetricTensor.from_dense(v4)
+
             return v2, v3, v4
     class KineticTerms(ExpansionTerms):
-        def __init__(self, coords, masses, modes, internals = None):
+        def __init__(self, coords, masses, modes, internals = None, cache=None, cache_key=None, profiler=None,
+                     jacobians=None):
             """Represents the KE coefficients
 
             :param masses: masses of the atoms in the modes
@@ -437,12 +1174,20 @@ class PerturbationTheoryHamiltonian:
             :type modes: NormalModeCoordinates
             :param internals: Optional internal coordinate set to rexpress in
             :type internals: CoordinateSystem | None
+            :param cache: an optional cache to load the terms from/store them in
+            :type cache: ExpansionTermsCache | None
+            :param cache_key: the key to use with the cache
+            :type cache_key: str | None
+            :param profiler: an optional profiler to record `get_terms` with
+            :type profiler: Profiler | None
+            :param jacobians: an optional provider to share the internal coordinate Jacobians through
+            :type jacobians: PerturbationTheoryHamiltonian.JacobianProvider | None
             """
             self.coords = coords
             self.masses = masses
             self.modes = modes
             self.internals = internals
-            super().__init__()
+            super().__init__(cache=cache, cache_key=cache_key, profiler=profiler, jacobians=jacobians)
 
         def get_terms(self):
 
@@ -467,13 +1212,8 @@ class PerturbationTheoryHamiltonian:
                 # we're dropping this because we want to go dimensionless
                 J = L#dot(L, m)
 
-                carts = CartesianCoordinates3D
-                ccoords = CoordinateSet(self.coords, CartesianCoordinates3D)
-                XR = ccoords.jacobian(self.internals, 1)
-                XRR = ccoords.jacobian(self.internals, 2)
-                intcds = ccoords.convert(self.internals)
-                RXX = intcds.jacobian(carts, 2)
-                RXXX = intcds.jacobian(carts, 3)
+                XR, XRR = self.jacobians.get_cartesian_jacobians((1, 2))
+                RXX, RXXX = self.jacobians.get_internal_jacobians((2, 3))
                 RQ = np.linalg.pinv(J)
 
                 YQ = dot(RQ, XR)
@@ -491,16 +1231,29 @@ class PerturbationTheoryHamiltonian:
                 GQQ_2 = dot(JQ, JQ, axes=[[2, 2]])
                 GQQ = GQQ_1 + shift(GQQ_2, (2, 0)) + shift(GQQ_2, (2, 1)) + shift(GQQ_1, (2, 3))
 
+            # the G-matrix derivatives are symmetric in the momentum indices, which we pack when it holds
+            if not isinstance(GQ, int) and SymmetricTensor.is_symmetric(GQ, ((0, 2), (1,))):
+                GQ = SymmetricTensor.from_dense(GQ, ((0, 2), (1,)))
+            if not isinstance(GQQ, int) and SymmetricTensor.is_symmetric(GQQ, ((0, 3), (1, 2))):
+                GQQ = SymmetricTensor.from_dense(GQQ, ((0, 3), (1, 2)))
+
             G_terms = (G, GQ, GQQ)
             return G_terms
 
     class SubHamiltonian:
-        def __init__(self, compute, n_quanta):
+        def __init__(self, compute, n_quanta, name=None, profiler=None, basis=None, element_cache=None,
+                     selection_rules=None):
             self.compute = compute
             self.dims = n_quanta
+            self.basis = DirectProductStateSpace(n_quanta) if basis is None else basis
+            self.name = type(self).__name__ if name is None else name
+            self.profiler = profiler
+            self.element_cache = element_cache
+            # the changes in quantum numbers that can have nonzero elements, None if anything goes
+            self.selection_rules = selection_rules
         @property
         def diag(self):
-            ndims = int(np.prod(self.dims))
+            ndims = len(self.basis)
             return self[np.arange(ndims), np.arange(ndims)]
         def get_element(self, n, m):
             """Pulls elements of the Hamiltonian, first figures out if it's supposed to be pulling blocks...
@@ -512,9 +1265,12 @@ class PerturbationTheoryHamiltonian:
             :return:
             :rtype:
             """
-
-            dims = self.dims
-            ndims = int(np.prod(dims))
+            if self.profiler is None:
+                return self._get_element(n, m)
+            return self.profiler.profile(self.name + ".get_element", self._get_element, n, m)
+        def _get_element(self, n, m):
+            basis = self.basis
+            ndims = len(basis)
             idx = (n, m)
 
             pull_elements = True
@@ -531,26 +1287,19 @@ class PerturbationTheoryHamiltonian:
             if not isinstance(n, int):
                 if isinstance(n, np.ndarray):
                     n = n.flatten()
-                if not isinstance(n, slice):
-                    n = np.array(n)
-                n = np.arange(ndims)[n]
+                n = self._normalize_indices(n, ndims)
             else:
                 n = [n]
             if not isinstance(m, int):
                 if isinstance(m, np.ndarray):
                     m = m.flatten()
-                if not isinstance(m, slice):
-                    m = np.array(m)
-                m = np.arange(ndims)[m]
+                m = self._normalize_indices(m, ndims)
             else:
                 m = [m]
-            if pull_elements:
-                n = np.unravel_index(n, dims)
-                m = np.unravel_index(m, dims)
-            else:
-                blocks = np.array(list(ip.product(n, m)))
-                n = np.unravel_index(blocks[:, 0], dims)
-                m = np.unravel_index(blocks[:, 1], dims)
+            n = basis.unravel(n)
+            m = basis.unravel(m)
+            if not pull_elements:
+                return self._get_block(n, m)
             def pad_lens(a, b):
                 if isinstance(a, (int, np.integer)) and not isinstance(b, (int, np.integer)):
                     a = np.full((len(b),), a)
@@ -558,12 +1307,68 @@ class PerturbationTheoryHamiltonian:
                     b = np.full((len(a),), b)
                 return a,b
             i = tuple(pad_lens(a, b) for a,b in zip(n,m))
-            els = self.compute(i)
-            if pull_elements:
-                return els
+            return self._compute(i)
+        @staticmethod
+        def _normalize_indices(n, ndims):
+            """Turns a slice, boolean mask, or (possibly negative) indices into the basis into plain indices,
+            following NumPy's indexing rules without allocating an index for every basis state
+
+            :param n:
+            :type n: slice | Iterable[int] | Iterable[bool]
+            :param ndims: the size of the basis
+            :type ndims: int
+            :return:
+            :rtype: np.ndarray
+            """
+            if isinstance(n, slice):
+                return np.arange(*n.indices(ndims))
+            n = np.asarray(n)
+            if n.size == 0:
+                return n.astype(int)
+            if n.dtype == bool:
+                if n.shape != (ndims,):
+                    raise IndexError("boolean index did not match the basis of size {}".format(ndims))
+                return np.nonzero(n)[0]
+            if not np.issubdtype(n.dtype, np.integer):
+                raise IndexError("only integers, slices, and integer or boolean arrays are valid indices")
+            bad = np.logical_or(n < -ndims, n >= ndims)
+            if bad.any():
+                raise IndexError("index {} is out of bounds for a basis of size {}".format(n[bad].flat[0], ndims))
+            return np.where(n < 0, n + ndims, n)
+        def _compute(self, idx):
+            if self.element_cache is None:
+                return self.compute(idx)
+            return self.element_cache.get(self.name, idx, self.compute)
+        def _get_block(self, n, m):
+            """Computes the (len(n), len(m)) block between two sets of states, broadcasting their quantum numbers
+            against each other and only handing the pairs the selection rules allow to `compute`
+
+            :param n: the quantum numbers of the row states, one array per mode
+            :type n: tuple[np.ndarray]
+            :param m: the quantum numbers of the column states, one array per mode
+            :type m: tuple[np.ndarray]
+            :return:
+            :rtype: np.ndarray
+            """
+            n = [np.asarray(x, dtype=int).reshape(-1) for x in n]
+            m = [np.asarray(x, dtype=int).reshape(-1) for x in m]
+            shp = (len(n[0]), len(m[0]))
+            if self.selection_rules is None:
+                rows, cols = np.indices(shp).reshape((2, -1))
             else:
-                shp = (len(np.unique(blocks[:, 0])), len(np.unique(blocks[:, 1])))
-                return els.reshape(shp).squeeze()
+                changes = np.sum(np.abs(self.selection_rules), axis=1)
+                dists = np.zeros(shp, dtype=int)
+                for a, b in zip(n, m):
+                    dists += np.abs(a[:, np.newaxis] - b[np.newaxis, :])
+                allowed = dists <= np.max(changes)
+                parities = np.unique(changes % 2)
+                if len(parities) == 1:
+                    allowed = np.logical_and(allowed, dists % 2 == parities[0])
+                rows, cols = np.nonzero(allowed)
+            block = np.zeros(shp)
+            if len(rows) > 0:
+                block[rows, cols] = _densify(self._compute(tuple((a[rows], b[cols]) for a, b in zip(n, m)))).reshape(-1)
+            return block.squeeze()
 
         def __getitem__(self, item):
             if not isinstance(item, tuple):
@@ -572,18 +1377,291 @@ class PerturbationTheoryHamiltonian:
                 item = item + (slice(None, None, None),)
             return self.get_element(*item)
 
+        def _get_states(self, states):
+            if states is None:
+                return np.arange(len(self.basis))
+            if isinstance(states, slice):
+                return np.arange(len(self.basis))[states]
+            return np.unique(np.asarray(states, dtype=int))
+        def get_couplings(self, states=None, chunk_size=100):
+            """Enumerates the (row <= column) pairs of states the selection rules allow a nonzero element between,
+            by applying the allowed changes in quantum numbers to every state rather than comparing every pair
+
+            :param states: the (basis indices of the) states to use, all of them by default
+            :type states: None | slice | Iterable[int]
+            :param chunk_size: the number of states to process at once
+            :type chunk_size: int
+            :return: the row and column positions into the (sorted) states
+            :rtype: (np.ndarray, np.ndarray)
+            """
+            states = self._get_states(states)
+            if self.selection_rules is None:
+                return np.triu_indices(len(states))
+            qns = self.basis.get_quantum_numbers(states)
+            rows = []
+            cols = []
+            for i in range(0, len(states), chunk_size):
+                new = qns[i:i+chunk_size, np.newaxis, :] + self.selection_rules[np.newaxis, :, :]
+                inds = self.basis.get_indices(new, missing=-1)
+                pos = np.minimum(np.searchsorted(states, inds), len(states) - 1)
+                r, c = np.nonzero(np.logical_and(inds >= 0, states[pos] == inds))
+                c = pos[r, c]
+                r = r + i
+                upper = r <= c
+                rows.append(r[upper])
+                cols.append(c[upper])
+            if len(rows) == 0:
+                return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+            return np.concatenate(rows), np.concatenate(cols)
+        def to_sparse(self, states=None, memory_budget=None):
+            """Assembles the block over `states` as a sparse matrix, only computing the elements allowed by
+            the selection rules (and only the upper triangle, since the Hamiltonian is symmetric)
+
+            :param states: the (basis indices of the) states to use, all of them by default
+            :type states: None | slice | Iterable[int]
+            :param memory_budget: if given, the elements are computed in chunks that fit in roughly this many bytes
+            :type memory_budget: int | None
+            :return: the matrix, with rows and columns in the order of the sorted states
+            :rtype: sp.csr_matrix
+            """
+            states = self._get_states(states)
+            ns = len(states)
+            rows, cols = self.get_couplings(states)
+            if len(rows) == 0:
+                return sp.csr_matrix((ns, ns))
+            if memory_budget is None:
+                step = len(rows)
+            else:
+                step = _get_chunk_size(memory_budget, self.basis.n_modes)
+            vals = np.concatenate([
+                _densify(self.get_element(states[rows[i:i+step]], states[cols[i:i+step]])).reshape(-1)
+                for i in range(0, len(rows), step)
+            ])
+            nz = vals != 0
+            rows, cols, vals = rows[nz], cols[nz], vals[nz]
+            off = rows != cols
+            return sp.csr_matrix(
+                (
+                    np.concatenate([vals, vals[off]]),
+                    (np.concatenate([rows, cols[off]]), np.concatenate([cols, rows[off]]))
+                ),
+                shape=(ns, ns)
+            )
+        def export(self, file, states=None, memory_budget=None, format=None):
+            """Writes the block over `states` to a file other solvers can load, either as a compressed .npz that
+            `scipy.sparse.load_npz` reads (with the quantum numbers of the states stored under 'basis') or in the
+            Matrix Market format
+
+            :param file:
+            :type file: str
+            :param states: the (basis indices of the) states to use, all of them by default
+            :type states: None | slice | Iterable[int]
+            :param memory_budget: see `to_sparse`
+            :type memory_budget: int | None
+            :param format: 'npz' or 'mtx', by default taken from the file extension
+            :type format: str | None
+            :return: the matrix that was written
+            :rtype: sp.csr_matrix
+            """
+            if format is None:
+                format = 'mtx' if file.endswith('.mtx') else 'npz'
+            states = self._get_states(states)
+            mat = self.to_sparse(states, memory_budget=memory_budget)
+            if format == 'mtx':
+                from scipy.io import mmwrite
+                mmwrite(file, mat, comment="{} over {} states".format(self.name, len(states)), symmetry='symmetric')
+            elif format == 'npz':
+                # the same layout as scipy.sparse.save_npz, plus the basis
+                np.savez_compressed(
+                    file,
+                    format=mat.format.encode('ascii'),
+                    shape=mat.shape,
+                    data=mat.data,
+                    indices=mat.indices,
+                    indptr=mat.indptr,
+                    basis=self.basis.get_quantum_numbers(states)
+                )
+            else:
+                raise ValueError("{}.export: unknown format '{}'".format(self.name, format))
+            return mat
+
+    class OperatorCache:
+        """
+        A size-bounded, least-recently-used cache that lets the operators and their single-mode
+        building blocks be shared across H0, H1, H2, and repeated calls
+        """
+        def __init__(self, max_size=128, max_bytes=None):
+            """
+            :param max_size: the maximum number of entries to keep
+            :type max_size: int | None
+            :param max_bytes: the maximum total size of array-valued entries to keep
+            :type max_bytes: int | None
+            """
+            from collections import OrderedDict
+            from threading import RLock
+            self.max_size = max_size
+            self.max_bytes = max_bytes
+            self._data = OrderedDict()
+            self._bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self._lock = RLock()
+        def __len__(self):
+            return len(self._data)
+        def __contains__(self, key):
+            return key in self._data
+        def get(self, key, builder):
+            """Returns the cached value for key, building (and caching) it if it isn't there
+
+            :param key:
+            :type key:
+            :param builder:
+            :type builder: callable
+            :return:
+            :rtype:
+            """
+            with self._lock:
+                if key in self._data:
+                    self.hits += 1
+                    self._data.move_to_end(key)
+                    return self._data[key]
+                self.misses += 1
+                val = builder()
+                self._data[key] = val
+                self._bytes += getattr(val, 'nbytes', 0)
+                self._evict()
+                return val
+        def _evict(self):
+            while len(self._data) > 1 and (
+                    (self.max_size is not None and len(self._data) > self.max_size)
+                    or (self.max_bytes is not None and self._bytes > self.max_bytes)
+            ):
+                k, v = self._data.popitem(last=False)
+                self._bytes -= getattr(v, 'nbytes', 0)
+        def set(self, key, val):
+            """Stores val under key, replacing whatever was there
+
+            :param key:
+            :type key:
+            :param val:
+            :type val:
+            :return:
+            :rtype:
+            """
+            with self._lock:
+                if key in self._data:
+                    self._bytes -= getattr(self._data.pop(key), 'nbytes', 0)
+                self._data[key] = val
+                self._bytes += getattr(val, 'nbytes', 0)
+                self._evict()
+                return val
+        def clear(self):
+            with self._lock:
+                self._data.clear()
+                self._bytes = 0
+
+    class ElementCache:
+        """
+        Holds on to the matrix elements of each sub-Hamiltonian keyed by the quantum numbers of the bra and ket
+        (rather than the basis indices), so they stay valid when the basis changes and only the elements
+        involving new states have to be computed
+        """
+        def __init__(self):
+            from threading import RLock
+            self._stores = {}
+            self._lock = RLock()
+            self.hits = 0
+            self.misses = 0
+        def __len__(self):
+            return sum(len(k) for k, v in self._stores.values())
+        @staticmethod
+        def _get_keys(n, m):
+            # the Hamiltonian is symmetric, so <n|H|m> and <m|H|n> share a key
+            diff = n - m
+            first = np.argmax(diff != 0, axis=0)
+            swap = diff[first, np.arange(diff.shape[1])] < 0
+            n, m = np.where(swap, m, n), np.where(swap, n, m)
+            pairs = np.ascontiguousarray(np.concatenate([n, m]).T.astype(np.int16))
+            return pairs.view(np.dtype((np.void, pairs.dtype.itemsize * pairs.shape[1]))).reshape(-1)
+        def get(self, name, idx, compute):
+            """Returns the elements of the sub-Hamiltonian `name` for the (n, m) pairs in `idx`, only calling
+            `compute` on the ones that haven't been seen before
+
+            :param name:
+            :type name: str
+            :param idx: pairs of quantum numbers (n, m) for every mode
+            :type idx: Iterable[Iterable[np.ndarray]]
+            :param compute: the function computing the elements
+            :type compute: callable
+            :return:
+            :rtype: np.ndarray
+            """
+            idx = tuple(np.broadcast_arrays(*(np.asarray(x, dtype=int) for x in j)) for j in idx)
+            n = np.array([j[0] for j in idx]).reshape((len(idx), -1))
+            m = np.array([j[1] for j in idx]).reshape((len(idx), -1))
+            keys = self._get_keys(n, m)
+            with self._lock:
+                known, vals = self._stores.get(name, (keys[:0], np.zeros(0)))
+            els = np.zeros(len(keys))
+            found = np.zeros(len(keys), dtype=bool)
+            if len(known) > 0:
+                pos = np.minimum(np.searchsorted(known, keys), len(known) - 1)
+                found = known[pos] == keys
+                els[found] = vals[pos[found]]
+            missing = np.flatnonzero(np.logical_not(found))
+            with self._lock:
+                self.hits += len(keys) - len(missing)
+                self.misses += len(missing)
+            if len(missing) > 0:
+                new_keys, first = np.unique(keys[missing], return_index=True)
+                todo = missing[first]
+                new_vals = _densify(compute(tuple((n[k][todo], m[k][todo]) for k in range(len(idx))))).reshape(-1)
+                els[missing] = new_vals[np.searchsorted(new_keys, keys[missing])]
+                with self._lock:
+                    known, vals = self._stores.get(name, (keys[:0], np.zeros(0)))
+                    new = np.ones(len(new_keys), dtype=bool)
+                    if len(known) > 0:
+                        # another thread may have added some of these in the meantime
+                        pos = np.minimum(np.searchsorted(known, new_keys), len(known) - 1)
+                        new = known[pos] != new_keys
+                    known = np.concatenate([known, new_keys[new]])
+                    vals = np.concatenate([vals, new_vals[new]])
+                    order = np.argsort(known, kind='stable')
+                    self._stores[name] = (known[order], vals[order])
+            return els
+        def clear(self):
+            with self._lock:
+                self._stores.clear()
+
+    def get_operator(self, name):
+        """Returns the (shared) `ProductOperator` with the given name, e.g. 'QQQ' or 'pQp'. Since it can be shared,
+        the profiler and executor to use are passed along when its elements are pulled
+
+        :param name:
+        :type name: str
+        :return:
+        :rtype: PerturbationTheoryHamiltonian.ProductOperator
+        """
+        op = self.operator_cache.get(
+            ("operator", name, tuple(self.n_quanta)),
+            lambda: getattr(self.ProductOperator, name)(self.n_quanta, cache=self.operator_cache)
+        )
+        return op
+
     @property
     def H0(self):
         def compute_H1(inds,
-                       G=self.G_terms[0],
-                       V=self.V_terms[0],
-                       pp=self.ProductOperator.pp(self.n_quanta),
-                       QQ=self.ProductOperator.QQ(self.n_quanta),
+                       G=self.G_terms.packed_terms[0],
+                       V=self.V_terms.packed_terms[0],
+                       pp=self.get_operator('pp'),
+                       QQ=self.get_operator('QQ'),
                        H=self._compute_h0
                        ):
             return H(inds, G, V, pp, QQ)
 
-        return self.SubHamiltonian(compute_H1, self.n_quanta)
+        return self.SubHamiltonian(compute_H1, self.n_quanta, name="H0", profiler=self.profiler,
+                                   basis=self.basis, element_cache=self.element_cache,
+                                   selection_rules=self.get_selection_rule_displacements(2))
 
     def _compute_h0(self, inds, G, F, pp, QQ):
         """
@@ -600,11 +1678,12 @@ class PerturbationTheoryHamiltonian:
         :return:
         :rtype:
         """
+        opts = dict(profiler=self.profiler, executor=self.executor)
 
         # print(type(gmatrix_derivs))
         if not isinstance(G, int):
             # takes a 5-dimensional SparseTensor and turns it into a contracted 2D one
-            subKE = pp[inds]
+            subKE = pp.get_elements(inds, **opts)
             if isinstance(subKE, np.ndarray):
                 ke = np.tensordot(subKE.squeeze(), -G, axes=[[0, 1], [0, 1]])
             else:
@@ -613,7 +1692,7 @@ class PerturbationTheoryHamiltonian:
             ke = 0
 
         if not isinstance(F, int):
-            subPE = QQ[inds]
+            subPE = QQ.get_elements(inds, **opts)
             if isinstance(subPE, np.ndarray):
                 pe = np.tensordot(subPE.squeeze(), F, axes=[[0, 1], [0, 1]])
             else:
@@ -627,14 +1706,16 @@ class PerturbationTheoryHamiltonian:
     @property
     def H1(self):
         def compute_H1(inds,
-                       G=self.G_terms[1],
-                       V=self.V_terms[1],
-                       pQp=self.ProductOperator.pQp(self.n_quanta),
-                       QQQ=self.ProductOperator.QQQ(self.n_quanta),
+                       G=self.G_terms.packed_terms[1],
+                       V=self.V_terms.packed_terms[1],
+                       pQp=self.get_operator('pQp'),
+                       QQQ=self.get_operator('QQQ'),
                        H=self._compute_h1
                        ):
             return H(inds, G, V, pQp, QQQ)
-        return self.SubHamiltonian(compute_H1, self.n_quanta)
+        return self.SubHamiltonian(compute_H1, self.n_quanta, name="H1", profiler=self.profiler,
+                                   basis=self.basis, element_cache=self.element_cache,
+                                   selection_rules=self.get_selection_rule_displacements(3))
 
     def _compute_h1(self, inds, gmatrix_derivs, V_derivs, pQp, QQQ):
         """
@@ -651,9 +1732,12 @@ class PerturbationTheoryHamiltonian:
         :return:
         :rtype:
         """
+        opts = dict(profiler=self.profiler, executor=self.executor)
 
-        if not isinstance(gmatrix_derivs, int):
-            subpQp = pQp[inds]
+        if isinstance(gmatrix_derivs, SymmetricTensor):
+            ke = np.squeeze(-gmatrix_derivs.contract(pQp.get_element_matrix(inds, **opts)))
+        elif not isinstance(gmatrix_derivs, int):
+            subpQp = pQp.get_elements(inds, **opts)
             if isinstance(subpQp, np.ndarray):
                 subpQp = subpQp.squeeze()
                 ke = np.tensordot(subpQp, -gmatrix_derivs, axes=[[0, 1, 2], [0, 1, 2]])
@@ -662,8 +1746,10 @@ class PerturbationTheoryHamiltonian:
         else:
             ke = 0
 
-        if not isinstance(V_derivs, int):
-            subQQQ = QQQ[inds]
+        if isinstance(V_derivs, SymmetricTensor):
+            pe = np.squeeze(V_derivs.contract(QQQ.get_element_matrix(inds, **opts)))
+        elif not isinstance(V_derivs, int):
+            subQQQ = QQQ.get_elements(inds, **opts)
             if isinstance(subQQQ, np.ndarray):
                 subQQQ = subQQQ.squeeze()
                 pe = np.tensordot(subQQQ, V_derivs, axes=[[0, 1, 2], [0, 1, 2]])
@@ -680,15 +1766,17 @@ class PerturbationTheoryHamiltonian:
     @property
     def H2(self):
         def compute_H2(inds,
-                       G=self.G_terms[2],
-                       V=self.V_terms[2],
-                       KE=self.ProductOperator.pQQp(self.n_quanta),
-                       PE=self.ProductOperator.QQQQ(self.n_quanta),
+                       G=self.G_terms.packed_terms[2],
+                       V=self.V_terms.packed_terms[2],
+                       KE=self.get_operator('pQQp'),
+                       PE=self.get_operator('QQQQ'),
                        H=self._compute_h2
                        ):
             return H(inds, G, V, KE, PE)
 
-        return self.SubHamiltonian(compute_H2, self.n_quanta)
+        return self.SubHamiltonian(compute_H2, self.n_quanta, name="H2", profiler=self.profiler,
+                                   basis=self.basis, element_cache=self.element_cache,
+                                   selection_rules=self.get_selection_rule_displacements(4))
 
     def _compute_h2(self, inds, gmatrix_derivs, V_derivs, KE, PE):
         """
@@ -705,10 +1793,13 @@ class PerturbationTheoryHamiltonian:
         :return:
         :rtype:
         """
+        opts = dict(profiler=self.profiler, executor=self.executor)
 
         # print(type(gmatrix_derivs))
-        if not isinstance(gmatrix_derivs, int):
-            keTens = KE[inds]
+        if isinstance(gmatrix_derivs, SymmetricTensor):
+            ke = np.squeeze(-gmatrix_derivs.contract(KE.get_element_matrix(inds, **opts)))
+        elif not isinstance(gmatrix_derivs, int):
+            keTens = KE.get_elements(inds, **opts)
             if isinstance(keTens, np.ndarray):
                 ke = np.tensordot(keTens.squeeze(), -gmatrix_derivs, axes=[[0, 1, 2, 3], [0, 1, 2, 3]])
             else:
@@ -718,8 +1809,10 @@ class PerturbationTheoryHamiltonian:
 
         # print(inds)
 
-        if not isinstance(V_derivs, int):
-            peTens = PE[inds]
+        if isinstance(V_derivs, SymmetricTensor):
+            pe = np.squeeze(V_derivs.contract(PE.get_element_matrix(inds, **opts)))
+        elif not isinstance(V_derivs, int):
+            peTens = PE.get_elements(inds, **opts)
             if isinstance(peTens, np.ndarray):
                 pe = np.tensordot(peTens.squeeze(), V_derivs, axes=[[0, 1, 2, 3], [0, 1, 2, 3]])
             else:
@@ -734,20 +1827,37 @@ class PerturbationTheoryHamiltonian:
         Provides a (usually) _lazy_ representation of an operator, which allows things like
         QQQ and pQp to be calculated block-by-block
         """
-        def __init__(self, funcs, quanta):
+        def __init__(self, funcs, quanta, cache=None, profiler=None, executor=None):
             """
 
             :param funcs:
             :type funcs:
             :param quanta:
             :type quanta:
+            :param cache: an optional cache to share single-mode element tables through
+            :type cache: PerturbationTheoryHamiltonian.OperatorCache | None
+            :param profiler: an optional profiler to record the element pulls with
+            :type profiler: Profiler | None
+            :param executor: an optional executor to spread the element evaluation over
+            :type executor: ElementExecutor | None
             """
             self.funcs = funcs
             self.quanta = tuple(quanta)
             self.mode_n = len(quanta)
+            self.cache = cache
+            self.profiler = profiler
+            self.executor = executor
             self._tensor = None
+            self._index_blocks = None
+            self.chunk_size = int(1e6)
 
         @property
+        def name(self):
+            return "".join(
+                "Q" if f is self.qmatrix_ho else "p" if f is self.pmatrix_ho else getattr(f, '__name__', 'f')
+                for f in self.funcs
+            )
+        @property
         def ndim(self):
             return len(self.funcs) + len(self.quanta)
         @property
@@ -776,47 +1886,314 @@ class PerturbationTheoryHamiltonian:
         def __getitem__(self, item):
             return self.get_elements(item)
         def get_individual_elements(self, idx):
+            """Pulls the products of the single-mode elements for every inner index tuple,
+            without applying the orthogonality of the modes that aren't in the tuple
+
+            :param idx: pairs of quantum numbers (n, m) for every mode
+            :type idx: Iterable[Iterable[np.ndarray]]
+            :return:
+            :rtype: np.ndarray
+            """
             if len(idx) != len(self.quanta):
                 raise ValueError("number of indices requested must be the same as the number of modes")
-            inds = self.get_inner_indices()
-            idx = tuple(tuple(np.array([i]) if isinstance(i, (int, np.integer)) else i for i in j) for j in idx)
-            funcs = self.funcs
-            quants = self.quanta
-            def pull(inds, f=funcs, x=idx, qn = quants):
-                uinds = np.unique(inds)
-                mats = self._operator_submatrix(f, qn, inds, return_kron=False)
-                els = [m[x[i]] for m,i in zip(mats, uinds)]
-                if isinstance(els[0], np.matrix):
-                    els = [np.asarray(e).squeeze() for e in els]
-                res = np.prod(els, axis=0)
-                # print(inds, [len(x[i][0]) for i in inds])
-                return res
-            res = np.apply_along_axis(pull, -1, inds)
-            return res
-        def get_elements(self, idx):
+            return self._get_batched_elements(idx, orthogonalize=False).toarray().reshape(
+                (self.mode_n,)*len(self.funcs) + (-1,)
+            )
+        def get_elements(self, idx, profiler=None, executor=None):
+            """Pulls the matrix elements <n|O|m> for every inner index tuple (i, j, k, ...) using the closed-form
+            harmonic oscillator expressions, so the per-tuple Kronecker product tensor is never built
+
+            :param idx: pairs of quantum numbers (n, m) for every mode
+            :type idx: Iterable[Iterable[np.ndarray]]
+            :param profiler: the profiler to record the pull with, by default the operator's own
+            :type profiler: Profiler | None
+            :param executor: the executor to evaluate the elements on, by default the operator's own
+            :type executor: ElementExecutor | None
+            :return:
+            :rtype: SparseArray
+            """
             if len(idx) != len(self.quanta):
                 raise ValueError("number of indices requested must be the same as the number of quanta")
-            inds = self.get_inner_indices()
-            idx = tuple(tuple(np.array([i]) if isinstance(i, (int, np.integer)) else i for i in j) for j in idx)
-            tens = self.tensor
-            quants = self.quanta
-            def pull(inds, t=tens, x=idx, qn = quants):
-                sly = t[tuple(inds)]
-                uinds = np.unique(inds)
-                sub = tuple(tuple(j) for i in uinds for j in x[i])
-                try:
-                    res = sly[sub]
-                except:
-                    print(sub)
-                    raise
-
-                missing = [i for i in range(len(x)) if i not in inds]
-                equivs = [x[i][0] == x[i][1] for i in missing]
-
-                orthog = np.prod(equivs, axis=0).astype(int)
-                return res * orthog
-            res = np.apply_along_axis(pull, -1, inds)
-            return SparseArray(res.squeeze())
+            els = self.get_element_matrix(idx, profiler=profiler, executor=executor)
+            return SparseArray(els, shape=(self.mode_n,)*len(self.funcs) + (els.shape[1],))
+        def get_element_matrix(self, idx, profiler=None, executor=None):
+            """Pulls the matrix elements like `get_elements` but as a sparse matrix where the rows run over the
+            flattened inner indices and the columns over the requested elements
+
+            :param idx: pairs of quantum numbers (n, m) for every mode
+            :type idx: Iterable[Iterable[np.ndarray]]
+            :param profiler: the profiler to record the pull with, by default the operator's own
+            :type profiler: Profiler | None
+            :param executor: the executor to evaluate the elements on, by default the operator's own
+            :type executor: ElementExecutor | None
+            :return:
+            :rtype: sp.csr_matrix
+            """
+            if len(idx) != len(self.quanta):
+                raise ValueError("number of indices requested must be the same as the number of quanta")
+            if profiler is None:
+                profiler = self.profiler
+            if profiler is None:
+                return self._get_batched_elements(idx, executor=executor)
+            return profiler.profile(
+                "ProductOperator({}).get_element_matrix".format(self.name),
+                self._get_batched_elements,
+                idx,
+                executor=executor
+            )
+
+        def _get_index_blocks(self):
+            """Groups the inner index tuples by which of their positions share a mode, since within a group every tuple
+            needs the same single-mode words. Returns the flat positions of the tuples, the modes each block of
+            positions maps to, and the words that act on them
+
+            :return:
+            :rtype: list
+            """
+            if self._index_blocks is None:
+                # these don't depend on the quanta, so operators over different bases can share them
+                if self.cache is None:
+                    self._index_blocks = self._compute_index_blocks()
+                else:
+                    self._index_blocks = self.cache.get(
+                        ("index_blocks", self.funcs, self.mode_n),
+                        self._compute_index_blocks
+                    )
+            return self._index_blocks
+        def _compute_index_blocks(self):
+            k = len(self.funcs)
+            dims = (self.mode_n,) * k
+            blocks = []
+            for labels in ip.product(range(k), repeat=k):
+                # restricted growth strings enumerate each set partition exactly once
+                if any(l > max(labels[:i], default=-1) + 1 for i, l in enumerate(labels)):
+                    continue
+                labels = np.array(labels)
+                nblocks = int(labels.max()) + 1
+                if nblocks > self.mode_n:
+                    continue
+                modes = np.array(list(ip.permutations(range(self.mode_n), nblocks)), dtype=int)
+                flat = np.ravel_multi_index(modes[:, labels].T, dims)
+                words = tuple(tuple(f for f, l in zip(self.funcs, labels) if l == b) for b in range(nblocks))
+                blocks.append((flat, modes, words))
+            return blocks
+
+        def _get_batched_elements(self, idx, orthogonalize=True, chunk_size=None, executor=None):
+            """Evaluates every inner index tuple against every requested (n, m) pair in one go
+
+            :param idx: pairs of quantum numbers (n, m) for every mode
+            :type idx: Iterable[Iterable[np.ndarray]]
+            :param orthogonalize: whether to apply <n_i|m_i> for the modes that don't appear in the tuple
+            :type orthogonalize: bool
+            :param chunk_size: the number of tuples (times requested elements) to handle at once
+            :type chunk_size: int | None
+            :param executor: the executor to evaluate the chunks on, by default the operator's own
+            :type executor: ElementExecutor | None
+            :return: the (tuple, element) matrix
+            :rtype: sp.csr_matrix
+            """
+            if chunk_size is None:
+                chunk_size = self.chunk_size
+            if executor is None:
+                executor = self.executor
+            nels = max(len(np.atleast_1d(x)) for j in idx for x in j)
+            n = np.array([np.broadcast_to(j[0], (nels,)) for j in idx], dtype=int)
+            m = np.array([np.broadcast_to(j[1], (nels,)) for j in idx], dtype=int)
+            mismatch = n != m
+            if orthogonalize and nels > 0:
+                # all the modes that change have to be covered by the tuple, so elements that change the same
+                # modes share the same (usually small) set of tuples
+                patterns, pattern_inds = np.unique(mismatch.T, axis=0, return_inverse=True)
+                pattern_inds = pattern_inds.reshape(-1)
+                pattern_order = np.argsort(pattern_inds, kind='stable')
+                pattern_els = np.split(pattern_order, np.cumsum(np.bincount(pattern_inds))[:-1])
+            words = {}
+
+            rows = []
+            cols = []
+            vals = []
+            tasks = []
+            results = []
+            for flat, modes, block_words in self._get_index_blocks():
+                for w in block_words:
+                    if w not in words:
+                        words[w] = self._operator_elements(w, n, m)
+                if orthogonalize:
+                    if nels == 0:
+                        continue
+                    mode_mask = np.zeros((len(modes), self.mode_n), dtype=bool)
+                    mode_mask[np.arange(len(modes))[:, np.newaxis], modes] = True
+                    chunks = []
+                    for pat, els in zip(patterns, pattern_els):
+                        if np.count_nonzero(pat) > modes.shape[1]:
+                            continue
+                        sub = np.nonzero(np.all(mode_mask[:, pat], axis=1))[0]
+                        step = max(1, chunk_size // len(els))
+                        for i in range(0, len(sub), step):
+                            chunks.append((np.repeat(sub[i:i+step], len(els)), np.tile(els, len(sub[i:i+step]))))
+                else:
+                    step = max(1, chunk_size // max(nels, 1))
+                    chunks = (
+                        (
+                            i + np.repeat(np.arange(len(modes[i:i+step])), nels),
+                            np.tile(np.arange(nels), len(modes[i:i+step]))
+                        )
+                        for i in range(0, len(modes), step)
+                    )
+                tables = [words[w] for w in block_words]
+                if executor is None:
+                    for p, e in chunks:
+                        nz, v = self._evaluate_chunk(tables, modes[p], e)
+                        rows.append(flat[p[nz]])
+                        cols.append(e[nz])
+                        vals.append(v)
+                else:
+                    chunks = list(chunks)
+                    tasks.extend((flat, p, e) for p, e in chunks)
+                    # the tables are the same for every chunk, so they're only sent to the workers once
+                    results.extend(executor.map(
+                        self._evaluate_chunk,
+                        [modes[p] for p, e in chunks], [e for p, e in chunks],
+                        shared=tables
+                    ))
+            # results come back in submission order, so the matrix is assembled exactly as in the serial case
+            for (flat, p, e), (nz, v) in zip(tasks, results):
+                rows.append(flat[p[nz]])
+                cols.append(e[nz])
+                vals.append(v)
+
+            shp = (self.mode_n**len(self.funcs), nels)
+            if len(rows) > 0:
+                rows = np.concatenate(rows)
+                cols = np.concatenate(cols)
+                vals = np.concatenate(vals)
+            return sp.csr_matrix((vals, (rows, cols)), shape=shp)
+        @staticmethod
+        def _evaluate_chunk(tables, modes, els):
+            """Multiplies out the single-mode elements for a chunk of (tuple, element) pairs
+
+            :param tables: the single-mode elements of every word, indexed by (mode, element)
+            :type tables: list[np.ndarray]
+            :param modes: the modes of every tuple in the chunk
+            :type modes: np.ndarray
+            :param els: the element of every tuple in the chunk
+            :type els: np.ndarray
+            :return: which pairs are nonzero and their values
+            :rtype: tuple
+            """
+            v = np.prod([t[modes[:, b], els] for b, t in enumerate(tables)], axis=0)
+            nz = v != 0
+            return nz, v[nz]
+
+        def _ladder_coefficients(self, f):
+            """Returns the coefficients of (a, a^dagger) for the operators we know in closed form
+
+            :param f:
+            :type f:
+            :return:
+            :rtype: None | tuple
+            """
+            if f is self.qmatrix_ho:
+                return (1/np.sqrt(2), 1/np.sqrt(2))
+            elif f is self.pmatrix_ho:
+                # same phase convention as pmatrix_ho, i.e. the imaginary unit has been pulled out
+                return (1/np.sqrt(2), -1/np.sqrt(2))
+            else:
+                return None
+
+        def _operator_elements(self, funcs, n, m):
+            """Computes <n|f_1 f_2 ... f_k|m> for a single mode. If every f is linear in the ladder operators this
+            is done in closed form, otherwise we fall back to multiplying out just large enough 1D matrices
+
+            :param funcs: the functions acting on the mode, in order
+            :type funcs: tuple
+            :param n: the bra quantum numbers
+            :type n: np.ndarray
+            :param m: the ket quantum numbers
+            :type m: np.ndarray
+            :return:
+            :rtype: np.ndarray
+            """
+            n = np.asarray(n, dtype=int)
+            m = np.asarray(m, dtype=int)
+            if self.cache is not None and len(self.quanta) > 0:
+                size = int(np.max(self.quanta))
+                if n.size > 0 and max(np.max(n), np.max(m)) < size and min(np.min(n), np.min(m)) >= 0:
+                    key = ("elements", funcs)
+                    table = self.cache.get(key, lambda: self._extend_operator_elements(funcs, None, size))
+                    if len(table) < size:
+                        # the basis has grown since the table was built, so we only fill in the new rows and columns
+                        table = self.cache.set(key, self._extend_operator_elements(funcs, table, size))
+                    return table[n, m]
+            return self._compute_operator_elements(funcs, n, m)
+        def _extend_operator_elements(self, funcs, table, size):
+            """Grows a table of single-mode elements to `size` x `size`, only computing the entries that aren't
+            already in `table`
+
+            :param funcs:
+            :type funcs: tuple
+            :param table: the existing (square) table, if there is one
+            :type table: np.ndarray | None
+            :param size:
+            :type size: int
+            :return:
+            :rtype: np.ndarray
+            """
+            if table is None:
+                return self._compute_operator_elements(funcs, *np.indices((size, size)))
+            old = len(table)
+            new = np.empty((size, size), dtype=table.dtype)
+            new[:old, :old] = table
+            border = np.ones((size, size), dtype=bool)
+            border[:old, :old] = False
+            n, m = np.nonzero(border)
+            new[n, m] = self._compute_operator_elements(funcs, n, m)
+            return new
+        def _compute_operator_elements(self, funcs, n, m):
+            terms = [self._ladder_coefficients(f) for f in funcs]
+            if all(t is not None for t in terms):
+                return self._ladder_elements(terms, n, m)
+
+            n = np.asarray(n, dtype=int)
+            m = np.asarray(m, dtype=int)
+            size = int(max(np.max(n), np.max(m))) + len(funcs) + 1
+            mat = fp.reduce(lambda a, b: a.dot(b), [f(size) for f in funcs])
+            if sp.issparse(mat):
+                mat = mat.toarray()
+            return np.asarray(mat)[n, m]
+
+        @staticmethod
+        def _ladder_elements(terms, n, m):
+            """Closed-form <n|f_1 f_2 ... f_k|m> where each f_i = c_a a + c_d a^dagger, obtained by summing over every
+            sequence of raising/lowering operators that connects m to n (so |n - m| <= k)
+
+            :param terms: the (c_a, c_d) pairs for every operator
+            :type terms: Iterable[tuple]
+            :param n:
+            :type n: np.ndarray
+            :param m:
+            :type m: np.ndarray
+            :return:
+            :rtype: np.ndarray
+            """
+            n, m = np.broadcast_arrays(np.asarray(n, dtype=int), np.asarray(m, dtype=int))
+            k = len(terms)
+            delta = n - m
+            res = np.zeros(n.shape)
+            for path in ip.product((-1, 1), repeat=k):
+                if not np.any(delta == sum(path)):
+                    continue # selection rule
+                s = m
+                c = np.ones(n.shape)
+                # the rightmost operator acts first
+                for (ca, cd), step in zip(reversed(terms), reversed(path)):
+                    if step > 0:
+                        c = c * (cd * np.sqrt(np.maximum(s + 1, 0)))
+                    else:
+                        c = c * (ca * np.sqrt(np.maximum(s, 0)))
+                    s = s + step
+                res += c * (s == n)
+            return res
 
         def product_operator_tensor(self):
             """Generates the tensor created from the product of funcs over the dimensions dims, except for the fact that it
@@ -830,11 +2207,15 @@ class PerturbationTheoryHamiltonian:
             :rtype:
             """
 
+            if self.profiler is not None:
+                start = self.profiler.start("ProductOperator({}).product_operator_tensor".format(self.name))
             dims = self.quanta
             funcs = self.funcs
             base_tensor = self.get_inner_indices()
             news_boy = lambda inds, f=funcs, d=dims: self._operator_submatrix(f, d, inds)
             news_boys = np.apply_along_axis(news_boy, -1, base_tensor)
+            if self.profiler is not None:
+                self.profiler.stop("ProductOperator({}).product_operator_tensor".format(self.name), start, news_boys)
 
             return news_boys
 
@@ -911,85 +2292,191 @@ class PerturbationTheoryHamiltonian:
             return sp.csr_matrix(sp.diags([b[0] for b in bands], [b[1] for b in bands]))
 
         @classmethod
-        def QQ(cls, n_quanta, qmatrix=None):
+        def QQ(cls, n_quanta, qmatrix=None, cache=None):
             if qmatrix is None:
                 qmatrix = cls.qmatrix_ho
-            return cls((qmatrix, qmatrix), n_quanta)
+            return cls((qmatrix, qmatrix), n_quanta, cache=cache)
 
         @classmethod
-        def pp(cls, n_quanta, pmatrix=None):
+        def pp(cls, n_quanta, pmatrix=None, cache=None):
             if pmatrix is None:
                 pmatrix = cls.pmatrix_ho
-            return cls((pmatrix, pmatrix), n_quanta)
+            return cls((pmatrix, pmatrix), n_quanta, cache=cache)
 
         @classmethod
-        def QQQ(cls, n_quanta, qmatrix=None):
+        def QQQ(cls, n_quanta, qmatrix=None, cache=None):
             if qmatrix is None:
                 qmatrix = cls.qmatrix_ho
-            return cls((qmatrix, qmatrix, qmatrix), n_quanta)
+            return cls((qmatrix, qmatrix, qmatrix), n_quanta, cache=cache)
 
         @classmethod
-        def pQp(cls, n_quanta, pmatrix=None, qmatrix=None):
+        def pQp(cls, n_quanta, pmatrix=None, qmatrix=None, cache=None):
             if pmatrix is None:
                 pmatrix = cls.pmatrix_ho
             if qmatrix is None:
                 qmatrix = cls.qmatrix_ho
-            return cls((pmatrix, qmatrix, pmatrix), n_quanta)
+            return cls((pmatrix, qmatrix, pmatrix), n_quanta, cache=cache)
 
         @classmethod
-        def QQQQ(cls, n_quanta, qmatrix=None):
+        def QQQQ(cls, n_quanta, qmatrix=None, cache=None):
             if qmatrix is None:
                 qmatrix = cls.qmatrix_ho
-            return cls((qmatrix, qmatrix, qmatrix, qmatrix), n_quanta)
+            return cls((qmatrix, qmatrix, qmatrix, qmatrix), n_quanta, cache=cache)
 
         @classmethod
-        def pQQp(cls, n_quanta, pmatrix=None, qmatrix=None):
+        def pQQp(cls, n_quanta, pmatrix=None, qmatrix=None, cache=None):
             if pmatrix is None:
                 pmatrix = cls.pmatrix_ho
             if qmatrix is None:
                 qmatrix = cls.qmatrix_ho
-            return cls((pmatrix, qmatrix, qmatrix, pmatrix), n_quanta)
+            return cls((pmatrix, qmatrix, qmatrix, pmatrix), n_quanta, cache=cache)
 
     def get_state_indices(self, states):
+        """Converts states into indices into `self.basis`
+
+        :param states: a number of states, a slice, indices, quantum numbers, or another state space
+        :type states: int | slice | Iterable[int] | Iterable[Iterable[int]] | StateSpace
+        :return:
+        :rtype: np.ndarray | slice
+        """
+        if isinstance(states, StateSpace):
+            states = states.get_quantum_numbers()
         if isinstance(states, (int, np.integer)):
-            states = np.arange(min([np.prod(self.n_quanta), states]))
+            states = np.arange(min([len(self.basis), states]))
         if not isinstance(states, slice):
             if not isinstance(states[0], (int, np.integer)):
-                states = np.ravel_multi_index(np.array(states).T, self.n_quanta)
+                states = self.basis.get_indices(np.array(states))
             if isinstance(states, tuple):  # numpy is weird
                 states = np.array(states)
         return states
 
     def get_state_quantum_numbers(self, states):
         if isinstance(states, slice):
-            states = np.arange(np.prod(self.n_quanta))[states]
+            states = np.arange(len(self.basis))[states]
         elif isinstance(states, int):
-            states = np.arange(min([np.prod(self.n_quanta), states]))
-        qns = tuple(np.array(np.unravel_index(states, self.n_quanta)).T)
+            states = np.arange(min([len(self.basis), states]))
+        qns = tuple(self.basis.get_quantum_numbers(np.asarray(states, dtype=int)))
         return qns
 
-    def _get_corrections(self, states=15, coupled_states=None, coeff_threshold=None, energy_threshold=None):
-        if states is None:
-            states = np.prod(self.n_quanta)
+    def get_selection_rule_displacements(self, order=3):
+        """Returns every change in quantum numbers that a product of `order` operators linear in the ladder operators
+        can produce, i.e. all integer vectors with |dn| <= order and the same parity as order
+
+        :param order: the order of the operator (or a set of orders)
+        :type order: int | Iterable[int]
+        :return:
+        :rtype: np.ndarray
+        """
+        if isinstance(order, (int, np.integer)):
+            order = (order,)
+        order = tuple(sorted(set(order)))
+        if order in self._displacement_cache:
+            return self._displacement_cache[order]
+        ndim = self.mode_n
+        units = np.concatenate([np.eye(ndim, dtype=int), -np.eye(ndim, dtype=int)])
+        disps = []
+        for o in order:
+            for t in range(o % 2, o + 1, 2):
+                if t == 0:
+                    disps.append(np.zeros((1, ndim), dtype=int))
+                    continue
+                combs = np.array(list(ip.combinations_with_replacement(range(2*ndim), t)), dtype=int)
+                d = np.sum(units[combs], axis=1)
+                disps.append(d[np.sum(np.abs(d), axis=1) == t]) # drop the ones where steps cancel
+        disps = np.unique(np.concatenate(disps), axis=0)
+        self._displacement_cache[order] = disps
+        return disps
+
+    def get_coupled_states(self, states, order=3, return_pairs=False, chunk_size=100):
+        """Uses the harmonic oscillator selection rules to find the states that can be coupled to `states`
+        through an operator of the given order (3 for H1, 4 for H2)
+
+        :param states: the states to couple from
+        :type states: int | Iterable[int] | Iterable[Iterable[int]]
+        :param order: the order of the operator (or a set of orders)
+        :type order: int | Iterable[int]
+        :param return_pairs: whether to also return the (state position, coupled state index) pairs
+        :type return_pairs: bool
+        :param chunk_size: the number of states to process at once
+        :type chunk_size: int
+        :return:
+        :rtype: np.ndarray | tuple
+        """
         states = self.get_state_indices(states)
-        if coupled_states is None:
-            coupled_states = slice(None, None, None)
-        if isinstance(coupled_states, slice):
-            coupled_states = np.arange(np.prod(self.n_quanta))
-        coupled_states = self.get_state_indices(coupled_states)
+        qns = np.array(self.get_state_quantum_numbers(states))
+        disps = self.get_selection_rule_displacements(order)
+        rows = []
+        cols = []
+        for i in range(0, len(qns), chunk_size):
+            new = qns[i:i+chunk_size, np.newaxis, :] + disps[np.newaxis, :, :]
+            inds = self.basis.get_indices(new, missing=-1)
+            w = np.where(inds >= 0)
+            rows.append(i + w[0])
+            cols.append(inds[w])
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        coupled = np.unique(cols)
+        if return_pairs:
+            return coupled, (rows, cols)
+        else:
+            return coupled
 
+    def _get_corrections(self, states=15, coupled_states=None, coeff_threshold=None, energy_threshold=None,
+                         memory_budget=None, return_coeffs=True, resonance_threshold=None):
+        if states is None:
+            states = len(self.basis)
+        states = self.get_state_indices(states)
+        opts = dict(
+            coeff_threshold=coeff_threshold,
+            energy_threshold=energy_threshold,
+            memory_budget=memory_budget,
+            return_coeffs=return_coeffs,
+            resonance_threshold=resonance_threshold
+        )
+        if self.profiler is None:
+            return self._compute_corrections(states, coupled_states, **opts)
+        return self.profiler.profile("_get_corrections", self._compute_corrections, states, coupled_states,
+                                     sizes=dict(states=len(states)), **opts)
+    def _compute_corrections(self, states, coupled_states=None, coeff_threshold=None, energy_threshold=None,
+                             memory_budget=None, return_coeffs=True, resonance_threshold=None):
+        if memory_budget is not None:
+            return self._get_chunked_corrections(states, coupled_states,
+                                                 coeff_threshold=coeff_threshold,
+                                                 energy_threshold=energy_threshold,
+                                                 memory_budget=memory_budget,
+                                                 return_coeffs=return_coeffs,
+                                                 resonance_threshold=resonance_threshold
+                                                 )
         H0 = self.H0
         H1 = self.H1
         H2 = self.H2
 
-        energies = H0.diag
-        state_E = energies[states]
-        energies = energies[coupled_states]
-        if isinstance(coupled_states, slice):
-            H1_blocks = H1[states, coupled_states]
+        if isinstance(coupled_states, str) and coupled_states == 'auto':
+            # only the elements allowed by the selection rules on H1 are ever computed
+            coupled_states, (rows, cols) = self.get_coupled_states(states, order=3, return_pairs=True)
+            def pull_H1():
+                H1_blocks = np.zeros((len(states), len(coupled_states)))
+                H1_blocks[rows, np.searchsorted(coupled_states, cols)] = _densify(H1[states[rows], cols])
+                return H1_blocks
+        else:
+            if coupled_states is None:
+                coupled_states = slice(None, None, None)
+            if isinstance(coupled_states, slice):
+                coupled_states = np.arange(len(self.basis))
+            coupled_states = self.get_state_indices(coupled_states)
+            pull_H1 = lambda: _densify(H1[np.ix_(states, coupled_states)])
+
+        # the blocks are independent, so with an executor they're evaluated alongside each other
+        blocks = (
+            pull_H1,
+            lambda: _densify(H0[states, states]),
+            lambda: _densify(H0[coupled_states, coupled_states]),
+            lambda: H2[states, states]
+        )
+        if self.executor is None:
+            H1_blocks, state_E, energies, e2s = [f() for f in blocks]
         else:
-            ixes = np.ix_(states, coupled_states)
-            H1_blocks = H1[ixes]
+            H1_blocks, state_E, energies, e2s = self.executor.run_all(blocks)
 
         e_blocks = state_E[:, np.newaxis] - np.broadcast_to(energies[np.newaxis], (len(states), len(energies)))
 
@@ -998,13 +2485,22 @@ class PerturbationTheoryHamiltonian:
             if len(w) > 0:
                 e_blocks[n, w[0]] = 1 # gotta prevent blowups
 
+        resonances = None
+        if resonance_threshold is not None:
+            # screened off the same blocks (and before the denominators get thresholded)
+            r, c = np.nonzero(H1_blocks)
+            resonances = self._screen_resonances(
+                [(r, c, H1_blocks[r, c], e_blocks[r, c], states[r] == coupled_states[c])],
+                states, coupled_states, resonance_threshold
+            )
+
         if energy_threshold is not None:
             if isinstance(energy_threshold, (int, float, np.integer, np.floating)):
                 energy_threshold = (energy_threshold, 1)
             dropped = np.abs(e_blocks) < energy_threshold[0]
             e_blocks[dropped] = np.sign(e_blocks[dropped]) * energy_threshold[1]
 
-        coeffs = H1_blocks / e_blocks
+        coeffs = np.divide(H1_blocks, e_blocks, out=np.zeros(e_blocks.shape), where=H1_blocks != 0)
 
         if coeff_threshold is not None:
             if isinstance(coeff_threshold, (int, float, np.integer, np.floating)):
@@ -1020,11 +2516,158 @@ class PerturbationTheoryHamiltonian:
         e_co = np.expand_dims(coeffs, axis=1)
         e_H1 = np.expand_dims(H1_blocks, axis=2)
         e1 = np.matmul(e_co, e_H1).squeeze()
-        e2s = H2[states, states]
 
         # print(self._fmt_corr2_matrix(states, coupled_states, H1_blocks, coeffs))
 
-        return coeffs, (state_E , e1,  e2s), e_blocks, H1_blocks, states, coupled_states
+        return coeffs, (state_E , e1,  e2s), e_blocks, H1_blocks, states, coupled_states, resonances
+
+    def _screen_resonances(self, couplings, states, coupled_states, resonance_threshold):
+        """Runs the Martin test over the nonzero couplings of the correction pass
+
+        :param couplings: (row, column, H1 element, energy difference, self coupling) arrays for every block of
+        couplings that was evaluated
+        :type couplings: Iterable[tuple]
+        :param resonance_threshold: the Martin threshold, or the Martin and near-degeneracy thresholds,
+        by default 1 and 100 wavenumbers
+        :type resonance_threshold: bool | float | Iterable[float]
+        :return: the sparse (state, coupled state) Martin values and near-degeneracy flags,
+        and the (state, coupled state) pairs that fail the Martin test
+        :rtype: dict
+        """
+        h2w = UnitsData.convert("Hartrees", "Wavenumbers")
+        if resonance_threshold is True:
+            resonance_threshold = (1 / h2w, 100 / h2w)
+        elif isinstance(resonance_threshold, (int, float, np.integer, np.floating)):
+            resonance_threshold = (resonance_threshold, 100 / h2w)
+        martin_threshold, degeneracy_threshold = resonance_threshold
+
+        rows = []
+        cols = []
+        martin = []
+        near = []
+        for r, c, h, e, self_coupled in couplings:
+            keep = np.logical_and(h != 0, np.logical_not(self_coupled))
+            r, c, h, e = r[keep], c[keep], h[keep], e[keep]
+            rows.append(r)
+            cols.append(c)
+            martin.append(h**4 / e**3)
+            near.append(np.abs(e) < degeneracy_threshold)
+        if len(rows) > 0:
+            rows, cols, martin, near = (np.concatenate(x) for x in (rows, cols, martin, near))
+        else:
+            rows = cols = np.zeros(0, dtype=int)
+            martin = np.zeros(0)
+            near = np.zeros(0, dtype=bool)
+        shp = (len(states), len(coupled_states))
+        resonant = np.abs(martin) >= martin_threshold
+        return dict(
+            martin=sp.csr_matrix((martin, (rows, cols)), shape=shp),
+            near_degenerate=sp.csr_matrix((near[near], (rows[near], cols[near])), shape=shp, dtype=bool),
+            pairs=np.column_stack([states[rows[resonant]], coupled_states[cols[resonant]]])
+        )
+
+    def _pull_elements(self, H, n, m, chunk_size):
+        """Pulls the elements H[n[i], m[i]] a chunk at a time"""
+        if len(n) == 0:
+            return np.zeros((0,))
+        return np.concatenate([
+            _densify(H[n[i:i+chunk_size], m[i:i+chunk_size]]).reshape(-1) for i in range(0, len(n), chunk_size)
+        ])
+    def _get_chunked_corrections(self, states, coupled_states=None, coeff_threshold=None, energy_threshold=None,
+                                 memory_budget=2**30, return_coeffs=True, resonance_threshold=None):
+        """Computes the same corrections as the dense path of `_get_corrections`, but evaluates H1, the energy
+        denominators, and the second-order sums in tiles of (state, coupled state) pairs sized to fit in
+        `memory_budget` bytes, accumulating the energies as it goes
+
+        :param states: the indices of the states to correct
+        :type states: np.ndarray
+        :param coupled_states: the states to couple to (see `get_corrections`)
+        :type coupled_states: None | str | Iterable[int]
+        :param memory_budget: the approximate number of bytes a tile is allowed to use
+        :type memory_budget: int
+        :param return_coeffs: whether to collect the nonzero coefficients and H1 elements as sparse matrices
+        :type return_coeffs: bool
+        :param resonance_threshold: if given, the resonances are screened for tile by tile (see `get_corrections`)
+        :type resonance_threshold: None | bool | float | Iterable[float]
+        :return: the sparse coefficients (or None), the corrections, None in place of the energy denominators,
+        the sparse H1 block (or None), the states, the coupled states, and the resonances (or None)
+        :rtype: tuple
+        """
+        H0 = self.H0
+        H1 = self.H1
+        H2 = self.H2
+
+        nstates = len(states)
+        chunk = _get_chunk_size(memory_budget, self.mode_n)
+        if isinstance(coupled_states, str) and coupled_states == 'auto':
+            coupled_states, (rows, cols) = self.get_coupled_states(states, order=3, return_pairs=True)
+            cols = np.searchsorted(coupled_states, cols)
+            tiles = ((rows[i:i+chunk], cols[i:i+chunk]) for i in range(0, len(rows), chunk))
+        else:
+            if coupled_states is None or isinstance(coupled_states, slice):
+                coupled_states = np.arange(len(self.basis))[coupled_states if coupled_states is not None else slice(None)]
+            coupled_states = self.get_state_indices(coupled_states)
+            ncoupled = len(coupled_states)
+            row_step = max(1, min(nstates, chunk // ncoupled))
+            col_step = max(1, min(ncoupled, chunk // row_step))
+            tiles = (
+                (np.repeat(np.arange(i, min(i+row_step, nstates)), min(j+col_step, ncoupled) - j),
+                 np.tile(np.arange(j, min(j+col_step, ncoupled)), min(i+row_step, nstates) - i))
+                for i in range(0, nstates, row_step) for j in range(0, ncoupled, col_step)
+            )
+        ncoupled = len(coupled_states)
+
+        state_E = self._pull_elements(H0, states, states, chunk)
+        energies = self._pull_elements(H0, coupled_states, coupled_states, chunk)
+
+        if energy_threshold is not None and isinstance(energy_threshold, (int, float, np.integer, np.floating)):
+            energy_threshold = (energy_threshold, 1)
+        if coeff_threshold is not None and isinstance(coeff_threshold, (int, float, np.integer, np.floating)):
+            coeff_threshold = (coeff_threshold, 0)
+
+        e1 = np.zeros(nstates)
+        kept = []
+        couplings = []
+        for r, c in tiles:
+            h = _densify(H1[states[r], coupled_states[c]]).reshape(-1)
+            e = state_E[r] - energies[c]
+            self_coupled = states[r] == coupled_states[c]
+            e[self_coupled] = 1 # gotta prevent blowups
+            if resonance_threshold is not None:
+                nz = h != 0
+                couplings.append((r[nz], c[nz], h[nz], e[nz], self_coupled[nz]))
+            if energy_threshold is not None:
+                dropped = np.abs(e) < energy_threshold[0]
+                e[dropped] = np.sign(e[dropped]) * energy_threshold[1]
+            co = np.divide(h, e, out=np.zeros(e.shape), where=h != 0)
+            if coeff_threshold is not None:
+                dropped = np.abs(co) > coeff_threshold[0]
+                co[dropped] = np.sign(co[dropped]) * coeff_threshold[1]
+            co[self_coupled] = 0 # we don't want to double count this
+            e1 += np.bincount(r, weights=co * h, minlength=nstates)
+            if return_coeffs:
+                nz = co != 0
+                kept.append((r[nz], c[nz], co[nz], h[nz]))
+
+        e2s = self._pull_elements(H2, states, states, chunk)
+
+        if return_coeffs:
+            if len(kept) > 0:
+                r, c, co, h = (np.concatenate(x) for x in zip(*kept))
+            else:
+                r = c = np.array([], dtype=int)
+                co = h = np.array([])
+            coeffs = sp.csr_matrix((co, (r, c)), shape=(nstates, ncoupled))
+            H1_blocks = sp.csr_matrix((h, (r, c)), shape=(nstates, ncoupled))
+        else:
+            coeffs = None
+            H1_blocks = None
+
+        if resonance_threshold is not None:
+            resonances = self._screen_resonances(couplings, states, coupled_states, resonance_threshold)
+        else:
+            resonances = None
+        return coeffs, (state_E, e1, e2s), None, H1_blocks, states, coupled_states, resonances
 
     def _fmt_corr_matrix(self, states, coupled_states, H1_blocks, coeffs):
         """A useful debug function"""
@@ -1050,19 +2693,224 @@ class PerturbationTheoryHamiltonian:
                 ]
         )
 
-    def get_corrections(self, states=15, coupled_states=None, coeff_threshold=None, energy_threshold=None):
+    def get_corrections(self, states=15, coupled_states=None, coeff_threshold=None, energy_threshold=None,
+                        memory_budget=None, return_coeffs=True, resonance_threshold=None, return_resonances=False,
+                        return_coupled_states=False):
         """
 
         :param states:
         :type states:
+        :param coupled_states: the states to couple to, `'auto'` uses the selection rules on H1 to only pull the
+        states (and elements) that can actually be coupled to `states`, `None` uses the full direct product basis
+        :type coupled_states: None | str | Iterable[int]
         :param coeff_threshold: a hack for ditching near degeneracies
         :type coeff_threshold: float | Iterable[float]
-        :return:
-        :rtype:
+        :param memory_budget: if given, H1 and the second-order sums are evaluated in tiles that fit in roughly this
+        many bytes and the coefficients come back as a sparse matrix
+        :type memory_budget: int | None
+        :param return_coeffs: whether to collect the coefficients in the tiled mode
+        :type return_coeffs: bool
+        :param resonance_threshold: the thresholds to screen for resonances with, which takes either `True`
+        (1 wavenumber), a Martin threshold, or a Martin threshold and a near-degeneracy threshold (100 wavenumbers by
+        default) in Hartrees
+        :type resonance_threshold: None | bool | float | Iterable[float]
+        :param return_resonances: whether to also run the couplings through the Martin test as the coefficients are
+        built and return the results
+        :type return_resonances: bool
+        :param return_coupled_states: whether to also return the indices of the coupled states, which label the
+        columns of the coefficients (and, with `'auto'`, are only the states the selection rules allow)
+        :type return_coupled_states: bool
+        :return: the coefficients and corrections, then with `return_coupled_states` the coupled state indices, and
+        with `return_resonances` a dict of the sparse Martin values (`'martin'`), the sparse near-degeneracy flags
+        (`'near_degenerate'`) and the (state, coupled state) pairs that fail the Martin test (`'pairs'`)
+        :rtype: tuple
         """
 
-        return self._get_corrections(states=states, coupled_states=coupled_states,
-                                     coeff_threshold=coeff_threshold, energy_threshold=energy_threshold)[:2]
+        if not return_resonances:
+            if resonance_threshold is not None:
+                raise PerturbationTheoryException("{0}.{1}: a resonance_threshold needs return_resonances".format(
+                    type(self).__name__, "get_corrections"
+                ))
+        elif resonance_threshold is None:
+            resonance_threshold = True
+        res = self._get_corrections(states=states, coupled_states=coupled_states,
+                                    coeff_threshold=coeff_threshold, energy_threshold=energy_threshold,
+                                    memory_budget=memory_budget, return_coeffs=return_coeffs,
+                                    resonance_threshold=resonance_threshold)
+        coeffs, corrs, _, _, _, coupled_states, resonances = res
+        ret = (coeffs, corrs)
+        if return_coupled_states:
+            ret += (coupled_states,)
+        if return_resonances:
+            ret += (resonances,)
+        return ret
+
+    def get_higher_order_corrections(self, states=15, order=4, energy_threshold=None, memory_budget=None):
+        """Carries Rayleigh-Schrodinger perturbation theory (with H1 as the first-order and H2 as the second-order
+        perturbation) past second order. The wavefunction corrections are built up by applying sparse H1 and H2
+        matrices, which only hold the elements allowed by the selection rules, to the previous corrections, so the
+        cost grows with the number of states reachable from `states` rather than with the size of the basis
+
+        :param states: the states to correct
+        :type states: int | Iterable[int] | Iterable[Iterable[int]]
+        :param order: the highest order of energy correction to compute, which needs the wavefunction corrections
+        through `order - 1` (so the space grows with every order)
+        :type order: int
+        :param energy_threshold: like in `get_corrections`, energy differences smaller than the first element are
+        replaced by the second (couplings between exactly degenerate states are always dropped)
+        :type energy_threshold: float | Iterable[float] | None
+        :param memory_budget: if given, the matrix elements are pulled in chunks that fit in roughly this many bytes
+        :type memory_budget: int | None
+        :return: the energy corrections for orders 0 through `order`, the (state, coupled state) coefficient
+        matrices for orders 1 through `order - 1`, and the indices of the coupled states
+        :rtype: (list[np.ndarray], list[sp.csr_matrix], np.ndarray)
+        """
+        if order < 2:
+            raise PerturbationTheoryException("{0}.{1}: use get_corrections for orders below 2".format(
+                type(self).__name__, "get_higher_order_corrections"
+            ))
+        states = self.get_state_indices(states)
+        if isinstance(states, slice):
+            states = np.arange(len(self.basis))[states]
+        states = np.asarray(states)
+        opts = dict(energy_threshold=energy_threshold, memory_budget=memory_budget)
+        if self.profiler is None:
+            return self._compute_higher_order_corrections(states, order, **opts)
+        return self.profiler.profile("_get_higher_order_corrections", self._compute_higher_order_corrections,
+                                     states, order, sizes=dict(states=len(states), order=order), **opts)
+    def _get_coupled_space(self, states, depth):
+        """Grows the space coupled to `states` by H1 or H2 `depth` times, keeping earlier states first
+
+        :return: the indices of the states, and the number that came from each step
+        :rtype: (np.ndarray, list[int])
+        """
+        space = np.asarray(states)
+        sizes = [len(space)]
+        for _ in range(depth):
+            new = np.setdiff1d(self.get_coupled_states(space, order=(3, 4)), space)
+            space = np.concatenate([space, new])
+            sizes.append(len(space))
+        return space, sizes
+    def _get_sparse_couplings(self, H, order, space, n_sources, memory_budget=None):
+        """Builds the (symmetric) sparse matrix of H over `space`, with every column belonging to one of the first
+        `n_sources` states filled in, using the selection rules to only pull the elements that can be nonzero
+
+        :return:
+        :rtype: sp.csc_matrix
+        """
+        n = len(space)
+        sort = np.argsort(space)
+        sources, (pos, cols) = self.get_coupled_states(space[:n_sources], order=order, return_pairs=True)
+        rows = sort[np.searchsorted(space, cols, sorter=sort)]
+        # pairs between two sources would be pulled twice, so only half of them are kept and then mirrored
+        keep = rows >= pos
+        rows, pos = rows[keep], pos[keep]
+        if len(rows) == 0:
+            return sp.csc_matrix((n, n))
+        chunk_size = len(rows) if memory_budget is None else _get_chunk_size(memory_budget, self.mode_n)
+        vals = self._pull_elements(H, space[rows], space[pos], chunk_size)
+        nz = vals != 0
+        rows, pos, vals = rows[nz], pos[nz], vals[nz]
+        mirror = np.logical_and(rows < n_sources, rows != pos)
+        return sp.csc_matrix(
+            (
+                np.concatenate([vals, vals[mirror]]),
+                (np.concatenate([rows, pos[mirror]]), np.concatenate([pos, rows[mirror]]))
+            ),
+            shape=(n, n)
+        )
+    def _compute_higher_order_corrections(self, states, order, energy_threshold=None, memory_budget=None):
+        ns = len(states)
+        # psi_k needs H applied to psi_(k-1), so the space has to reach order - 1 steps out from the states
+        # while the matrices only need the columns of the states reached in order - 2 steps
+        space, sizes = self._get_coupled_space(states, order - 1)
+        n_sources = sizes[-2]
+        V = {
+            1: self._get_sparse_couplings(self.H1, 3, space, n_sources, memory_budget=memory_budget),
+            2: self._get_sparse_couplings(self.H2, 4, space, n_sources, memory_budget=memory_budget)
+        }
+        chunk_size = len(space) if memory_budget is None else _get_chunk_size(memory_budget, self.mode_n)
+        E0 = self._pull_elements(self.H0, space, space, chunk_size)
+        own = np.arange(ns)
+
+        diffs = E0[:, np.newaxis] - E0[np.newaxis, :ns]
+        diffs[own, own] = 0
+        if energy_threshold is not None:
+            if isinstance(energy_threshold, (int, float, np.integer, np.floating)):
+                energy_threshold = (energy_threshold, 1)
+            dropped = np.logical_and(np.abs(diffs) < energy_threshold[0], diffs != 0)
+            diffs[dropped] = np.sign(diffs[dropped]) * energy_threshold[1]
+
+        psi = [np.zeros((len(space), ns))]
+        psi[0][own, own] = 1
+        corrs = [E0[:ns]]
+        for k in range(1, order + 1):
+            # <n|V|psi> only needs the columns of V belonging to the states, which are always filled in
+            corrs.append(sum(
+                np.einsum('ms,ms->s', psi[k-j], V[j][:, :ns].toarray()) for j in (1, 2) if k >= j
+            ))
+            if k == order:
+                break
+            rhs = sum(corrs[j][np.newaxis, :] * psi[k-j] for j in range(1, k + 1))
+            rhs = rhs - sum(V[j].dot(psi[k-j]) for j in (1, 2) if k >= j)
+            # intermediate normalization, so psi_k has no overlap with the unperturbed state
+            psi.append(np.divide(rhs, diffs, out=np.zeros(rhs.shape), where=diffs != 0))
+
+        coeffs = [sp.csr_matrix(p.T) for p in psi[1:]]
+        return corrs, coeffs, space
+
+    def get_converged_energies(self, states, tolerance=1e-6, step=1, max_quanta=None, method='corrections', **opts):
+        """Extends the basis `step` quanta at a time until none of the energies of `states` change by more than
+        `tolerance`. Element caching is turned on (if it wasn't already) so that every extension only pays for
+        the elements involving the new states, and the basis and element cache are put back once it's done
+
+        :param states: the states to converge, which are tracked by their quantum numbers as the basis grows
+        :type states: int | Iterable[int] | Iterable[Iterable[int]]
+        :param tolerance: the largest change in energy (in Hartrees) that counts as converged
+        :type tolerance: float
+        :param step: the number of quanta to add to every mode at each extension
+        :type step: int
+        :param max_quanta: the most quanta a mode can be given before giving up, by default 5 extensions are tried
+        :type max_quanta: int | None
+        :param method: `'corrections'` to converge the VPT2 energies, `'variational'` for the variational ones
+        :type method: str
+        :param opts: the options for `get_corrections` or `get_variational_wavefunctions`
+        :return: the converged energies and the (n_quanta, energies) at every step
+        :rtype: (np.ndarray, list)
+        """
+        if method == 'corrections':
+            opts.setdefault('coupled_states', 'auto')
+            get_energies = lambda s: sum(self.get_corrections(s, **opts)[1])
+        elif method == 'variational':
+            get_energies = lambda s: self.get_variational_wavefunctions(s, **opts).energies
+        else:
+            raise PerturbationTheoryException("{0}.{1}: unknown method '{2}'".format(
+                type(self).__name__, "get_converged_energies", method
+            ))
+        if max_quanta is None:
+            max_quanta = max(self.n_quanta) + 5 * step
+        states = self.get_state_indices(states)
+        if isinstance(states, slice):
+            states = np.arange(len(self.basis))[states]
+        qns = np.array(self.get_state_quantum_numbers(states))
+
+        basis, n_quanta, element_cache = self.basis, self.n_quanta, self.element_cache
+        if element_cache is None:
+            self.element_cache = self.ElementCache()
+        try:
+            history = [(self.n_quanta, np.asarray(get_energies(self.get_state_indices(qns))))]
+            while max(self.n_quanta) + step <= max_quanta:
+                self.extend_basis(self._get_extended_basis(step))
+                history.append((self.n_quanta, np.asarray(get_energies(self.get_state_indices(qns)))))
+                if np.max(np.abs(history[-1][1] - history[-2][1])) < tolerance:
+                    return history[-1][1], history
+            raise PerturbationTheoryException("{0}.{1}: energies still changed by {2} at n_quanta {3}".format(
+                type(self).__name__, "get_converged_energies",
+                np.max(np.abs(history[-1][1] - history[-2][1])) if len(history) > 1 else None,
+                self.n_quanta
+            ))
+        finally:
+            self.basis, self.n_quanta, self.element_cache = basis, n_quanta, element_cache
 
     def get_wavefunctions(self, states=15, coupled_states=None, coeff_threshold=None, energy_threshold=None):
             """Computes perturbation expansion of the wavefunctions and energies
@@ -1072,50 +2920,221 @@ class PerturbationTheoryHamiltonian:
             :return: coeffs
             :rtype: np.ndarray
             """
+            from .Wavefunctions import PerturbationTheoryWavefunctions
 
-            coeffs, corrs, e_blocks, H1_blocks, states, coupled_states = self._get_corrections(
+            coeffs, corrs, e_blocks, H1_blocks, states, coupled_states, _ = self._get_corrections(
                 states, coeff_threshold=coeff_threshold, coupled_states=coupled_states
             )
             energies = sum(corrs)
 
-            # basis = np.array(np.unravel_index(np.arange(num_ens), self.n_quanta)).T
-
+            # the coefficients run over the coupled states, so those are the basis
             return PerturbationTheoryWavefunctions(
-                None, # need to get the basis back int, but using the coupled_states args
-                # (UnitsData.convert("AtomicUnitOfEnergy", "Wavenumbers")*energies, basis),
+                np.array(self.get_state_quantum_numbers(coupled_states)),
                 energies,
                 coeffs,
                 self
             )
 
-    def martin_test(self, states=15, coupled_states=None):
-        """Applies the Martin Test to all of the specified states and returns the resulting correlation matrix
+    def get_sparse_hamiltonian(self, basis, memory_budget=None):
+        """Assembles H0 + H1 + H2 over `basis` as a sparse matrix, only pulling the elements allowed by the
+        selection rules (and only the upper triangle, since the Hamiltonian is symmetric)
 
-        :param states:
-        :type states:
-        :return:
-        :rtype:
+        :param basis: the states to use as the basis
+        :type basis: int | Iterable[int] | Iterable[Iterable[int]]
+        :param memory_budget: if given, the elements are pulled in chunks that fit in roughly this many bytes
+        :type memory_budget: int | None
+        :return: the Hamiltonian, with rows and columns in the order of the sorted basis
+        :rtype: sp.csr_matrix
         """
+        basis = np.unique(self.get_state_indices(basis))
+        return sum(H.to_sparse(basis, memory_budget=memory_budget) for H in (self.H0, self.H1, self.H2)).tocsr()
+
+    def get_variational_wavefunctions(self, states=15, basis=None, order=(3, 4), k=None, memory_budget=None,
+                                      tol=0, dense_cutoff=500):
+        """Diagonalizes H0 + H1 + H2 in a selection-rule-pruned basis with a sparse eigensolver, which
+        is safe against the resonances that blow up the perturbative corrections
+
+        :param states: the states to target, which are always included in the basis
+        :type states: int | Iterable[int] | Iterable[Iterable[int]]
+        :param basis: the basis to use, by default `states` and everything coupled to them through `order`
+        :type basis: None | Iterable[int] | Iterable[Iterable[int]]
+        :param order: the operator order(s) used to build the default basis, (3, 4) covers H1 and H2
+        :type order: int | Iterable[int]
+        :param k: the number of (lowest) eigenpairs to find, defaults to the number of target states
+        :type k: int | None
+        :param memory_budget: see `get_sparse_hamiltonian`
+        :type memory_budget: int | None
+        :param tol: the eigensolver tolerance (0 means machine precision)
+        :type tol: float
+        :param dense_cutoff: bases at least this small are just diagonalized densely
+        :type dense_cutoff: int
+        :return: the wavefunctions, with the coefficients running over the basis
+        :rtype: PerturbationTheoryWavefunctions
+        """
+        from scipy.sparse.linalg import eigsh
+        from .Wavefunctions import PerturbationTheoryWavefunctions
+
         states = self.get_state_indices(states)
-        if coupled_states is None:
-            coupled_states = states#slice(None, None, None)
+        if isinstance(states, slice):
+            states = np.arange(len(self.basis))[states]
+        if basis is None:
+            basis = np.union1d(states, self.get_coupled_states(states, order=order))
+        basis = np.unique(self.get_state_indices(basis))
+        if k is None:
+            k = len(states)
+        k = min(k, len(basis))
+
+        H = self.get_sparse_hamiltonian(basis, memory_budget=memory_budget)
+        if len(basis) <= dense_cutoff or k >= len(basis) - 1:
+            energies, vecs = np.linalg.eigh(H.toarray())
+            energies, vecs = energies[:k], vecs[:, :k]
         else:
-            coupled_states = self.get_state_indices(states)
-        if isinstance(coupled_states, slice):
-            H1_blocks = self.H1[states, coupled_states]
+            energies, vecs = eigsh(H, k=k, which='SA', tol=tol)
+            order = np.argsort(energies)
+            energies, vecs = energies[order], vecs[:, order]
+
+        return PerturbationTheoryWavefunctions(
+            np.array(self.get_state_quantum_numbers(basis)),
+            energies,
+            vecs.T,
+            self
+        )
+
+    def _get_analytic_force_constants(self):
+        """Pulls the harmonic frequencies, the cubic force constants and the iijj quartic force constants,
+        checking that the Hamiltonian is one the analytic VPT2 expressions actually apply to
+
+        :return:
+        :rtype: tuple
+        """
+        G, GQ, GQQ = self.G_terms.packed_terms
+        F, V3, V4 = self.V_terms.packed_terms
+        for g in (GQ, GQQ):
+            if isinstance(g, SymmetricTensor):
+                g = g.values
+            if not isinstance(g, int) and not np.allclose(_densify(g), 0):
+                raise PerturbationTheoryException(
+                    "{0}.{1}: the analytic expressions don't include the G-matrix derivatives, use get_corrections".format(
+                        type(self).__name__,
+                        "get_anharmonic_constants"
+                    )
+                )
+        G = _densify(G)
+        F = _densify(F)
+        freqs = np.diag(F)
+        if not (np.allclose(F, np.diag(freqs)) and np.allclose(G, np.diag(freqs))):
+            raise PerturbationTheoryException(
+                "{0}.{1}: the analytic expressions need a diagonal harmonic Hamiltonian in dimensionless normal modes".format(
+                    type(self).__name__,
+                    "get_anharmonic_constants"
+                )
+            )
+        n = self.mode_n
+        if isinstance(V3, int):
+            V3 = np.zeros((n,) * 3)
+        elif isinstance(V3, SymmetricTensor):
+            V3 = V3.toarray()
+        V3 = _densify(V3)
+        if isinstance(V4, int):
+            V4_iijj = np.zeros((n, n))
         else:
-            H1_blocks = self.H1[np.ix_(states, coupled_states)]
+            i, j = np.indices((n, n))
+            V4_iijj = _densify(V4[i, i, j, j]) if isinstance(V4, SymmetricTensor) else _densify(V4)[i, i, j, j]
+        return freqs, V3, V4_iijj
 
-        energies = self.H0.diag
-        state_energies = energies[states]
-        coupled_energies = energies[coupled_states]
-        diffs = state_energies[:, np.newaxis] - coupled_energies[np.newaxis, :]
-        for n,s in enumerate(states):
-            w = np.where(coupled_states==s)[0]
-            if len(w) > 0:
-                diffs[n, w[0]] = 1
+    def get_anharmonic_constants(self):
+        """Computes the VPT2 anharmonicity constants x_ij and the constant energy shift e0 in closed form from the
+        harmonic frequencies and the cubic and quartic force constants, so that for any state n
+
+            E(n) = sum_i w_i (n_i + 1/2) + sum_{i<=j} x_ij (n_i + 1/2)(n_j + 1/2) + e0
+
+        This costs O(N^3) and needs no matrix elements, but only applies to Cartesian normal mode runs
+        (no G-matrix derivatives) and, like `get_corrections`, isn't corrected for resonances
 
-        return (H1_blocks**4)/(diffs**3)
+        :return: the (symmetric) anharmonicity constants and the constant shift
+        :rtype: (np.ndarray, float)
+        """
+        if self._anharmonic_constants is None:
+            w, f3, f4 = self._get_analytic_force_constants()
+            n = len(w)
+            wi = w[:, np.newaxis, np.newaxis]
+            wj = w[np.newaxis, :, np.newaxis]
+            wk = w[np.newaxis, np.newaxis, :]
+            delta = wi**4 + wj**4 + wk**4 - 2*(wi**2*wj**2 + wi**2*wk**2 + wj**2*wk**2)
+            f3_iik = np.einsum('iik->ik', f3)
+            f3_iii = np.diag(f3_iik)
+
+            x = (
+                    f4 / 4
+                    - np.einsum('ik,jk,k->ij', f3_iik, f3_iik, 1 / w) / 4
+                    - np.sum(f3**2 * wk * (wk**2 - wi**2 - wj**2) / (2 * delta), axis=2)
+            )
+            w_i = w[:, np.newaxis]
+            w_k = w[np.newaxis, :]
+            x[np.diag_indices(n)] = (
+                    np.diag(f4) / 16
+                    - np.sum(f3_iik**2 * (8*w_i**2 - 3*w_k**2) / (16 * w_k * (4*w_i**2 - w_k**2)), axis=1)
+            )
+
+            off = np.logical_not(np.eye(n, dtype=bool))
+            i, j, k = np.array(list(ip.combinations(range(n), 3)), dtype=int).reshape(-1, 3).T
+            e0 = (
+                    np.sum(np.diag(f4)) / 64
+                    - 7 / 576 * np.sum(f3_iii**2 / w)
+                    + 3 / 64 * np.sum((f3_iik**2 * w_k / (4*w_i**2 - w_k**2))[off])
+                    - 1 / 4 * np.sum(f3[i, j, k]**2 * w[i] * w[j] * w[k] / delta[i, j, k])
+            )
+            self._anharmonic_constants = (w, x, e0)
+        return self._anharmonic_constants[1:]
+
+    def get_analytic_energies(self, states=15):
+        """Evaluates the VPT2 energies of the states from the anharmonicity constants, which makes fundamentals,
+        overtones and combination bands essentially free
+
+        :param states: the states as indices into the basis or as quantum numbers (which needn't fit in `n_quanta`)
+        :type states: int | Iterable[int] | Iterable[Iterable[int]]
+        :return:
+        :rtype: np.ndarray
+        """
+        if isinstance(states, (int, np.integer, slice)):
+            states = self.get_state_indices(states)
+        states = np.asarray(states)
+        if states.ndim == 1:
+            states = np.array(self.get_state_quantum_numbers(states))
+        qns = states.reshape((-1, self.mode_n)) + 1/2
+        x, e0 = self.get_anharmonic_constants()
+        freqs = self._anharmonic_constants[0]
+        return np.dot(qns, freqs) + np.einsum('si,ij,sj->s', qns, np.triu(x), qns) + e0
+
+    def get_analytic_frequencies(self, states=15):
+        """Like `get_analytic_energies`, but relative to the VPT2 ground state energy
+
+        :param states:
+        :type states: int | Iterable[int] | Iterable[Iterable[int]]
+        :return:
+        :rtype: np.ndarray
+        """
+        return self.get_analytic_energies(states) - self.get_analytic_energies([(0,) * self.mode_n])[0]
+
+    def martin_test(self, states=15, coupled_states=None, resonance_threshold=True):
+        """Applies the Martin Test to all of the specified states and returns the resulting correlation matrix,
+        which comes out of the same pass over H1 that `get_corrections` makes
+
+        :param states:
+        :type states:
+        :param coupled_states: the states to test the couplings to, by default `states` itself
+        :type coupled_states: None | str | Iterable[int] | Iterable[Iterable[int]]
+        :param resonance_threshold: the thresholds to screen with (see `get_corrections`)
+        :type resonance_threshold: bool | float | Iterable[float]
+        :return: the sparse Martin values of the (state, coupled state) couplings
+        :rtype: sp.csr_matrix
+        """
+        states = self.get_state_indices(states)
+        if coupled_states is None:
+            coupled_states = states
+        _, _, resonances = self.get_corrections(states, coupled_states=coupled_states, return_coeffs=False,
+                                                resonance_threshold=resonance_threshold, return_resonances=True)
+        return resonances['martin']
 
 
 
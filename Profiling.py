@@ -0,0 +1,161 @@
+"""
+Provides lightweight instrumentation for the stages of a VPT run (parsing, the expansion terms, the operator
+element pulls, the corrections) so that slow jobs can be attributed to the stage they're spending their time in
+"""
+
+import time, collections, threading, numpy as np
+
+__all__ = [
+    'Profiler',
+    'ProfilerEvent'
+]
+
+ProfilerEvent = collections.namedtuple("ProfilerEvent", ["name", "phase", "time", "sizes"])
+ProfilerEvent.__doc__ = """
+A single instrumentation event, `phase` is either "start" or "end" and `time` is the elapsed wall time
+(zero for "start" events)
+"""
+
+class Profiler:
+    """
+    Accumulates wall times, call counts and array sizes per stage and optionally forwards every
+    stage start/end to a callback (e.g. for logging where a running job currently is).
+    Nothing is recorded unless a profiler is attached, so the disabled path costs a single `None` check.
+    """
+    def __init__(self, callback=None, keep_events=False):
+        """
+        :param callback: called with a `ProfilerEvent` whenever a stage starts or ends
+        :type callback: callable | None
+        :param keep_events: whether to hold on to every "end" event (in order) in addition to the summaries
+        :type keep_events: bool
+        """
+        self.callback = callback
+        self.keep_events = keep_events
+        self._lock = threading.Lock()
+        self.reset()
+    def reset(self):
+        """Clears everything recorded so far"""
+        self.stats = collections.OrderedDict()
+        self.events = []
+
+    def start(self, name, **sizes):
+        """Marks the start of a stage
+
+        :param name:
+        :type name: str
+        :return: the start time to hand back to `stop`
+        :rtype: float
+        """
+        if self.callback is not None:
+            self.callback(ProfilerEvent(name, "start", 0., sizes))
+        return time.perf_counter()
+    def stop(self, name, start, result=None, **sizes):
+        """Marks the end of a stage and records it
+
+        :param name:
+        :type name: str
+        :param start: the value returned by `start`
+        :type start: float
+        :param result: if given, its size in bytes is recorded as `nbytes`
+        :type result:
+        :return: the result, so that calls can be wrapped inline
+        :rtype:
+        """
+        elapsed = time.perf_counter() - start
+        if result is not None:
+            sizes['nbytes'] = self.get_nbytes(result)
+        self.record(name, elapsed, **sizes)
+        return result
+    def record(self, name, elapsed, **sizes):
+        """Records a stage that took `elapsed` seconds
+
+        :param name:
+        :type name: str
+        :param elapsed:
+        :type elapsed: float
+        """
+        with self._lock: # stages can finish on several threads at once
+            if name not in self.stats:
+                self.stats[name] = dict(calls=0, time=0., max_time=0., sizes={})
+            s = self.stats[name]
+            s['calls'] += 1
+            s['time'] += elapsed
+            s['max_time'] = max(s['max_time'], elapsed)
+            for k, v in sizes.items():
+                # sizes are summed over calls, with the largest single call kept alongside
+                tot, big = s['sizes'].get(k, (0, 0))
+                s['sizes'][k] = (tot + v, max(big, v))
+            event = ProfilerEvent(name, "end", elapsed, sizes)
+            if self.keep_events:
+                self.events.append(event)
+        if self.callback is not None:
+            self.callback(event)
+
+    def profile(self, name, func, *args, sizes=None, **kwargs):
+        """Calls `func(*args, **kwargs)` as the stage `name`
+
+        :param name:
+        :type name: str
+        :param func:
+        :type func: callable
+        :param sizes: extra sizes to record for the call
+        :type sizes: dict | None
+        :return:
+        :rtype:
+        """
+        sizes = {} if sizes is None else sizes
+        start = self.start(name, **sizes)
+        return self.stop(name, start, func(*args, **kwargs), **sizes)
+
+    @classmethod
+    def get_nbytes(cls, obj):
+        """Roughly how much memory an array (or sparse array, packed tensor, or container of these) takes
+
+        :param obj:
+        :type obj:
+        :return:
+        :rtype: int
+        """
+        if isinstance(obj, np.ndarray):
+            return obj.nbytes
+        elif isinstance(obj, (tuple, list)):
+            return sum(cls.get_nbytes(o) for o in obj)
+        elif hasattr(obj, 'nbytes'):
+            return int(obj.nbytes)
+        elif hasattr(obj, 'data') and hasattr(obj, 'indices') and hasattr(obj, 'indptr'):
+            return obj.data.nbytes + obj.indices.nbytes + obj.indptr.nbytes
+        elif hasattr(obj, 'data') and isinstance(obj.data, np.ndarray):
+            return obj.data.nbytes
+        return 0
+
+    def report(self):
+        """A structured summary of every stage, in the order they were first seen
+
+        :return: a dict from stage name to its calls, total/mean/max time, and summed/max sizes
+        :rtype: dict
+        """
+        return collections.OrderedDict(
+            (name, dict(
+                calls=s['calls'],
+                time=s['time'],
+                mean_time=s['time'] / s['calls'],
+                max_time=s['max_time'],
+                sizes={k: dict(total=tot, max=big) for k, (tot, big) in s['sizes'].items()}
+            ))
+            for name, s in self.stats.items()
+        )
+    def format_report(self):
+        """Formats the report as a table
+
+        :return:
+        :rtype: str
+        """
+        lines = ["{:<48} {:>7} {:>11} {:>11} {:>14}".format("stage", "calls", "time (s)", "max (s)", "bytes")]
+        for name, s in self.report().items():
+            nbytes = s['sizes'].get('nbytes', {}).get('total', 0)
+            lines.append("{:<48} {:>7d} {:>11.4f} {:>11.4f} {:>14,d}".format(
+                name, s['calls'], s['time'], s['max_time'], nbytes
+            ))
+        return "\n".join(lines)
+    def __repr__(self):
+        return "{}({} stages)".format(type(self).__name__, len(self.stats))
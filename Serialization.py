@@ -0,0 +1,114 @@
+"""
+Provides a simple chunked binary container for sets of named arrays, which is what Hamiltonians and wavefunctions
+are saved as, so that the large arrays can be memory-mapped on load instead of being read into memory
+"""
+
+import os, json, struct, numpy as np
+
+__all__ = [
+    'ArrayContainer'
+]
+
+class ArrayContainer:
+    """
+    Writes a set of named arrays as aligned chunks of raw data followed by a JSON index of where each one lives (and
+    any extra metadata), so that reading an array is just a `np.memmap` at the recorded offset
+
+    The layout is the magic bytes, the format version, and the offset of the index, then the chunks, then the index
+    """
+    magic = b'PYVPTBIN'
+    version = 1
+    _prefix = struct.Struct('<8sIQ')
+
+    @classmethod
+    def write(cls, file, arrays, metadata=None, alignment=64):
+        """Writes the arrays (and metadata) to `file`, going through a temporary file so that readers never see
+        partial data
+
+        :param file: the file to write
+        :type file: str
+        :param arrays: the arrays to store, keyed by name
+        :type arrays: dict
+        :param metadata: anything JSON-serializable to store alongside the arrays
+        :type metadata: dict | None
+        :param alignment: the byte alignment of every chunk
+        :type alignment: int
+        """
+        tmp = file + ".{}.tmp".format(os.getpid())
+        index = {}
+        with open(tmp, 'wb') as f:
+            f.write(cls._prefix.pack(cls.magic, cls.version, 0))
+            for name, arr in arrays.items():
+                arr = np.asarray(arr)
+                if arr.dtype == object:
+                    raise ValueError("{}: can't store object array '{}'".format(cls.__name__, name))
+                f.write(b'\0' * (-f.tell() % alignment))
+                index[name] = dict(offset=f.tell(), dtype=arr.dtype.str, shape=list(arr.shape))
+                if arr.size > 0:
+                    # contiguous arrays (and memmaps) are streamed without a copy
+                    f.write(memoryview(np.ascontiguousarray(arr)).cast('B'))
+            index_offset = f.tell()
+            f.write(json.dumps(dict(arrays=index, metadata=metadata)).encode())
+            f.seek(0)
+            f.write(cls._prefix.pack(cls.magic, cls.version, index_offset))
+        os.replace(tmp, file)
+
+    @classmethod
+    def read_index(cls, file):
+        """Reads the index of the arrays in `file` and the metadata stored with them
+
+        :param file:
+        :type file: str
+        :return:
+        :rtype: dict
+        """
+        with open(file, 'rb') as f:
+            magic, version, index_offset = cls._prefix.unpack(f.read(cls._prefix.size))
+            if magic != cls.magic:
+                raise ValueError("{}: {} isn't an array container".format(cls.__name__, file))
+            if version > cls.version:
+                raise ValueError("{}: {} uses format version {} but only up to {} is understood".format(
+                    cls.__name__, file, version, cls.version
+                ))
+            f.seek(index_offset)
+            return json.loads(f.read().decode())
+
+    @classmethod
+    def read(cls, file, mmap=True, mmap_threshold=2**16):
+        """Reads the arrays and metadata stored in `file`
+
+        :param file:
+        :type file: str
+        :param mmap: whether to memory-map the arrays instead of reading them into memory
+        :type mmap: bool
+        :param mmap_threshold: arrays smaller than this many bytes are always just read
+        :type mmap_threshold: int
+        :return: the arrays and the metadata
+        :rtype: (dict, dict)
+        """
+        index = cls.read_index(file)
+        arrays = {}
+        with open(file, 'rb') as f:
+            for name, spec in index['arrays'].items():
+                dtype = np.dtype(spec['dtype'])
+                shape = tuple(spec['shape'])
+                size = int(np.prod(shape))
+                if size == 0:
+                    arrays[name] = np.zeros(shape, dtype=dtype)
+                elif mmap and size * dtype.itemsize >= mmap_threshold:
+                    arrays[name] = np.memmap(file, dtype=dtype, mode='r', offset=spec['offset'], shape=shape)
+                else:
+                    f.seek(spec['offset'])
+                    arrays[name] = np.fromfile(f, dtype=dtype, count=size).reshape(shape)
+        return arrays, index['metadata']
+
+    @staticmethod
+    def get_group(arrays, prefix):
+        """Pulls out the arrays stored under `prefix/`, with the prefix stripped"""
+        prefix = prefix + "/"
+        return {k[len(prefix):]: v for k, v in arrays.items() if k.startswith(prefix)}
+    @staticmethod
+    def add_group(arrays, prefix, group):
+        """Stores the arrays in `group` under `prefix/`"""
+        arrays.update({prefix + "/" + k: v for k, v in group.items()})
+        return arrays
@@ -0,0 +1,193 @@
+"""
+Provides representations of the harmonic oscillator basis the Hamiltonian is evaluated in, so that we're not tied
+to the full n_quanta^N direct product basis but can also work with truncated bases like the states with at most K
+total quanta (which is what actually couples through the low orders of perturbation theory)
+"""
+
+import numpy as np, itertools as ip
+
+__all__ = [
+    'StateSpace',
+    'DirectProductStateSpace',
+    'TruncatedStateSpace'
+]
+
+class StateSpace:
+    """
+    The interface for a set of harmonic oscillator states, mapping quantum numbers to compact indices and back
+    """
+    def __init__(self, n_quanta):
+        """
+        :param n_quanta: the (exclusive) upper bound on the quantum numbers of every mode
+        :type n_quanta: Iterable[int]
+        """
+        self.n_quanta = tuple(int(n) for n in n_quanta)
+
+    @property
+    def n_modes(self):
+        return len(self.n_quanta)
+    def __len__(self):
+        raise NotImplementedError("abstract base class")
+
+    def get_quantum_numbers(self, indices=None):
+        """Returns the quantum numbers of the states at the given indices
+
+        :param indices: the indices, all the states by default
+        :type indices: None | int | Iterable[int] | slice
+        :return: an array whose last axis runs over the modes
+        :rtype: np.ndarray
+        """
+        raise NotImplementedError("abstract base class")
+    def get_indices(self, quantum_numbers, missing=None):
+        """Returns the indices of the states with the given quantum numbers
+
+        :param quantum_numbers: an array whose last axis runs over the modes
+        :type quantum_numbers: Iterable[Iterable[int]]
+        :param missing: what to return for states that aren't in the space, by default a `ValueError` is raised
+        :type missing: None | int
+        :return:
+        :rtype: np.ndarray
+        """
+        raise NotImplementedError("abstract base class")
+
+    def ravel(self, quantum_numbers, missing=None):
+        """Like `np.ravel_multi_index`, takes one array of quantum numbers per mode"""
+        return self.get_indices(np.moveaxis(np.asarray(quantum_numbers), 0, -1), missing=missing)
+    def unravel(self, indices):
+        """Like `np.unravel_index`, gives back one array of quantum numbers per mode"""
+        return tuple(np.moveaxis(self.get_quantum_numbers(indices), -1, 0))
+
+    def to_data(self):
+        """Converts to a dict of arrays for storage
+
+        :return:
+        :rtype: dict
+        """
+        return dict(n_quanta=np.array(self.n_quanta))
+    @classmethod
+    def from_data(cls, data):
+        """Rebuilds a space stored with `to_data`, picking the type of space from what was stored"""
+        if 'states' in data:
+            return TruncatedStateSpace(data['states'], n_quanta=data['n_quanta'])
+        return DirectProductStateSpace(data['n_quanta'])
+
+    def _in_bounds(self, qns):
+        return np.all(np.logical_and(qns >= 0, qns < np.array(self.n_quanta)), axis=-1)
+    def _check_missing(self, found, missing, qns):
+        if missing is None and not np.all(found):
+            bad = np.asarray(qns)[np.logical_not(found)]
+            raise ValueError("{}: states {} aren't in the space".format(type(self).__name__, bad[:5].tolist()))
+
+class DirectProductStateSpace(StateSpace):
+    """
+    The full direct product basis, indexed the same way `np.ravel_multi_index` would
+    """
+    def __len__(self):
+        return int(np.prod(self.n_quanta))
+    def get_quantum_numbers(self, indices=None):
+        if indices is None:
+            indices = slice(None)
+        if isinstance(indices, slice):
+            indices = np.arange(len(self))[indices]
+        indices = np.asarray(indices, dtype=int)
+        return np.moveaxis(np.array(np.unravel_index(indices, self.n_quanta)), 0, -1)
+    def get_indices(self, quantum_numbers, missing=None):
+        qns = np.asarray(quantum_numbers, dtype=int)
+        found = self._in_bounds(qns)
+        self._check_missing(found, missing, qns)
+        inds = np.full(qns.shape[:-1], -1 if missing is None else missing, dtype=int)
+        inds[found] = np.ravel_multi_index(qns[found].T, self.n_quanta)
+        return inds
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, self.n_quanta)
+
+class TruncatedStateSpace(StateSpace):
+    """
+    An explicit set of states, e.g. all of the states with at most `max_quanta` total quanta, ordered by
+    total quanta (and then lexicographically) and indexed through a sorted array of keys
+    """
+    def __init__(self, states, n_quanta=None):
+        """
+        :param states: the quantum numbers of the states
+        :type states: Iterable[Iterable[int]]
+        :param n_quanta: the bound on the quantum numbers of every mode, by default one more than the largest present
+        :type n_quanta: None | Iterable[int]
+        """
+        states = np.unique(np.asarray(states, dtype=int).reshape((len(states), -1)), axis=0)
+        if n_quanta is None:
+            n_quanta = np.max(states, axis=0) + 1
+        super().__init__(n_quanta)
+        if not np.all(self._in_bounds(states)):
+            raise ValueError("{}: some states exceed n_quanta {}".format(type(self).__name__, self.n_quanta))
+        order = np.lexsort(tuple(states[:, ::-1].T) + (np.sum(states, axis=1),))
+        self.states = states[order]
+        # the keys only need to be consistent, so when the raveled indices could overflow we fall back on the raw bytes
+        self._ravelable = np.sum(np.log2(np.maximum(self.n_quanta, 1))) < 62
+        keys = self._get_keys(self.states)
+        self._key_order = np.argsort(keys, kind='stable')
+        self._keys = keys[self._key_order]
+
+    @classmethod
+    def from_max_quanta(cls, n_modes, max_quanta, n_quanta=None, filter=None):
+        """Builds the space of every state with at most `max_quanta` total quanta
+
+        :param n_modes:
+        :type n_modes: int
+        :param max_quanta: the maximum total number of quanta
+        :type max_quanta: int
+        :param n_quanta: an additional per-mode bound on the quantum numbers
+        :type n_quanta: None | int | Iterable[int]
+        :param filter: an extra predicate that takes an array of quantum numbers and returns which to keep
+        :type filter: None | callable
+        :return:
+        :rtype: TruncatedStateSpace
+        """
+        if n_quanta is None:
+            n_quanta = max_quanta + 1
+        if isinstance(n_quanta, (int, np.integer)):
+            n_quanta = (n_quanta,) * n_modes
+        states = [np.zeros((1, n_modes), dtype=int)]
+        for k in range(1, max_quanta + 1):
+            # every multiset of k modes is a distribution of k quanta
+            combs = np.array(list(ip.combinations_with_replacement(range(n_modes), k)), dtype=int)
+            qns = np.zeros((len(combs), n_modes), dtype=int)
+            np.add.at(qns, (np.arange(len(combs))[:, np.newaxis], combs), 1)
+            states.append(qns)
+        states = np.concatenate(states)
+        states = states[np.all(states < np.array(n_quanta), axis=1)]
+        if filter is not None:
+            states = states[np.asarray(filter(states), dtype=bool)]
+        return cls(states, n_quanta=n_quanta)
+
+    def _get_keys(self, qns):
+        qns = np.asarray(qns, dtype=int)
+        if self._ravelable:
+            return np.ravel_multi_index(np.moveaxis(qns, -1, 0), self.n_quanta)
+        qns = np.ascontiguousarray(qns.reshape((-1, self.n_modes)).astype(np.int16))
+        return qns.view(np.dtype((np.void, qns.dtype.itemsize * self.n_modes))).reshape(qns.shape[:-1])
+
+    def __len__(self):
+        return len(self.states)
+    def to_data(self):
+        return dict(n_quanta=np.array(self.n_quanta), states=self.states)
+    def get_quantum_numbers(self, indices=None):
+        if indices is None:
+            return self.states
+        return self.states[indices]
+    def get_indices(self, quantum_numbers, missing=None):
+        qns = np.asarray(quantum_numbers, dtype=int)
+        shp = qns.shape[:-1]
+        qns = qns.reshape((-1, self.n_modes))
+        inds = np.full(len(qns), -1 if missing is None else missing, dtype=int)
+        ok = self._in_bounds(qns)
+        if np.any(ok):
+            keys = self._get_keys(qns[ok])
+            pos = np.minimum(np.searchsorted(self._keys, keys), len(self._keys) - 1)
+            hit = self._keys[pos] == keys
+            sub = np.flatnonzero(ok)[hit]
+            inds[sub] = self._key_order[pos[hit]]
+            ok[np.flatnonzero(ok)[np.logical_not(hit)]] = False
+        self._check_missing(ok, missing, qns)
+        return inds.reshape(shp)
+    def __repr__(self):
+        return "{}({} states, n_quanta={})".format(type(self).__name__, len(self), self.n_quanta)
@@ -0,0 +1,252 @@
+"""
+Provides a packed representation of tensors that are symmetric under permutations of (groups of) their axes,
+like the cubic and quartic force constants, so that only the unique entries need to be stored
+"""
+
+import numpy as np, itertools as ip, math
+
+__all__ = [
+    'SymmetricTensor'
+]
+
+class SymmetricTensor:
+    """
+    Stores only the entries of a tensor whose indices are sorted within every group of symmetric axes,
+    e.g. the i <= j <= k entries of a fully symmetric cubic tensor
+    """
+    def __init__(self, values, indices, shape, groups):
+        """
+        :param values: the unique values
+        :type values: np.ndarray
+        :param indices: the canonical (sorted within each group) indices of the values
+        :type indices: np.ndarray
+        :param shape: the shape of the full tensor
+        :type shape: Iterable[int]
+        :param groups: the groups of axes the tensor is symmetric over
+        :type groups: Iterable[Iterable[int]]
+        """
+        self.values = np.asarray(values)
+        self.indices = np.asarray(indices, dtype=int)
+        self.shape = tuple(int(s) for s in shape)
+        self.groups = tuple(tuple(int(a) for a in g) for g in groups)
+        self._flat = None
+        self._order = None
+        self._stab = None
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+    @property
+    def size(self):
+        return len(self.values)
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.indices.nbytes
+
+    @staticmethod
+    def _prep_groups(ndim, groups):
+        if groups is None:
+            groups = (tuple(range(ndim)),)
+        groups = tuple(tuple(g) for g in groups)
+        covered = sorted(a for g in groups for a in g)
+        if covered != list(range(ndim)):
+            groups = groups + tuple((a,) for a in range(ndim) if a not in covered)
+        return groups
+
+    @classmethod
+    def get_canonical_indices(cls, shape, groups):
+        """Enumerates the indices that are sorted within every group
+
+        :param shape:
+        :type shape: Iterable[int]
+        :param groups:
+        :type groups: Iterable[Iterable[int]]
+        :return:
+        :rtype: np.ndarray
+        """
+        group_inds = [
+            np.array(list(ip.combinations_with_replacement(range(shape[g[0]]), len(g))), dtype=int).reshape(-1, len(g))
+            for g in groups
+        ]
+        sel = np.array(list(ip.product(*(range(len(g)) for g in group_inds))), dtype=int).reshape(-1, len(groups))
+        inds = np.zeros((len(sel), len(shape)), dtype=int)
+        for n, (g, gi) in enumerate(zip(groups, group_inds)):
+            inds[:, g] = gi[sel[:, n]]
+        return inds
+
+    @classmethod
+    def get_permutations(cls, ndim, groups):
+        """Returns every axis permutation that only mixes axes within a group
+
+        :param ndim:
+        :type ndim: int
+        :param groups:
+        :type groups: Iterable[Iterable[int]]
+        :return:
+        :rtype: list
+        """
+        perms = []
+        for sub in ip.product(*(ip.permutations(g) for g in groups)):
+            p = list(range(ndim))
+            for g, s in zip(groups, sub):
+                for a, b in zip(g, s):
+                    p[a] = b
+            perms.append(tuple(p))
+        return perms
+
+    @classmethod
+    def is_symmetric(cls, tensor, groups=None, rtol=1e-8, atol=1e-12):
+        """Checks whether a dense tensor actually has the symmetry we'd be packing over
+
+        :param tensor:
+        :type tensor: np.ndarray
+        :param groups:
+        :type groups: Iterable[Iterable[int]]
+        :return:
+        :rtype: bool
+        """
+        tensor = cls._asarray(tensor)
+        groups = cls._prep_groups(tensor.ndim, groups)
+        if any(len(set(tensor.shape[a] for a in g)) > 1 for g in groups):
+            return False
+        return all(
+            np.allclose(tensor, tensor.transpose(p), rtol=rtol, atol=atol)
+            for p in cls.get_permutations(tensor.ndim, groups)
+        )
+
+    @classmethod
+    def from_dense(cls, tensor, groups=None):
+        """Packs a dense tensor, averaging over the equivalent entries so that contracting against any
+        tensor with the same symmetry is unchanged
+
+        :param tensor:
+        :type tensor: np.ndarray
+        :param groups: the groups of symmetric axes (all axes by default)
+        :type groups: Iterable[Iterable[int]] | None
+        :return:
+        :rtype: SymmetricTensor
+        """
+        tensor = cls._asarray(tensor)
+        groups = cls._prep_groups(tensor.ndim, groups)
+        inds = cls.get_canonical_indices(tensor.shape, groups)
+        perms = cls.get_permutations(tensor.ndim, groups)
+        vals = sum(tensor[tuple(inds[:, p].T)] for p in perms) / len(perms)
+        return cls(vals, inds, tensor.shape, groups)
+
+    @staticmethod
+    def _asarray(a):
+        if not isinstance(a, np.ndarray):
+            if hasattr(a, 'asarray'):
+                a = a.asarray()
+            elif hasattr(a, 'toarray'):
+                a = a.toarray()
+        return np.asarray(a)
+
+    @property
+    def stabilizers(self):
+        """The number of group permutations that leave each canonical index unchanged"""
+        if self._stab is None:
+            stab = np.ones(len(self.indices), dtype=int)
+            for g in self.groups:
+                sub = self.indices[:, g]
+                for v in np.unique(sub):
+                    counts = np.sum(sub == v, axis=1)
+                    stab *= np.array([math.factorial(c) for c in range(len(g) + 1)])[counts]
+            self._stab = stab
+        return self._stab
+
+    def canonicalize(self, idx):
+        """Sorts indices within each group
+
+        :param idx: indices with the last axis running over the tensor axes
+        :type idx: np.ndarray
+        :return:
+        :rtype: np.ndarray
+        """
+        idx = np.array(idx, dtype=int)
+        for g in self.groups:
+            if len(g) > 1:
+                idx[..., g] = np.sort(idx[..., g], axis=-1)
+        return idx
+
+    def _lookup(self, idx):
+        if self._flat is None:
+            flat = np.ravel_multi_index(self.indices.T, self.shape)
+            self._order = np.argsort(flat)
+            self._flat = flat[self._order]
+        flat = np.ravel_multi_index(np.moveaxis(self.canonicalize(idx), -1, 0), self.shape)
+        return self._order[np.searchsorted(self._flat, flat)]
+
+    def __getitem__(self, item):
+        if not isinstance(item, tuple):
+            item = (item,)
+        if len(item) == self.ndim and all(isinstance(i, (int, np.integer)) for i in item):
+            return self.values[self._lookup(np.array(item))]
+        if len(item) == self.ndim and all(
+                isinstance(i, (int, np.integer)) or (isinstance(i, np.ndarray) and i.dtype.kind in 'iu') for i in item
+        ):
+            # integer array indexing can be done on the packed values directly
+            return self.values[self._lookup(np.stack(np.broadcast_arrays(*item), axis=-1))]
+        return self.toarray()[item]
+
+    def toarray(self):
+        """Unpacks into a dense tensor
+
+        :return:
+        :rtype: np.ndarray
+        """
+        arr = np.zeros(self.shape, dtype=self.values.dtype)
+        for p in self.get_permutations(self.ndim, self.groups):
+            arr[tuple(self.indices[:, p].T)] = self.values
+        return arr
+    def asarray(self):
+        return self.toarray()
+
+    def contract(self, tensor):
+        """Fully contracts the packed tensor against the leading axes of `tensor`,
+        i.e. computes sum_t self[t] * tensor[t, ...], without unpacking
+
+        :param tensor: either a dense array with shape `self.shape + extra` or a sparse matrix whose rows
+        run over the flattened `self.shape`
+        :type tensor: np.ndarray | sp.spmatrix
+        :return:
+        :rtype: np.ndarray
+        """
+        if not hasattr(tensor, 'tocsr'):
+            tensor = self._asarray(tensor)
+            tensor = tensor.reshape((int(np.prod(self.shape)), -1))
+        else:
+            tensor = tensor.tocsr()
+        weights = self.values / self.stabilizers
+        res = 0
+        for p in self.get_permutations(self.ndim, self.groups):
+            rows = np.ravel_multi_index(self.indices[:, p].T, self.shape)
+            res = res + tensor[rows].T.dot(weights)
+        return np.asarray(res).reshape(-1)
+
+    def __mul__(self, other):
+        if isinstance(other, (int, float, np.integer, np.floating)):
+            return type(self)(self.values * other, self.indices, self.shape, self.groups)
+        return NotImplemented
+    __rmul__ = __mul__
+    def __neg__(self):
+        return self * -1
+
+    def to_data(self):
+        """Converts to a dict of arrays for storage
+
+        :return:
+        :rtype: dict
+        """
+        group_labels = np.zeros(self.ndim, dtype=int)
+        for n, g in enumerate(self.groups):
+            group_labels[list(g)] = n
+        return dict(values=self.values, indices=self.indices, shape=np.array(self.shape), groups=group_labels)
+    @classmethod
+    def from_data(cls, data):
+        labels = np.asarray(data['groups'])
+        groups = [tuple(np.where(labels == n)[0]) for n in np.unique(labels)]
+        return cls(data['values'], data['indices'], data['shape'], groups)
+
+    def __repr__(self):
+        return "{}(shape={}, groups={}, unique={})".format(type(self).__name__, self.shape, self.groups, self.size)
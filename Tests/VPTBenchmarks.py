@@ -0,0 +1,335 @@
+"""
+Scaling benchmarks for the full VPT pipeline on synthetic (but physically sensible) molecules
+
+Every stage of the pipeline is timed separately along with its peak (traced) memory, and the results are written
+as JSON so that runs from different revisions can be compared, e.g.
+
+    python VPTBenchmarks.py --modes 3 6 9 --quanta 3 5 --output new.json --compare old.json
+"""
+
+from Peeves.TestUtils import *
+from unittest import TestCase
+from PyVPT import *
+import sys, os, time, json, platform, subprocess, tracemalloc, numpy as np
+
+__all__ = [
+    "VPTBenchmarks",
+    "SyntheticMolecule",
+    "run_benchmarks",
+    "compare_benchmarks",
+    "measure_import_time"
+]
+
+class SyntheticMolecule:
+    """
+    Generates a random molecule with 3N-6 = n_modes vibrations: a random geometry, random masses,
+    a positive definite Hessian with the translations and rotations projected out, the corresponding normal modes,
+    and fully symmetric cubic and quartic force fields, all stored the way `load_fchk_data` returns them
+    so that `get_hamiltonian` goes through the same mass weighting as `from_fchk`
+    """
+    wavenumbers = 1/219474.6313702
+    def __init__(self, n_modes, seed=0):
+        from McUtils.Data import UnitsData
+
+        if (n_modes + 6) % 3 != 0:
+            raise ValueError("{} modes doesn't correspond to a nonlinear molecule".format(n_modes))
+        self.n_modes = n_modes
+        self.n_atoms = (n_modes + 6) // 3
+        self.seed = seed
+        rng = np.random.RandomState(seed)
+        amu_conv = UnitsData.convert("AtomicMassUnits", "AtomicUnitOfMass")
+
+        n = self.n_atoms
+        self.masses = amu_conv * rng.uniform(1, 32, n)
+        self.coords = rng.normal(scale=2.5, size=(n, 3))
+        self.coords -= np.average(self.coords, weights=self.masses, axis=0)
+
+        # translations and rotations in mass-weighted coordinates
+        sqm = np.sqrt(np.repeat(self.masses, 3))
+        tr = []
+        for a in range(3):
+            t = np.zeros((n, 3))
+            t[:, a] = 1
+            tr.append(t.flatten() * sqm)
+            r = np.cross(self.coords, np.eye(3)[a])
+            tr.append(r.flatten() * sqm)
+        tr = np.linalg.qr(np.array(tr).T)[0]
+        basis = np.linalg.qr(np.concatenate([tr, rng.normal(size=(3*n, n_modes))], axis=1))[0]
+        vibs = basis[:, 6:].T
+
+        freqs = np.sort(rng.uniform(500, 4000, n_modes))[::-1] * self.wavenumbers
+        self.freqs = freqs
+        # the Cartesian force constants, so that the modes reproduce the frequencies like they do in an fchk file
+        self.hessian = np.dot(vibs.T * freqs**2, vibs) * np.outer(sqm, sqm)
+        self.modes = vibs / sqm[np.newaxis, :]
+        self.gradient = np.zeros(3*n)
+
+        # the cubic and quartic force constants in the dimensionless normal coordinates, which is what the
+        # expansion should give back
+        self.cubic = self._symmetrize(rng.normal(scale=.1, size=(n_modes,)*3)) * np.min(freqs)
+        self.quartic = self._symmetrize(rng.normal(scale=.01, size=(n_modes,)*4)) * np.min(freqs)
+        # ...brought back to the normal mode derivatives of the Cartesian force constants that Gaussian reports,
+        # where only the semi-diagonal fourth derivatives are available
+        sqf = np.sqrt(freqs)
+        proj = np.linalg.pinv(self.modes)
+        v3 = self.cubic * (sqf[:, np.newaxis, np.newaxis] * sqf[np.newaxis, :, np.newaxis] * sqf[np.newaxis, np.newaxis, :])
+        v4 = np.einsum('iimn->imn', self.quartic) * (
+                freqs[:, np.newaxis, np.newaxis] * sqf[np.newaxis, :, np.newaxis] * sqf[np.newaxis, np.newaxis, :]
+        )
+        self.thirds = np.sqrt(amu_conv) * np.einsum('ax,ixy,by->iab', proj, v3, proj)
+        self.fourths = amu_conv * np.einsum('ax,ixy,by->iab', proj, v4, proj)
+
+    @staticmethod
+    def _symmetrize(t):
+        import itertools as ip
+        perms = list(ip.permutations(range(t.ndim)))
+        return sum(np.transpose(t, p) for p in perms) / len(perms)
+
+    def get_hamiltonian(self, n_quanta=3, **opts):
+        """Builds the Hamiltonian the same way `from_fchk` would from the same data"""
+        from Psience import NormalModeCoordinates
+        from McUtils.Numputils import SparseArray
+
+        fcs, thirds, fourths = PerturbationTheoryHamiltonian._weight_derivatives_by_mass(
+            self.masses, self.freqs, self.hessian, self.thirds, SparseArray.from_diag(self.fourths)
+        )
+        return PerturbationTheoryHamiltonian(
+            coords=self.coords,
+            masses=self.masses,
+            pot_derivs=[self.gradient, fcs, thirds, fourths],
+            modes=NormalModeCoordinates(self.modes, freqs=self.freqs),
+            n_quanta=n_quanta,
+            **opts
+        )
+
+    def get_states(self):
+        """The ground state and fundamentals"""
+        return [(0,) * self.n_modes] + [tuple(int(i == j) for j in range(self.n_modes)) for i in range(self.n_modes)]
+
+def _measure(setup, run, repeats=3):
+    """Times run(setup()) (best of repeats) and then measures its peak traced memory in a separate pass"""
+    times = []
+    for _ in range(repeats):
+        arg = setup()
+        start = time.perf_counter()
+        run(arg)
+        times.append(time.perf_counter() - start)
+    arg = setup()
+    tracemalloc.start()
+    try:
+        run(arg)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(times), peak
+
+def _stages(mol, n_quanta, fchk=None, tensor_max_modes=3):
+    """The (name, setup, run) triples for every stage of the pipeline
+
+    The full `ProductOperator.tensor` is only built up to `tensor_max_modes`, since it holds a Kronecker product
+    block for every index tuple and stops being feasible after a few modes (the element pulls never build it)
+    """
+    states = mol.get_states()
+    def fresh(terms=True):
+        ham = mol.get_hamiltonian(n_quanta)
+        if terms:
+            ham.V_terms.packed_terms, ham.G_terms.packed_terms
+        return ham
+    stages = []
+    if fchk is not None:
+        stages.append(("from_fchk", lambda: None, lambda _: PerturbationTheoryHamiltonian.from_fchk(fchk, n_quanta=n_quanta)))
+    stages.extend([
+        ("undimensionalize", lambda: fresh(False), lambda h: h.undimensionalize(mol.masses, h.modes)),
+        ("_get_tensor_derivs", lambda: fresh(False),
+            lambda h: h.V_terms._get_tensor_derivs(
+                (h.V_terms.modes.matrix, 0, 0, 0),
+                h.V_terms.v_derivs,
+                mixed_XQ=True
+            )),
+        ("PotentialTerms.get_terms", lambda: fresh(False), lambda h: h.V_terms.get_terms()),
+        ("KineticTerms.get_terms", lambda: fresh(False), lambda h: h.G_terms.get_terms()),
+        ("ProductOperator setup", fresh,
+            lambda h: [h.get_operator(o)._get_index_blocks() for o in _operators]),
+        ("H0 elements", fresh, lambda h: h.H0[h.get_state_indices(states), h.get_state_indices(states)]),
+        ("H1 elements", fresh, lambda h: _pull_h1(h, states)),
+        ("H2 elements", fresh, lambda h: h.H2[h.get_state_indices(states), h.get_state_indices(states)]),
+        ("_get_corrections", fresh, lambda h: h._get_corrections(states, coupled_states='auto')),
+    ])
+    if mol.n_modes <= tensor_max_modes:
+        stages.insert(-4, ("ProductOperator tensor", fresh, lambda h: [h.get_operator(o).tensor for o in _operators]))
+    return stages
+
+_operators = ('pp', 'QQ', 'pQp', 'QQQ', 'pQQp', 'QQQQ')
+
+def _pull_h1(ham, states):
+    """Pulls the H1 elements allowed by the selection rules"""
+    inds = ham.get_state_indices(states)
+    coupled, (rows, cols) = ham.get_coupled_states(inds, order=3, return_pairs=True)
+    return ham.H1[inds[rows], cols]
+
+def _revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+# the modules that `import PyVPT` on its own shouldn't pull in
+heavy_modules = ("Psience", "McUtils.Coordinerds", "McUtils.Numputils", "McUtils.Data", "scipy.sparse")
+
+def measure_import_time(module="PyVPT", repeats=5):
+    """Times `import module` in fresh interpreters (best of repeats), since start-up is paid by every
+    short-lived worker, and reports which of the heavy dependencies got loaded along the way
+
+    :param module: the module to import
+    :type module: str
+    :param repeats: the number of interpreters to start
+    :type repeats: int
+    :return: the best time and the heavy modules that were imported
+    :rtype: dict
+    """
+    script = "; ".join([
+        "import sys, time, json",
+        "start = time.perf_counter()",
+        "import {}".format(module),
+        "t = time.perf_counter() - start",
+        "print(json.dumps([t, [m for m in {!r} if m in sys.modules]]))".format(heavy_modules)
+    ])
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+    times = []
+    loaded = []
+    for _ in range(repeats):
+        out = subprocess.check_output([sys.executable, "-c", script], env=env)
+        t, loaded = json.loads(out.decode().strip().splitlines()[-1])
+        times.append(t)
+    return dict(module=module, time=min(times), loaded=loaded)
+
+def run_benchmarks(n_modes=(3, 6, 9, 12, 18, 24, 30), n_quanta=(3, 5, 8), repeats=3, seed=0, fchk=None,
+                   tensor_max_modes=3, log=None):
+    """Runs every stage for every (n_modes, n_quanta) combination
+
+    :param n_modes: the numbers of modes to use (must be 3*n_atoms - 6)
+    :type n_modes: Iterable[int]
+    :param n_quanta: the numbers of quanta to use
+    :type n_quanta: Iterable[int]
+    :param repeats: the number of timing repeats (the best is kept)
+    :type repeats: int
+    :param fchk: an optional fchk file to also time `from_fchk` on
+    :type fchk: str | None
+    :param tensor_max_modes: the largest number of modes to build the full `ProductOperator.tensor` for
+    :type tensor_max_modes: int
+    :param log: an optional stream to report progress on
+    :return: the machine-readable benchmark results
+    :rtype: dict
+    """
+    results = []
+    for n in n_modes:
+        mol = SyntheticMolecule(n, seed=seed)
+        for q in n_quanta:
+            for name, setup, run in _stages(mol, q, fchk=fchk, tensor_max_modes=tensor_max_modes):
+                t, mem = _measure(setup, run, repeats=repeats)
+                results.append(dict(stage=name, n_modes=n, n_quanta=q, time=t, peak_memory=mem))
+                if log is not None:
+                    print("{:>3} modes {:>2} quanta {:<26} {:>10.4f}s {:>12,d}B".format(n, q, name, t, mem), file=log)
+    return dict(
+        meta=dict(
+            revision=_revision(),
+            timestamp=time.time(),
+            python=platform.python_version(),
+            numpy=np.__version__,
+            machine=platform.machine(),
+            seed=seed,
+            repeats=repeats
+        ),
+        import_time=measure_import_time(repeats=repeats),
+        results=results
+    )
+
+def compare_benchmarks(old, new, tolerance=1.25, min_time=1e-3):
+    """Finds the stages that got slower (or hungrier) by more than `tolerance` between two runs
+
+    :param old: the reference results
+    :type old: dict | str
+    :param new: the new results
+    :type new: dict | str
+    :param tolerance: the allowed ratio
+    :type tolerance: float
+    :param min_time: timings below this are considered noise
+    :type min_time: float
+    :return: the regressions as (stage, n_modes, n_quanta, quantity, old, new) tuples
+    :rtype: list
+    """
+    if isinstance(old, str):
+        with open(old) as f:
+            old = json.load(f)
+    if isinstance(new, str):
+        with open(new) as f:
+            new = json.load(f)
+    key = lambda r: (r["stage"], r["n_modes"], r["n_quanta"])
+    ref = {key(r): r for r in old["results"]}
+    regressions = []
+    for r in new["results"]:
+        o = ref.get(key(r))
+        if o is None:
+            continue
+        if r["time"] > min_time and r["time"] > tolerance * o["time"]:
+            regressions.append(key(r) + ("time", o["time"], r["time"]))
+        if r["peak_memory"] > tolerance * max(o["peak_memory"], 1):
+            regressions.append(key(r) + ("peak_memory", o["peak_memory"], r["peak_memory"]))
+    if "import_time" in old and "import_time" in new:
+        o, r = old["import_time"]["time"], new["import_time"]["time"]
+        if r > min_time and r > tolerance * o:
+            regressions.append(("import", 0, 0, "time", o, r))
+    return regressions
+
+class VPTBenchmarks(TestCase):
+
+    @timingTest
+    def test_PipelineScaling(self):
+        res = run_benchmarks(n_modes=(3, 6, 9), n_quanta=(3, 5), repeats=1, log=sys.stdout)
+        # the full operator tensor is only built for the 3 mode molecule
+        self.assertEqual(len(res["results"]), 3 * 2 * 9 + 2)
+
+    @timingTest
+    def test_ImportTime(self):
+        res = measure_import_time()
+        print("import PyVPT: {:.4f}s".format(res["time"]))
+        self.assertEqual(res["loaded"], [])
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmarks the stages of the VPT pipeline")
+    parser.add_argument("--modes", type=int, nargs="+", default=[3, 6, 9, 12, 18, 24, 30])
+    parser.add_argument("--quanta", type=int, nargs="+", default=[3, 5, 8])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fchk", default=None, help="an fchk file to also time from_fchk on")
+    parser.add_argument("--tensor-max-modes", type=int, default=3,
+                        help="the largest number of modes to build the full ProductOperator tensor for")
+    parser.add_argument("--output", default=None, help="where to write the JSON results")
+    parser.add_argument("--compare", default=None, help="a previous JSON result to check for regressions against")
+    parser.add_argument("--tolerance", type=float, default=1.25)
+    opts = parser.parse_args(argv)
+
+    res = run_benchmarks(n_modes=opts.modes, n_quanta=opts.quanta, repeats=opts.repeats,
+                         seed=opts.seed, fchk=opts.fchk, tensor_max_modes=opts.tensor_max_modes,
+                         log=sys.stderr)
+    if opts.output is not None:
+        with open(opts.output, "w") as f:
+            json.dump(res, f, indent=1)
+    else:
+        json.dump(res, sys.stdout, indent=1)
+
+    if opts.compare is not None:
+        regressions = compare_benchmarks(opts.compare, res, tolerance=opts.tolerance)
+        for r in regressions:
+            print("REGRESSION {} ({} modes, {} quanta) {}: {:.4g} -> {:.4g}".format(*r), file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
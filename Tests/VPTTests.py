@@ -3,7 +3,76 @@ from unittest import TestCase
 from PyVPT import *
 from McUtils.Plots import *
 from McUtils.Data import UnitsData
-import sys, os, numpy as np
+from .VPTBenchmarks import SyntheticMolecule
+import sys, os, itertools as ip, numpy as np
+
+def _pair_potential(coords, scale, seed=0):
+    """The Cartesian second, third, and fourth derivatives at `coords` of a sum over atom pairs of polynomials in
+    the change in squared distance, which makes for a rotationally invariant force field with known derivatives"""
+    rng = np.random.RandomState(seed)
+    nat = len(coords)
+    n = 3 * nat
+    F2, F3, F4 = np.zeros((n,)*2), np.zeros((n,)*3), np.zeros((n,)*4)
+    for a, b in ip.combinations(range(nat), 2):
+        # the derivatives of the potential with respect to the change in squared distance, e
+        g2, g3, g4 = scale * rng.uniform(.5, 1.5, 3) * [2, -2, 1]
+        # the (only nonvanishing) first and second derivatives of e with respect to the coordinates
+        u = np.zeros(nat)
+        u[a], u[b] = 1, -1
+        e1 = 2 * np.kron(u, coords[a] - coords[b])
+        e2 = 2 * np.kron(np.outer(u, u), np.eye(3))
+        F2 += g2 * np.outer(e1, e1)
+        t = np.einsum('ab,c->abc', e2, e1)
+        F3 += g3 * np.einsum('a,b,c->abc', e1, e1, e1) + g2 * (t + t.transpose(0, 2, 1) + t.transpose(2, 1, 0))
+        t = np.einsum('ab,c,d->abcd', e2, e1, e1)
+        t = sum(t.transpose(p) for p in ip.permutations(range(4))) / 4
+        w = np.einsum('ab,cd->abcd', e2, e2)
+        F4 += g4 * np.einsum('a,b,c,d->abcd', e1, e1, e1, e1) + g3 * t + g2 * (
+                w + w.transpose(0, 2, 1, 3) + w.transpose(0, 3, 2, 1)
+        )
+    return F2, F3, F4
+
+class _SyntheticJob(VPTJob):
+    """A batch job on a synthetic molecule, which can also be told to fail in the ways a real job might"""
+    def __init__(self, n_modes=3, seed=0, failure=None, delay=0, **opts):
+        super().__init__("synthetic-{}-{}".format(n_modes, seed), **opts)
+        self.n_modes = n_modes
+        self.seed = seed
+        self.failure = failure
+        self.delay = delay
+    def get_hamiltonian(self):
+        import time
+
+        time.sleep(self.delay)
+        if self.failure == "raise":
+            raise ValueError("bad input")
+        elif self.failure == "crash":
+            os._exit(3)
+        elif self.failure == "memory":
+            np.empty(2**33, dtype=np.uint8)
+        return SyntheticMolecule(self.n_modes, seed=self.seed).get_hamiltonian(self.n_quanta)
+
+class _FakeJacobians:
+    """Stands in for a Coordinerds coordinate system or set, returning a fixed array for every order of Jacobian and
+    recording what it was asked for, optionally without supporting lists of orders like older versions"""
+    def __init__(self, shape, lists=True):
+        self.shape = shape
+        self.lists = lists
+        self.calls = []
+    def get(self, order):
+        return np.random.RandomState(order).normal(size=(self.shape,) * (order + 1))
+    def jacobian(self, *args):
+        order = args[-1]
+        self.calls.append(order)
+        if isinstance(order, list):
+            if not self.lists:
+                raise TypeError("orders must be integers")
+            return [self.get(o) for o in order]
+        return self.get(order)
+
+def _shared_row_sum(arrays, i):
+    """Reads a row of the shared arrays, which has to be module-level to be sent to worker processes"""
+    return float(np.sum(arrays[0][i]) + np.sum(arrays[1]))
 
 class VPTTests(TestCase):
 
@@ -17,6 +86,799 @@ class VPTTests(TestCase):
         )
 
 
+    @validationTest
+    def test_ClosedFormElements(self):
+
+        rng = np.random.default_rng(0)
+        quanta = (4, 3, 4)
+        n = np.array([rng.integers(0, q, 25) for q in quanta])
+        m = np.array([rng.integers(0, q, 25) for q in quanta])
+        idx = tuple((n[i], m[i]) for i in range(3))
+        # Q and (the real part of) p from ladder operators in a basis big enough that truncating it never matters
+        size = max(quanta) + 4
+        a = np.diag(np.sqrt(np.arange(1, size)), 1)
+        mats = {"Q": (a + a.T) / np.sqrt(2), "p": (a - a.T) / np.sqrt(2)}
+        ops = PerturbationTheoryHamiltonian.ProductOperator
+        for op in (ops.QQ(quanta), ops.pp(quanta), ops.pQp(quanta), ops.QQQ(quanta), ops.pQQp(quanta), ops.QQQQ(quanta)):
+            els = op.get_elements(idx)
+            for inds in np.ndindex(*els.shape[:-1]):
+                ref = np.ones(n.shape[1])
+                for mode in range(3):
+                    # the operators acting on a mode multiply in order, every other mode only contributes an overlap
+                    mat = np.eye(size)
+                    for f, i in zip(op.name, inds):
+                        if i == mode:
+                            mat = mat.dot(mats[f])
+                    ref = ref * mat[n[mode], m[mode]]
+                self.assertTrue(np.allclose(els[inds], ref))
+
+    @validationTest
+    def test_Profiling(self):
+
+        prof = Profiler()
+        hammer = PerturbationTheoryHamiltonian.from_fchk(TestManager.test_data("HOD_freq.fchk"), n_quanta=5,
+                                                         profiler=prof)
+        coeffs, corrs = hammer.get_corrections([0, 1, 5], coupled_states='auto')
+        report = prof.report()
+        for stage in ("from_fchk", "PotentialTerms.get_terms", "KineticTerms.get_terms",
+                      "H0.get_element", "H1.get_element", "ProductOperator(QQQ).get_element_matrix",
+                      "_get_corrections"):
+            self.assertIn(stage, report)
+        self.assertEqual(report["_get_corrections"]["calls"], 1)
+
+        hammer.profiler = None
+        coeffs2, corrs2 = hammer.get_corrections([0, 1, 5], coupled_states='auto')
+        self.assertEqual(prof.report()["_get_corrections"]["calls"], 1)
+        self.assertTrue(all(np.allclose(a, b) for a, b in zip(corrs, corrs2)))
+
+    @validationTest
+    def test_VariationalHOD(self):
+
+        hammer = PerturbationTheoryHamiltonian.from_fchk(TestManager.test_data("HOD_freq.fchk"), n_quanta=5)
+        wfns = hammer.get_variational_wavefunctions(5, dense_cutoff=0)
+        basis = hammer.get_state_indices(wfns.basis)
+        ix = np.ix_(basis, basis)
+        dense = sum(np.asarray(H[ix].asarray() if hasattr(H[ix], 'asarray') else H[ix])
+                    for H in (hammer.H0, hammer.H1, hammer.H2))
+        self.assertTrue(np.allclose(hammer.get_sparse_hamiltonian(basis).toarray(), dense))
+        self.assertTrue(np.allclose(wfns.energies, np.linalg.eigvalsh(dense)[:5]))
+
+    @validationTest
+    def test_SparseExportHOD(self):
+        import tempfile, scipy.sparse as sp
+
+        hammer = PerturbationTheoryHamiltonian.from_fchk(TestManager.test_data("HOD_freq.fchk"), n_quanta=4)
+        full = np.arange(len(hammer.basis))
+        for H in (hammer.H0, hammer.H1, hammer.H2):
+            dense = H[np.ix_(full, full)]
+            dense = np.asarray(dense.asarray() if hasattr(dense, 'asarray') else dense)
+            self.assertTrue(np.allclose(H.to_sparse().toarray(), dense))
+        with tempfile.TemporaryDirectory() as d:
+            mat = hammer.H1.export(os.path.join(d, "H1.npz"))
+            self.assertTrue(np.allclose(sp.load_npz(os.path.join(d, "H1.npz")).toarray(), mat.toarray()))
+
+    @validationTest
+    def test_BlockElementsHOD(self):
+
+        hammer = PerturbationTheoryHamiltonian.from_fchk(TestManager.test_data("HOD_freq.fchk"), n_quanta=5)
+        rows = np.array([0, 3, 3, 17, 42, 101])
+        cols = np.array([1, 0, 25, 17, 60])
+        for H in (hammer.H0, hammer.H1, hammer.H2):
+            block = H[np.ix_(rows, cols)]
+            self.assertEqual(block.shape, (len(rows), len(cols)))
+            els = H[np.repeat(rows, len(cols)), np.tile(cols, len(rows))]
+            els = np.asarray(els.asarray() if hasattr(els, 'asarray') else els)
+            self.assertTrue(np.allclose(block, els.reshape(block.shape)))
+
+    @validationTest
+    def test_AnalyticHOD(self):
+
+        hammer = PerturbationTheoryHamiltonian.from_fchk(TestManager.test_data("HOD_freq.fchk"), n_quanta=6)
+        states = [(0, 0, 0), (0, 0, 1), (0, 1, 0), (1, 0, 0), (0, 0, 2), (0, 2, 0), (2, 0, 0),
+                  (0, 1, 1), (1, 0, 1), (1, 1, 0)]
+        coeffs, corrs = hammer.get_corrections(states, coupled_states=None)
+        self.assertTrue(np.allclose(hammer.get_analytic_energies(states), sum(corrs)))
+
+    @validationTest
+    def test_TruncatedStateSpace(self):
+
+        space = TruncatedStateSpace.from_max_quanta(3, 4, n_quanta=5)
+        self.assertEqual(len(space), 35)
+        qns = space.get_quantum_numbers()
+        self.assertTrue(np.all(space.get_indices(qns) == np.arange(len(space))))
+        self.assertEqual(space.get_indices([(5, 0, 0), (2, 2, 1)], missing=-1).tolist(), [-1, -1])
+
+        states = [(0, 0, 0), (0, 0, 1), (0, 1, 0), (1, 0, 0)]
+        full = PerturbationTheoryHamiltonian.from_fchk(TestManager.test_data("HOD_freq.fchk"), n_quanta=5)
+        trunc = PerturbationTheoryHamiltonian.from_fchk(TestManager.test_data("HOD_freq.fchk"), n_quanta=space)
+        _, corrs = full.get_corrections(states, coupled_states='auto')
+        _, corrs2 = trunc.get_corrections(states)
+        self.assertTrue(all(np.allclose(a, b) for a, b in zip(corrs, corrs2)))
+
+    @validationTest
+    def test_ParallelHOD(self):
+
+        states = [(0, 0, 0), (0, 0, 1), (0, 1, 0), (1, 0, 0)]
+        serial = PerturbationTheoryHamiltonian.from_fchk(TestManager.test_data("HOD_freq.fchk"), n_quanta=5)
+        with ElementExecutor(max_workers=4) as executor:
+            threaded = PerturbationTheoryHamiltonian.from_fchk(TestManager.test_data("HOD_freq.fchk"), n_quanta=5,
+                                                               executor=executor)
+            coeffs2, corrs2 = threaded.get_corrections(states)
+        coeffs, corrs = serial.get_corrections(states)
+        self.assertTrue(np.array_equal(coeffs, coeffs2))
+        self.assertTrue(all(np.array_equal(a, b) for a, b in zip(corrs, corrs2)))
+
+    @validationTest
+    def test_HigherOrderHOD(self):
+
+        hammer = PerturbationTheoryHamiltonian.from_fchk(TestManager.test_data("HOD_freq.fchk"), n_quanta=10)
+        states = [(0, 0, 0), (0, 0, 1), (0, 1, 0), (1, 0, 0)]
+        corrs, coeffs, coupled = hammer.get_higher_order_corrections(states, order=4)
+        coeffs2, corrs2 = hammer.get_corrections(states, coupled_states='auto')
+        self.assertTrue(np.allclose(corrs[2], corrs2[1] + corrs2[2]))
+        self.assertTrue(np.allclose(corrs[3], 0))
+        self.assertEqual(len(coeffs), 3)
+        self.assertEqual(coeffs[1].shape, (len(states), len(coupled)))
+
+    @validationTest
+    def test_IsotopologuesHOD(self):
+
+        data = PerturbationTheoryHamiltonian.load_fchk_data(TestManager.test_data("HOD_freq.fchk"))
+        masses = data["masses"] / UnitsData.convert("AtomicMassUnits", "AtomicUnitOfMass")
+        states = [(0, 0, 0), (0, 0, 1), (0, 1, 0), (1, 0, 0)]
+        same, heavy = PerturbationTheoryHamiltonian.get_isotopologues(data, [masses, masses * [1, 2, 1]], n_quanta=5)
+        hammer = PerturbationTheoryHamiltonian.from_fchk(TestManager.test_data("HOD_freq.fchk"), n_quanta=5)
+        _, corrs = hammer.get_corrections(states, coupled_states='auto')
+        _, corrs2 = same.get_corrections(states, coupled_states='auto')
+        self.assertTrue(np.allclose(sum(corrs), sum(corrs2)))
+        self.assertTrue(np.all(heavy.modes.freqs <= same.modes.freqs + 1e-8))
+
+    @validationTest
+    def test_IsotopologueDerivatives(self):
+        from McUtils.Numputils import SparseArray
+
+        amu_conv = UnitsData.convert("AtomicMassUnits", "AtomicUnitOfMass")
+        coords = np.array([[0., 0., 0.], [1.8, 0., 0.], [-.5, 1.7, .2]])
+        coords -= np.average(coords, axis=0)
+        F2, F3, F4 = _pair_potential(coords, 1e-6 * amu_conv)
+        masses = np.array([16., 1., 1.])
+        # the derivatives along the modes the way Gaussian reports them
+        along = lambda L: (
+            np.sqrt(amu_conv) * np.einsum('ia,abc->ibc', L, F3),
+            amu_conv * np.einsum('ia,ib,abcd->icd', L, L, F4)
+        )
+        modes, freqs = PerturbationTheoryHamiltonian.get_isotopologue_modes(coords, amu_conv * masses, F2)
+        thirds, fourths = along(modes[0])
+        heavy = amu_conv * masses * [1, 2, 1]
+        new_modes, _ = PerturbationTheoryHamiltonian.get_isotopologue_modes(coords, heavy, F2)
+        new_thirds, new_fourths = PerturbationTheoryHamiltonian._transform_mode_derivatives(
+            coords, F2, modes[0], new_modes, thirds, SparseArray.from_diag(fourths)
+        )
+        ref_thirds, ref_fourths = along(new_modes[0])
+        self.assertTrue(np.allclose(new_thirds[0], ref_thirds))
+        # a triatomic has no quartic terms between four distinct modes, so nothing is left out
+        self.assertTrue(np.allclose(new_fourths[0], ref_fourths))
+
+        data = dict(coords=coords, masses=amu_conv * masses, gradient=np.zeros(9), force_constants=F2,
+                    third_derivatives=thirds, fourth_derivatives=SparseArray.from_diag(fourths),
+                    modes=modes[0], freqs=freqs[0])
+        hammer, = PerturbationTheoryHamiltonian.get_isotopologues(data, [masses * [1, 2, 1]], n_quanta=3)
+        ref = PerturbationTheoryHamiltonian(
+            coords=coords,
+            masses=heavy,
+            pot_derivs=[np.zeros(9)] + list(PerturbationTheoryHamiltonian._weight_derivatives_by_mass(
+                heavy, hammer.modes.freqs, F2, ref_thirds, SparseArray.from_diag(ref_fourths)
+            )),
+            modes=hammer.modes,
+            n_quanta=3
+        )
+        dense = lambda t: np.asarray(t.toarray() if hasattr(t, 'toarray') else t)
+        for i in range(3):
+            self.assertTrue(np.allclose(dense(hammer.V_terms[i]), dense(ref.V_terms[i])))
+
+    @validationTest
+    def test_LazyImports(self):
+        import subprocess, json, PyVPT
+
+        script = "; ".join([
+            "import sys, json, PyVPT",
+            "print(json.dumps([m for m in ('Psience', 'McUtils.Coordinerds', 'scipy.sparse') if m in sys.modules]))"
+        ])
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+        out = subprocess.check_output([sys.executable, "-c", script], env=env)
+        self.assertEqual(json.loads(out.decode().strip().splitlines()[-1]), [])
+        self.assertIs(PyVPT.PerturbationTheoryWavefunctions, PerturbationTheoryWavefunctions)
+
+    @validationTest
+    def test_SaveLoadHOD(self):
+        import tempfile
+
+        states = [(0, 0, 0), (0, 0, 1), (0, 1, 0), (1, 0, 0)]
+        hammer = PerturbationTheoryHamiltonian.from_fchk(TestManager.test_data("HOD_freq.fchk"), n_quanta=5)
+        wfns = hammer.get_wavefunctions(states, coupled_states='auto')
+        with tempfile.TemporaryDirectory() as d:
+            hammer.save(os.path.join(d, "HOD.vpt"))
+            hammer2 = PerturbationTheoryHamiltonian.load(os.path.join(d, "HOD.vpt"))
+            _, corrs = hammer.get_corrections(states, coupled_states='auto')
+            _, corrs2 = hammer2.get_corrections(states, coupled_states='auto')
+            self.assertTrue(all(np.allclose(a, b) for a, b in zip(corrs, corrs2)))
+
+            wfns.save(os.path.join(d, "HOD_wfns.vpt"))
+            wfns2 = PerturbationTheoryWavefunctions.load(os.path.join(d, "HOD_wfns.vpt"))
+            self.assertTrue(np.allclose(wfns.energies, wfns2.energies))
+            self.assertTrue(np.allclose(wfns.coeffs, wfns2.coeffs))
+            self.assertTrue(np.array_equal(wfns.basis, wfns2.basis))
+            self.assertEqual(wfns2.hamiltonian.basis.n_quanta, hammer.basis.n_quanta)
+            del wfns2, hammer2 # release the memory maps before the directory goes
+
+    @validationTest
+    def test_ExtendBasisHOD(self):
+
+        states = [(0, 0, 0), (0, 0, 1), (0, 1, 0), (1, 0, 0)]
+        hammer = PerturbationTheoryHamiltonian.from_fchk(TestManager.test_data("HOD_freq.fchk"), n_quanta=3,
+                                                         cache_elements=True)
+        hammer.get_corrections(states, coupled_states='auto')
+        hammer.extend_basis(5)
+        misses = hammer.element_cache.misses
+        _, corrs = hammer.get_corrections(states, coupled_states='auto')
+        self.assertGreater(hammer.element_cache.hits, 0)
+        self.assertLess(hammer.element_cache.misses - misses, hammer.element_cache.hits)
+
+        fresh = PerturbationTheoryHamiltonian.from_fchk(TestManager.test_data("HOD_freq.fchk"), n_quanta=5)
+        _, corrs2 = fresh.get_corrections(states, coupled_states='auto')
+        self.assertTrue(all(np.allclose(a, b) for a, b in zip(corrs, corrs2)))
+
+        energies, history = fresh.get_converged_energies(states, tolerance=1e-8)
+        self.assertTrue(np.allclose(energies, sum(corrs2)))
+
+    @validationTest
+    def test_ResonanceScreeningHOD(self):
+
+        hammer = PerturbationTheoryHamiltonian.from_fchk(TestManager.test_data("HOD_freq.fchk"), n_quanta=5)
+        states = hammer.get_state_indices([(0, 0, 0), (0, 0, 1), (0, 1, 0), (1, 0, 0), (0, 0, 2), (0, 2, 0)])
+        martin = hammer.martin_test(states).toarray()
+        coeffs, corrs, res = hammer.get_corrections(states, coupled_states=states, return_resonances=True)
+        self.assertTrue(np.allclose(res['martin'].toarray(), martin))
+        self.assertEqual(len(res['pairs']), np.count_nonzero(np.abs(martin) >= 1 / UnitsData.convert("Hartrees", "Wavenumbers")))
+
+        _, corrs2, res2 = hammer.get_corrections(states, coupled_states='auto', memory_budget=2**16,
+                                                 return_resonances=True)
+        _, corrs3 = hammer.get_corrections(states, coupled_states='auto')
+        self.assertTrue(all(np.allclose(a, b) for a, b in zip(corrs2, corrs3)))
+        self.assertEqual(res2['martin'].shape[0], len(states))
+
+    @validationTest
+    def test_SymmetricTensor(self):
+        import scipy.sparse as sp
+
+        rng = np.random.RandomState(0)
+        for shape, groups in (((4, 4, 4), None), ((4, 3, 4), ((0, 2), (1,))), ((3, 4, 4, 3), ((0, 3), (1, 2)))):
+            t = rng.normal(size=shape)
+            perms = SymmetricTensor.get_permutations(t.ndim, SymmetricTensor._prep_groups(t.ndim, groups))
+            sym = sum(t.transpose(p) for p in perms) / len(perms)
+            packed = SymmetricTensor.from_dense(t, groups)
+            self.assertTrue(np.allclose(packed.toarray(), sym))
+            self.assertTrue(SymmetricTensor.is_symmetric(sym, groups))
+            self.assertLess(packed.size, sym.size)
+
+            other = rng.normal(size=shape + (5,))
+            ref = np.tensordot(sym, other, axes=[list(range(t.ndim))] * 2)
+            self.assertTrue(np.allclose(packed.contract(other), ref))
+            other = sp.random(sym.size, 5, density=.3, random_state=rng, format='csr')
+            self.assertTrue(np.allclose(packed.contract(other), other.T.dot(sym.reshape(-1))))
+
+            idx = tuple(rng.randint(0, s, 6) for s in shape)
+            self.assertTrue(np.allclose(packed[idx], sym[idx]))
+
+        hammer = SyntheticMolecule(6, seed=4).get_hamiltonian(3)
+        # the public terms stay dense, H1 and H2 contract against the packed ones
+        for dense, packed in zip(hammer.V_terms.terms[1:], hammer.V_terms.packed_terms[1:]):
+            self.assertIsInstance(dense, np.ndarray)
+            self.assertIsInstance(packed, SymmetricTensor)
+            self.assertTrue(np.allclose(dense, packed.toarray()))
+        states = np.arange(12)
+        rows, cols = np.repeat(states, len(states)), np.tile(states, len(states))
+        inds = tuple(zip(hammer.basis.unravel(rows), hammer.basis.unravel(cols)))
+        # the Cartesian normal modes have a constant G-matrix, so its derivatives are made up with the right symmetry
+        for compute, groups, V, KE, PE in (
+                (hammer._compute_h1, ((0, 2), (1,)), hammer.V_terms.packed_terms[1], 'pQp', 'QQQ'),
+                (hammer._compute_h2, ((0, 3), (1, 2)), hammer.V_terms.packed_terms[2], 'pQQp', 'QQQQ')
+        ):
+            G = SymmetricTensor.from_dense(rng.normal(size=(6,) * sum(len(g) for g in groups)), groups)
+            KE, PE = hammer.get_operator(KE), hammer.get_operator(PE)
+            self.assertTrue(np.allclose(
+                compute(inds, G, V, KE, PE),
+                compute(inds, G.toarray(), V.toarray(), KE, PE)
+            ))
+
+    @validationTest
+    def test_ExpansionTermsCache(self):
+        import tempfile
+
+        mol = SyntheticMolecule(6, seed=5)
+        same = lambda a, b: np.array_equal(
+            *(t.toarray() if isinstance(t, SymmetricTensor) else np.asarray(t) for t in (a, b))
+        )
+        def fail():
+            raise AssertionError("the terms should have come from the cache")
+        with tempfile.TemporaryDirectory() as d:
+            hammer = mol.get_hamiltonian(3, cache_dir=d)
+            terms = hammer.V_terms.packed_terms, hammer.G_terms.packed_terms
+            key = hammer.V_terms.cache_key
+            cache = ExpansionTermsCache(d)
+            self.assertTrue(cache.has(key, "PotentialTerms") and cache.has(key, "KineticTerms"))
+
+            hammer2 = mol.get_hamiltonian(3, cache_dir=d)
+            self.assertEqual(hammer2.V_terms.cache_key, key)
+            hammer2.V_terms.get_terms = hammer2.G_terms.get_terms = fail
+            for old, new in zip(terms, (hammer2.V_terms.packed_terms, hammer2.G_terms.packed_terms)):
+                self.assertEqual(len(old), len(new))
+                self.assertTrue(all(same(a, b) for a, b in zip(old, new)))
+                self.assertTrue(all(type(a) is type(b) for a, b in zip(old, new)))
+
+            # without derivatives the terms can only come from the cache
+            from Psience import NormalModeCoordinates
+            opts = dict(coords=mol.coords, masses=mol.masses, pot_derivs=None,
+                        modes=NormalModeCoordinates(mol.modes, freqs=mol.freqs), n_quanta=3)
+            hammer3 = PerturbationTheoryHamiltonian(cache_dir=d, cache_key=key, **opts)
+            self.assertTrue(all(same(a, b) for a, b in zip(terms[0], hammer3.V_terms.packed_terms)))
+            with tempfile.TemporaryDirectory() as empty:
+                with self.assertRaises(PerturbationTheoryException):
+                    PerturbationTheoryHamiltonian(cache_dir=empty, cache_key=key, **opts).V_terms.terms
+
+            # anything that changes the terms changes the key
+            heavy = SyntheticMolecule(6, seed=5)
+            heavy.masses = heavy.masses * 2
+            self.assertNotEqual(heavy.get_hamiltonian(3, cache_dir=d).V_terms.cache_key, key)
+            rotated = SyntheticMolecule(6, seed=5)
+            rotated.modes = rotated.modes[::-1]
+            self.assertNotEqual(rotated.get_hamiltonian(3, cache_dir=d).V_terms.cache_key, key)
+            # as does the definition of the internals, not just what kind of coordinates they are
+            from types import SimpleNamespace
+            ordering = [[0, -1, -1], [1, 0, -1], [2, 0, 1]]
+            zmat = lambda matrix, ordering=ordering: SimpleNamespace(
+                name="ZMatrix", dimension=(None, 3), converter_options=dict(ordering=ordering), matrix=matrix
+            )
+            keys = [
+                mol.get_hamiltonian(3, cache_dir=d, internals=z).V_terms.cache_key
+                for z in (zmat(np.eye(3)), zmat(np.eye(3)), zmat(2 * np.eye(3)), zmat(np.eye(3), ordering[::-1]))
+            ]
+            self.assertEqual(keys[0], keys[1])
+            self.assertEqual(len(set(keys[1:])), 3)
+            self.assertNotEqual(keys[0], key)
+            files = []
+            for n, contents in enumerate((b"abc", b"abc", b"abd")):
+                files.append(os.path.join(d, "{}.fchk".format(n)))
+                with open(files[-1], 'wb') as f:
+                    f.write(contents)
+            keys = [cache.get_file_key(f, None, True) for f in files]
+            self.assertEqual(keys[0], keys[1])
+            self.assertNotEqual(keys[0], keys[2])
+            self.assertNotEqual(keys[0], cache.get_file_key(files[0], None, False))
+
+    @validationTest
+    def test_Batch(self):
+        import tempfile, json
+
+        states = [(0, 0, 0), (0, 0, 1), (0, 1, 0), (1, 0, 0)]
+        jobs = [
+            _SyntheticJob(seed=0, states=states, delay=1),
+            _SyntheticJob(failure="raise"),
+            _SyntheticJob(seed=1, states=states),
+            _SyntheticJob(failure="crash"),
+            _SyntheticJob(seed=2, states=states, n_quanta=4)
+        ]
+        results = list(run_batch(jobs, processes=3))
+        self.assertEqual([r.file for r in results], [j.file for j in jobs])
+        self.assertEqual([r.failed for r in results], [False, True, False, True, False])
+        self.assertIn("ValueError: bad input", results[1].error)
+        self.assertIn("exited with code 3", results[3].error)
+        for job, res in zip(jobs, results):
+            if not res.failed:
+                coeffs, corrs = SyntheticMolecule(3, seed=job.seed).get_hamiltonian(job.n_quanta).get_corrections(
+                    states, coupled_states='auto'
+                )
+                self.assertTrue(np.allclose(res.total_energies, sum(corrs)))
+                self.assertTrue(np.allclose(np.abs(res.coefficients[:, 0]), np.max(np.abs(coeffs), axis=1)))
+                self.assertEqual(res.states.tolist(), [list(s) for s in states])
+
+        try:
+            import resource
+        except ImportError:
+            pass
+        else:
+            # the limit is far above what a worker needs but far below the allocation
+            mem, ok = run_batch([_SyntheticJob(failure="memory"), _SyntheticJob()], memory_limit=2**32)
+            self.assertIn("MemoryError", mem.error)
+            self.assertFalse(ok.failed)
+
+        with tempfile.TemporaryDirectory() as d:
+            spec = os.path.join(d, "jobs.json")
+            with open(spec, 'w') as f:
+                json.dump([os.path.join(d, "missing{}.fchk".format(i)) for i in range(3)], f)
+            out = os.path.join(d, "results.jsonl")
+            from PyVPT.Batch import main
+            self.assertEqual(main([spec, "--processes", "2", "--output", out]), 1)
+            with open(out) as f:
+                results = [json.loads(l) for l in f]
+            self.assertEqual([r["file"] for r in results], [os.path.join(d, "missing{}.fchk".format(i)) for i in range(3)])
+            self.assertTrue(all(r["error"] is not None for r in results))
+
+    @validationTest
+    def test_OperatorCache(self):
+
+        cache = PerturbationTheoryHamiltonian.OperatorCache(max_size=3)
+        built = []
+        def get(key):
+            return cache.get(key, lambda: built.append(key) or np.zeros(10))
+        for key in "abca":
+            get(key)
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+        get("d") # evicts b, which is now the least recently used
+        self.assertEqual(len(cache), 3)
+        self.assertNotIn("b", cache)
+        self.assertTrue(all(k in cache for k in "acd"))
+        get("b")
+        self.assertNotIn("c", cache)
+        self.assertEqual((cache.hits, cache.misses), (1, 5))
+        self.assertEqual(built, list("abcdb"))
+        bounded = PerturbationTheoryHamiltonian.OperatorCache(max_size=None, max_bytes=200)
+        for key in "abc":
+            bounded.get(key, lambda: np.zeros(10))
+        self.assertEqual(len(bounded), 2)
+        self.assertNotIn("a", bounded)
+
+        mol = SyntheticMolecule(3, seed=6)
+        states = np.arange(20)
+        idx = np.ix_(states, states)
+        cached = mol.get_hamiltonian(4)
+        thrashing = mol.get_hamiltonian(4, operator_cache_size=1)
+        for H, H2 in ((cached.H1, thrashing.H1), (cached.H2, thrashing.H2)):
+            block = H[idx]
+            misses = cached.operator_cache.misses
+            self.assertTrue(np.allclose(H[idx], block))
+            self.assertEqual(cached.operator_cache.misses, misses)
+            self.assertTrue(np.allclose(H2[idx], block))
+        self.assertGreater(cached.operator_cache.hits, 0)
+        self.assertLessEqual(len(thrashing.operator_cache), 1)
+
+        n, m = cached.basis.unravel(np.repeat(states, 20)), cached.basis.unravel(np.tile(states, 20))
+        inds = tuple(zip(n, m))
+        for name in ('pQp', 'QQQ', 'pQQp', 'QQQQ'):
+            uncached = getattr(PerturbationTheoryHamiltonian.ProductOperator, name)(cached.n_quanta)
+            self.assertTrue(np.allclose(
+                cached.get_operator(name).get_element_matrix(inds).toarray(),
+                uncached.get_element_matrix(inds).toarray()
+            ))
+
+    @validationTest
+    def test_JacobianProvider(self):
+
+        for lists in (True, False):
+            internals = _FakeJacobians(4, lists=lists)
+            carts = _FakeJacobians(4, lists=lists)
+            ints = _FakeJacobians(4, lists=lists)
+            jacs = PerturbationTheoryHamiltonian.JacobianProvider(np.zeros((3, 3)), internals)
+            jacs._cartesians, jacs._internal_coords = carts, ints
+            # the same arrays the per-order Coordinerds calls give, computed in a single pass when lists work
+            for fake, get, orders in (
+                    (internals, lambda o: jacs.get_mode_jacobians(None, o), (1, 2, 3, 4)),
+                    (carts, jacs.get_cartesian_jacobians, (1, 2)),
+                    (ints, jacs.get_internal_jacobians, (2, 3))
+            ):
+                res = get(orders)
+                self.assertEqual(len(res), len(orders))
+                self.assertTrue(all(np.array_equal(r, fake.get(o)) for r, o in zip(res, orders)))
+                todo = list(range(1, max(orders) + 1))
+                self.assertEqual(fake.calls, [todo] if lists else [todo] + todo)
+                calls = len(fake.calls)
+                res = get(orders[:1])
+                self.assertTrue(np.array_equal(res[0], fake.get(orders[0])))
+                self.assertEqual(len(fake.calls), calls)
+
+        # anything other than one array per order also falls back to asking for the orders one at a time
+        jacs = PerturbationTheoryHamiltonian.JacobianProvider(None, None)
+        calls = []
+        def jacobian(o):
+            calls.append(o)
+            return np.full(3, o) if not isinstance(o, list) else np.zeros(3)
+        self.assertEqual([j[0] for j in jacs.get_jacobians("test", jacobian, (1, 2))], [1, 2])
+        self.assertEqual(calls, [[1, 2], 1, 2])
+
+        # the mode Jacobians are keyed on the mode matrix, not on which object holds it
+        from types import SimpleNamespace
+        internals = _FakeJacobians(4)
+        jacs = PerturbationTheoryHamiltonian.JacobianProvider(np.zeros((3, 3)), internals)
+        jacs._cartesians = _FakeJacobians(4)
+        jacs.get_mode_jacobians(SimpleNamespace(matrix=np.eye(4)), (1,))
+        jacs.get_mode_jacobians(SimpleNamespace(matrix=np.eye(4)), (1,))
+        self.assertEqual(len(internals.calls), 1)
+        jacs.get_mode_jacobians(SimpleNamespace(matrix=2 * np.eye(4)), (1,))
+        self.assertEqual(len(internals.calls), 2)
+
+        internals = _FakeJacobians(4)
+        hammer = SyntheticMolecule(3).get_hamiltonian(3, internals=internals)
+        self.assertIs(hammer.V_terms.jacobians, hammer.G_terms.jacobians)
+
+    @validationTest
+    def test_PlannedDot(self):
+        import functools as fp
+
+        fold = lambda t, axes: fp.reduce(lambda a, b: np.tensordot(a, b[0], axes=b[1]), zip(t[1:], axes), t[0])
+        chains = []
+        class Recorded(PerturbationTheoryHamiltonian.PotentialTerms):
+            @classmethod
+            def _planned_dot(cls, t, axes):
+                chains.append((t, axes))
+                return super()._planned_dot(t, axes)
+        class Folded(PerturbationTheoryHamiltonian.PotentialTerms):
+            @classmethod
+            def _planned_dot(cls, t, axes):
+                return fold(t, axes)
+
+        rng = np.random.RandomState(0)
+        n = 4
+        x_derivs = [rng.normal(size=(n,) * (k + 1)) for k in range(1, 5)]
+        V_derivs = [rng.normal(size=(n,) * k) for k in range(1, 5)]
+        mixed = V_derivs[:2] + [rng.normal(size=(n,) * 3), rng.normal(size=(n,) * 4)]
+        for x, V, m in ((x_derivs, V_derivs, False), ([x_derivs[0], 0, 0, 0], mixed, True), (x_derivs, mixed, True)):
+            planned = Recorded._get_tensor_derivs(x, V, mixed_XQ=m)
+            folded = Folded._get_tensor_derivs(x, V, mixed_XQ=m)
+            self.assertTrue(all(np.allclose(a, b) for a, b in zip(planned, folded)))
+        # every chain of three or more tensors get_terms builds, at the ranks it builds them with
+        self.assertGreaterEqual(len(set((tuple(np.ndim(a) for a in t), str(ax)) for t, ax in chains)), 8)
+        for t, axes in chains:
+            self.assertTrue(np.allclose(PerturbationTheoryHamiltonian.ExpansionTerms._planned_dot(t, axes), fold(t, axes)))
+
+    @validationTest
+    def test_ResonanceScreening(self):
+
+        hammer = SyntheticMolecule(3, seed=2).get_hamiltonian(4)
+        states = hammer.get_state_indices([(0, 0, 0), (0, 0, 1), (0, 1, 0), (1, 0, 0)])
+        coupled = np.setdiff1d(np.arange(len(hammer.basis)), states)[::3]
+        dense = lambda t: np.asarray(t.toarray() if hasattr(t, 'toarray') else t)
+        H1 = dense(hammer.H1[np.ix_(states, coupled)])
+        diffs = dense(hammer.H0[states, states])[:, np.newaxis] - dense(hammer.H0[coupled, coupled])[np.newaxis]
+        martin = H1**4 / diffs**3
+        self.assertTrue(np.allclose(hammer.martin_test(states, coupled_states=coupled).toarray(), martin))
+
+        for budget in (None, 2**12):
+            coeffs, corrs, res = hammer.get_corrections(states, coupled_states=coupled, memory_budget=budget,
+                                                        resonance_threshold=1e-12, return_resonances=True)
+            self.assertTrue(np.allclose(res['martin'].toarray(), martin))
+            self.assertEqual(len(res['pairs']), np.count_nonzero(np.abs(martin) >= 1e-12))
+            self.assertEqual(len(hammer.get_corrections(states, coupled_states=coupled, memory_budget=budget)), 2)
+        self.assertEqual(len(hammer._get_corrections(states, coupled_states=coupled)), 7)
+        self.assertIsNone(hammer._get_corrections(states, coupled_states=coupled)[6])
+        with self.assertRaises(PerturbationTheoryException):
+            hammer.get_corrections(states, resonance_threshold=True)
+
+    @validationTest
+    def test_ElementExecutor(self):
+        import threading, time
+
+        lock = threading.Lock()
+        running = [0, 0]
+        def block(i):
+            def run():
+                with lock:
+                    running[0] += 1
+                    running[1] = max(running)
+                time.sleep(.05)
+                with lock:
+                    running[0] -= 1
+                return i, threading.get_ident()
+            return run
+
+        with ElementExecutor(max_workers=2) as executor:
+            res = executor.run_all([block(i) for i in range(6)])
+            self.assertEqual([r[0] for r in res], list(range(6)))
+            self.assertEqual(running[1], 2)
+            threads = executor._block_pool
+            executor.run_all([block(i) for i in range(3)])
+            self.assertIs(executor._block_pool, threads)
+        self.assertIsNone(executor._block_pool)
+
+        serial = ElementExecutor(max_workers=1)
+        self.assertEqual(serial.run_all([block(0)])[0][1], threading.get_ident())
+        self.assertEqual(serial.run_all([block(0), block(1)])[1][1], threading.get_ident())
+        self.assertIsNone(serial._block_pool)
+        # closures never go through the process pool
+        with ElementExecutor(mode='processes', max_workers=2) as executor:
+            self.assertEqual([r[0] for r in executor.run_all([block(i) for i in range(3)])], [0, 1, 2])
+            self.assertIsNone(executor._pool)
+
+        # the shared arrays are only copied into shared memory once and released afterwards
+        from multiprocessing import shared_memory
+        from ..Executors import _SharedArrays, _call_with_shared
+        tables = [np.arange(40.).reshape(8, 5), np.arange(3, dtype=np.int32)]
+        expected = [_shared_row_sum(tables, i) for i in range(8)]
+        for mode in ElementExecutor.modes:
+            with ElementExecutor(mode=mode, max_workers=2) as executor:
+                self.assertEqual(executor.map(_shared_row_sum, range(8), shared=tables), expected)
+        with _SharedArrays(tables) as spec:
+            self.assertEqual(_call_with_shared(_shared_row_sum, spec, 3), expected[3])
+        with self.assertRaises(FileNotFoundError):
+            shared_memory.SharedMemory(name=spec[0])
+
+        states = [(0, 0, 0), (0, 0, 1), (0, 1, 0), (1, 0, 0)]
+        mol = SyntheticMolecule(3, seed=3)
+        coeffs, corrs = mol.get_hamiltonian(4).get_corrections(states)
+        for mode in ElementExecutor.modes:
+            with ElementExecutor(mode=mode, max_workers=3) as executor:
+                coeffs2, corrs2 = mol.get_hamiltonian(4, executor=executor).get_corrections(states)
+            self.assertTrue(np.array_equal(coeffs, coeffs2))
+            self.assertTrue(all(np.array_equal(a, b) for a, b in zip(corrs, corrs2)))
+
+        # the Hamiltonian only shuts down the pools it made itself
+        with mol.get_hamiltonian(4, executor=2) as hammer:
+            hammer.get_corrections(states)
+            self.assertIsNotNone(hammer.executor._block_pool)
+        self.assertIsNone(hammer.executor._block_pool)
+        self.assertIsNone(hammer.executor._pool)
+        with ElementExecutor(max_workers=2) as executor:
+            with mol.get_hamiltonian(4, executor=executor) as hammer:
+                hammer.get_corrections(states)
+            self.assertIsNotNone(executor._block_pool)
+            self.assertIsNotNone(executor._pool)
+
+        # the element cache is hit from every block at once, so its counts have to add up
+        cache = PerturbationTheoryHamiltonian.ElementCache()
+        rng = np.random.RandomState(3)
+        idx = [[tuple(rng.randint(0, 4, size=(2, 200))) for _ in range(3)] for _ in range(16)]
+        compute = lambda i: np.ones(len(i[0][0]))
+        with ElementExecutor(max_workers=8) as executor:
+            executor.run_all([(lambda i=i: cache.get("H", i, compute)) for i in idx])
+        self.assertEqual(cache.hits + cache.misses, 16 * 200)
+
+    @validationTest
+    def test_SharedOperators(self):
+
+        states = [(0, 0, 0), (0, 0, 1), (0, 1, 0), (1, 0, 0)]
+        mol = SyntheticMolecule(3, seed=5)
+        prof1, prof2 = Profiler(), Profiler()
+        with ElementExecutor(max_workers=2) as executor:
+            h1 = mol.get_hamiltonian(4, profiler=prof1, executor=executor)
+            h2 = mol.get_hamiltonian(4, profiler=prof2)
+            h2.operator_cache = h1.operator_cache
+            _, corrs1 = h1.get_corrections(states, coupled_states='auto')
+            calls = prof1.report()["ProductOperator(QQQ).get_element_matrix"]["calls"]
+            _, corrs2 = h2.get_corrections(states, coupled_states='auto')
+        # the shared operators are never handed either Hamiltonian's profiler or executor
+        op = h1.get_operator('QQQ')
+        self.assertIs(h2.get_operator('QQQ'), op)
+        self.assertIsNone(op.profiler)
+        self.assertIsNone(op.executor)
+        self.assertEqual(prof1.report()["ProductOperator(QQQ).get_element_matrix"]["calls"], calls)
+        self.assertEqual(prof2.report()["ProductOperator(QQQ).get_element_matrix"]["calls"], calls)
+        self.assertTrue(all(np.allclose(a, b) for a, b in zip(corrs1, corrs2)))
+
+    @validationTest
+    def test_WeightDerivatives(self):
+        import math
+
+        def loop_weights(t):
+            # the original diagonal-slice loop
+            s = t.shape
+            weights = np.ones(s)
+            all_inds = list(range(len(s)))
+            for i in range(2, len(s) + 1):
+                for inds in ip.combinations(all_inds, i):
+                    sel = tuple(slice(None, None, None) if a not in inds else np.arange(s[a]) for a in all_inds)
+                    weights[sel] = 1 / math.factorial(i)
+            return t * weights
+
+        terms = PerturbationTheoryHamiltonian.ExpansionTerms
+        rng = np.random.RandomState(0)
+        tensors = [rng.normal(size=s) for s in ((5,), (5, 5), (4, 4, 4), (4, 4, 4, 4))]
+        for t in tensors:
+            self.assertTrue(np.allclose(terms._weight_derivatives(t), loop_weights(t)))
+        weights = terms._get_weights((4, 4, 4, 4))
+        self.assertIs(terms._get_weights((4, 4, 4, 4)), weights)
+
+        # the large tensor branch only stores the entries on the diagonals
+        limit, cache = terms._dense_weight_limit, dict(terms._weight_cache)
+        try:
+            terms._dense_weight_limit = 0
+            terms._weight_cache.clear()
+            for t in tensors[1:]:
+                self.assertIsInstance(terms._get_weights(t.shape), tuple)
+                self.assertTrue(np.allclose(terms._weight_derivatives(t), loop_weights(t)))
+        finally:
+            terms._dense_weight_limit = limit
+            terms._weight_cache.clear()
+            terms._weight_cache.update(cache)
+
+        sym = SymmetricTensor.from_dense(sum(tensors[3].transpose(p) for p in ip.permutations(range(4))))
+        self.assertTrue(np.allclose(terms._weight_derivatives(sym).toarray(), loop_weights(sym.toarray())))
+
+        hammer = SyntheticMolecule(3, seed=4).get_hamiltonian(3)
+        dense = lambda t: np.asarray(t.toarray() if hasattr(t, 'toarray') else t)
+        for t, w in zip(hammer.V_terms.terms, hammer.V_terms.weighted_terms):
+            self.assertTrue(np.allclose(dense(w), loop_weights(dense(t))))
+
+    @validationTest
+    def test_ElementIndexing(self):
+
+        hammer = SyntheticMolecule(3).get_hamiltonian(3)
+        ndims = len(hammer.basis)
+        dense = lambda t: np.asarray(t.asarray() if hasattr(t, 'asarray') else t)
+        rows = np.array([0, 2, 5, ndims - 1])
+        mask = np.zeros(ndims, dtype=bool)
+        mask[rows] = True
+        for H in (hammer.H0, hammer.H1, hammer.H2):
+            self.assertTrue(np.allclose(dense(H[rows - ndims, 1]), dense(H[rows, 1])))
+            self.assertTrue(np.allclose(dense(H[mask, 1]), dense(H[rows, 1])))
+            self.assertTrue(np.allclose(dense(H[rows, :]), dense(H[np.ix_(rows, np.arange(ndims))])))
+            with self.assertRaises(IndexError):
+                H[[-ndims - 1], 0]
+            with self.assertRaises(IndexError):
+                H[[ndims], 0]
+            with self.assertRaises(IndexError):
+                H[mask[:-1], 0]
+
+    @validationTest
+    def test_AutoCoupledStates(self):
+
+        mol = SyntheticMolecule(3, seed=3)
+        hammer = mol.get_hamiltonian(6)
+        states = [(0, 0, 0), (0, 0, 1), (0, 1, 0), (1, 0, 0), (0, 1, 1)]
+        coeffs, corrs = hammer.get_corrections(states, coupled_states='auto')
+        coeffs2, corrs2 = hammer.get_corrections(states, coupled_states=None)
+        self.assertTrue(all(np.allclose(a, b) for a, b in zip(corrs, corrs2)))
+        # the coefficients only run over the states the selection rules allow, the rest are zero
+        _, _, coupled = hammer.get_corrections(states, coupled_states='auto', return_coupled_states=True)
+        full = np.zeros(coeffs2.shape)
+        full[:, coupled] = coeffs
+        self.assertTrue(np.allclose(full, coeffs2))
+        self.assertGreater(np.count_nonzero(coeffs), 0)
+
+    @validationTest
+    def test_ConvergedEnergies(self):
+
+        mol = SyntheticMolecule(3, seed=3)
+        hammer = mol.get_hamiltonian(3)
+        states = [(0, 0, 0), (0, 0, 1)]
+        energies, history = hammer.get_converged_energies(states, tolerance=1e-12, max_quanta=7, step=2)
+        self.assertEqual(history[-1][0], (7, 7, 7))
+        _, corrs = mol.get_hamiltonian(7).get_corrections(states, coupled_states='auto')
+        self.assertTrue(np.allclose(energies, sum(corrs)))
+        # the Hamiltonian it was called on is left as it was
+        self.assertEqual(hammer.n_quanta, (3, 3, 3))
+        self.assertEqual(len(hammer.basis), 3**3)
+        self.assertIsNone(hammer.element_cache)
+        with self.assertRaises(PerturbationTheoryException):
+            hammer.get_converged_energies(states, tolerance=0, max_quanta=5)
+        self.assertEqual(hammer.n_quanta, (3, 3, 3))
+        self.assertIsNone(hammer.element_cache)
+
+    @validationTest
+    def test_TripMass(self):
+
+        masses = np.array([1., 2., 3., 4.])
+        self.assertEqual(PerturbationTheoryHamiltonian._tripmass(masses).tolist(), [1.]*3 + [2.]*3 + [3.]*3 + [4.]*3)
+        # the mass weighting of the modes has to line up with the Cartesian coordinates past three atoms too
+        mol = SyntheticMolecule(6, seed=2)
+        hammer = mol.get_hamiltonian(3)
+        modes_T, modes_V = hammer.undimensionalize(mol.masses, hammer.modes)
+        sqm = np.sqrt(np.repeat(mol.masses, 3))
+        self.assertTrue(np.allclose(modes_T.matrix, mol.modes * sqm * np.sqrt(mol.freqs)[:, np.newaxis]))
+        self.assertTrue(np.allclose(modes_V.matrix, mol.modes / sqm / np.sqrt(mol.freqs)[:, np.newaxis]))
+
+    @validationTest
+    def test_SyntheticMolecule(self):
+
+        mol = SyntheticMolecule(6, seed=1)
+        hammer = mol.get_hamiltonian(3)
+        dense = lambda t: np.asarray(t.toarray() if hasattr(t, 'toarray') else t)
+        self.assertTrue(np.allclose(dense(hammer.V_terms[0]), np.diag(mol.freqs)))
+        self.assertTrue(np.allclose(dense(hammer.G_terms[0]), np.diag(mol.freqs)))
+        self.assertTrue(np.allclose(dense(hammer.V_terms[1]), mol.cubic))
+        # only the quartic terms with a repeated mode come through the semi-diagonal fourth derivatives
+        idx = np.indices(mol.quartic.shape)
+        semi = np.any([idx[i] == idx[j] for i in range(4) for j in range(i + 1, 4)], axis=0)
+        self.assertTrue(np.allclose(dense(hammer.V_terms[2])[semi], mol.quartic[semi]))
+
     @debugTest
     def test_WaterVPT(self):
 
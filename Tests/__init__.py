@@ -1,2 +1,2 @@
-
-from .VPTTests import *
\ No newline at end of file
+from .VPTTests import *
+from .VPTBenchmarks import *
\ No newline at end of file
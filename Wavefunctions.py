@@ -0,0 +1,98 @@
+"""
+Provides the wavefunctions that come out of the perturbation theory (and variational) calculations,
+which are kept apart from the Hamiltonian since they're the only thing that needs Psience's wavefunction machinery
+"""
+
+import numpy as np
+from Psience import Wavefunctions, Wavefunction
+from .Serialization import ArrayContainer
+
+__all__ = [
+    'PerturbationTheoryWavefunctions'
+]
+
+class PerturbationTheoryWavefunction(Wavefunction):
+    @property
+    def coeffs(self):
+        return self.data
+
+class PerturbationTheoryWavefunctions(Wavefunctions):
+    def __init__(self, basis, energies, coeffs, hamiltonian):
+        """Energies for the wavefunctions generated
+
+        :param basis: the quantum numbers of the states the coefficients run over
+        :type basis: np.ndarray | None
+        :param energies:
+        :type energies:
+        :param coeffs:
+        :type coeffs:
+        :param hamiltonian:
+        :type hamiltonian:
+        """
+        self.hamiltonian = hamiltonian
+        self.basis = basis
+        super().__init__(
+            energies=energies,
+            wavefunctions=coeffs,
+            wavefunction_class=PerturbationTheoryWavefunction
+        )
+
+    @property
+    def coeffs(self):
+        return self.wavefunctions
+
+    def save(self, file, save_hamiltonian=True):
+        """Saves the basis, energies, and coefficients (and, optionally, the Hamiltonian they came from)
+        as an `ArrayContainer`
+
+        :param file:
+        :type file: str
+        :param save_hamiltonian: whether to store the Hamiltonian as well
+        :type save_hamiltonian: bool
+        """
+        arrays = dict(energies=np.asarray(self.energies))
+        coeffs = self.coeffs
+        if hasattr(coeffs, 'indptr'):
+            coeffs = coeffs.tocsr()
+            ArrayContainer.add_group(arrays, "coeffs", dict(
+                data=coeffs.data, indices=coeffs.indices, indptr=coeffs.indptr, shape=np.array(coeffs.shape)
+            ))
+        else:
+            arrays["coeffs"] = np.asarray(coeffs)
+        if self.basis is not None:
+            arrays["basis"] = np.asarray(self.basis)
+        metadata = dict(type=type(self).__name__, hamiltonian=None)
+        if save_hamiltonian and self.hamiltonian is not None:
+            ham_arrays, metadata["hamiltonian"] = self.hamiltonian.to_data()
+            ArrayContainer.add_group(arrays, "hamiltonian", ham_arrays)
+        ArrayContainer.write(file, arrays, metadata=metadata)
+    @classmethod
+    def load(cls, file, mmap=True, hamiltonian=None):
+        """Loads wavefunctions written by `save`, memory-mapping the coefficients by default so that many sets of
+        results can be opened at once
+
+        :param file:
+        :type file: str
+        :param mmap: whether to memory-map the large arrays instead of reading them into memory
+        :type mmap: bool
+        :param hamiltonian: the Hamiltonian to attach, by default the stored one (if there is one)
+        :type hamiltonian: PerturbationTheoryHamiltonian | None
+        :return:
+        :rtype: PerturbationTheoryWavefunctions
+        """
+        arrays, metadata = ArrayContainer.read(file, mmap=mmap)
+        if metadata is None or metadata.get("type") != cls.__name__:
+            raise ValueError("{}.load: {} doesn't hold wavefunctions".format(cls.__name__, file))
+        if "coeffs" in arrays:
+            coeffs = arrays["coeffs"]
+        else:
+            import scipy.sparse as sp
+            parts = ArrayContainer.get_group(arrays, "coeffs")
+            coeffs = sp.csr_matrix((parts["data"], parts["indices"], parts["indptr"]), shape=tuple(parts["shape"]))
+        if hamiltonian is None and metadata["hamiltonian"] is not None:
+            from .PerturbationTheory import PerturbationTheoryHamiltonian
+            hamiltonian = PerturbationTheoryHamiltonian.from_data(
+                ArrayContainer.get_group(arrays, "hamiltonian"),
+                metadata["hamiltonian"]
+            )
+        return cls(arrays.get("basis", None), arrays["energies"], coeffs, hamiltonian)
@@ -2,9 +2,35 @@
 provides a class for doing (2nd order) vibrational perturbation theory in python
 builds off of resource packages to handle most of the dirty work and just does the actual potential expansions
 and pertubation theory computations
+
+the submodules are only imported once something from them is used, since most of them pull in
+heavy dependencies and short-lived worker processes shouldn't pay for what they don't touch
 """
 
-from .PerturbationTheory import *
+import importlib
+
+# each submodule and what it exports, which has to be kept in sync with the submodules' own __all__
+_submodules = {
+    "PerturbationTheory": ["PerturbationTheoryException", "PerturbationTheoryHamiltonian"],
+    "Wavefunctions": ["PerturbationTheoryWavefunctions"],
+    "SymmetricTensors": ["SymmetricTensor"],
+    "Caching": ["ExpansionTermsCache"],
+    "Batch": ["VPTJob", "VPTJobResult", "run_batch"],
+    "Profiling": ["Profiler", "ProfilerEvent"],
+    "StateSpaces": ["StateSpace", "DirectProductStateSpace", "TruncatedStateSpace"],
+    "Executors": ["ElementExecutor"],
+    "Serialization": ["ArrayContainer"]
+}
+_exports = {name: mod for mod, names in _submodules.items() for name in names}
+
+__all__ = list(_exports)
+
+def __getattr__(name):
+    if name in _exports:
+        val = getattr(importlib.import_module("." + _exports[name], __name__), name)
+        globals()[name] = val
+        return val
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
-from .PerturbationTheory import __all__ as PT__all__
-__all__ = PT__all__
\ No newline at end of file
+def __dir__():
+    return sorted(set(globals()) | set(__all__))